@@ -0,0 +1,76 @@
+"""
+Compares the cpu chunk planner of attention_sub_quad against the legacy free memory heuristic on long sequences.
+
+Each configuration runs in its own process so the reported peak RSS is not polluted by the previous run.
+
+    python -m benchmarks.attention_chunking --tokens 4096 16384 --cpu-attention-memory 1.0
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+
+
+def legacy_chunks(batch_x_heads, k_tokens, bytes_per_token, mem_free_total):
+    # the heuristic attention_sub_quad uses on every device except the cpu
+    for x in [4096, 2048, 1024, 512, 256]:
+        count = mem_free_total / (batch_x_heads * bytes_per_token * x * 4.0)
+        if count >= k_tokens:
+            return x, k_tokens
+    return 512, None
+
+
+def run(mode, batch, heads, tokens, dim_head, runs, budget_gb, queue):
+    import torch
+    from comfy.cli_args import args
+    args.cpu = True
+    args.cpu_attention_memory = budget_gb
+    import comfy.model_management
+    from comfy.ldm.modules import attention
+    from comfy.ldm.modules.sub_quadratic_attention import efficient_dot_product_attention
+
+    torch.manual_seed(0)
+    query = torch.randn(batch * heads, tokens, dim_head)
+    key_t = torch.randn(batch * heads, dim_head, tokens)
+    value = torch.randn(batch * heads, tokens, dim_head)
+
+    if mode == "legacy":
+        mem_free_total = comfy.model_management.get_free_memory(torch.device("cpu"))
+        query_chunk_size, kv_chunk_size = legacy_chunks(batch * heads, tokens, 4, mem_free_total)
+    else:
+        query_chunk_size, kv_chunk_size = attention.plan_sub_quad_chunks(batch * heads, tokens, tokens, dim_head, 4, attention.attention_memory_budget(torch.device("cpu")))
+
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        efficient_dot_product_attention(query, key_t, value, query_chunk_size=query_chunk_size, kv_chunk_size=kv_chunk_size, use_checkpoint=False)
+        timings.append(time.perf_counter() - start)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((query_chunk_size, kv_chunk_size, min(timings), (peak_rss - base_rss) / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, nargs="+", default=[4096, 9216, 16384])
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--heads", type=int, default=8)
+    parser.add_argument("--dim-head", type=int, default=64)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--cpu-attention-memory", type=float, default=1.0, metavar="GB")
+    bench_args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    print("{:>8} {:>8} {:>8} {:>8} {:>10} {:>14} {:>14}".format("tokens", "mode", "q_chunk", "kv_chunk", "time (s)", "tokens/s", "peak RSS (MB)"))  # noqa: T201
+    for tokens in bench_args.tokens:
+        for mode in ("legacy", "planned"):
+            queue = ctx.Queue()
+            p = ctx.Process(target=run, args=(mode, bench_args.batch, bench_args.heads, tokens, bench_args.dim_head, bench_args.runs, bench_args.cpu_attention_memory, queue))
+            p.start()
+            q_chunk, kv_chunk, elapsed, rss = queue.get()
+            p.join()
+            print("{:>8} {:>8} {:>8} {:>8} {:>10.3f} {:>14.0f} {:>14.0f}".format(tokens, mode, q_chunk, str(kv_chunk), elapsed, bench_args.batch * tokens / elapsed, rss))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
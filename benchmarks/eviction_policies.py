@@ -0,0 +1,54 @@
+"""
+Replays model load traces against every eviction policy in comfy.model_eviction.
+
+Record a trace with `python main.py --model-eviction-trace trace.jsonl`, then:
+
+    python -m benchmarks.eviction_policies --trace trace.jsonl --vram 12
+
+Without --trace a synthetic mixed workload (text encoder, UNet with a LoRA stack, VAE) is used.
+"""
+import argparse
+import random
+
+from comfy import model_eviction
+
+GB = 1024 ** 3
+
+
+def synthetic_trace(prompts=200, seed=0):
+    rng = random.Random(seed)
+    clip = {"id": "clip", "name": "SDXLClipModel", "size": int(1.6 * GB), "patches": 0, "source": "ram"}
+    vae = {"id": "vae", "name": "AutoencoderKL", "size": int(0.16 * GB), "patches": 0, "source": "pinned"}
+    unets = [
+        {"id": "unet_a", "name": "SDXL", "size": int(4.8 * GB), "patches": 720, "source": "ram"},
+        {"id": "unet_b", "name": "SDXL", "size": int(4.8 * GB), "patches": 0, "source": "pinned"},
+    ]
+    upscaler = {"id": "upscale", "name": "ESRGAN", "size": int(0.07 * GB), "patches": 0, "source": "ram"}
+    trace = []
+    for _ in range(prompts):
+        unet = unets[0] if rng.random() < 0.8 else unets[1]
+        trace.append({"models": [clip], "memory_required": int(0.5 * GB)})
+        trace.append({"models": [unet], "memory_required": int(1.5 * GB)})
+        trace.append({"models": [vae], "memory_required": int(2.5 * GB)})
+        if rng.random() < 0.3:
+            trace.append({"models": [upscaler], "memory_required": int(3 * GB)})
+    return trace
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", type=str, default=None, help="jsonl trace recorded with --model-eviction-trace")
+    parser.add_argument("--vram", type=float, nargs="+", default=[8, 10, 12], help="Simulated device memory in GB.")
+    parser.add_argument("--lookahead", type=int, default=4, help="How many future load events the queue predictor sees.")
+    bench_args = parser.parse_args()
+
+    trace = model_eviction.load_trace(bench_args.trace) if bench_args.trace is not None else synthetic_trace()
+    print("{:>8} {:>8} {:>8} {:>8} {:>10} {:>9} {:>12} {:>10}".format("vram GB", "policy", "loads", "misses", "evictions", "partial", "loaded GB", "reload s"))  # noqa: T201
+    for vram in bench_args.vram:
+        for name, policy in model_eviction.POLICIES.items():
+            stats = model_eviction.simulate(trace, policy, int(vram * GB), lookahead=bench_args.lookahead)
+            print("{:>8} {:>8} {:>8} {:>8} {:>10} {:>9} {:>12.1f} {:>10.2f}".format(vram, name, stats["loads"], stats["misses"], stats["evictions"], stats["partial_evictions"], stats["bytes_loaded"] / GB, stats["reload_seconds"]))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
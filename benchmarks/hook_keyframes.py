@@ -0,0 +1,94 @@
+"""
+CPU benchmark of --hook-keyframe-cache: a randomly initialized model sampled with two scheduled LoRA hooks (one on the
+positive, one on the negative prompt), the way the hook keyframe nodes schedule LoRA strengths. The first hook fades
+out over --keyframes keyframes, the second alternates between two strengths. Reports the time spent patching the
+hooked weights per image, with and without the cache, and the swapped/scaled/recomputed weight counts.
+
+    python -m benchmarks.hook_keyframes --hidden-size 1024 --depth 8 --rank 32 --steps 20 --keyframes 5 --cache-size 1
+"""
+import argparse
+import time
+
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.hook_keyframe_cache
+import comfy.hooks
+import comfy.model_patcher
+from comfy.weight_adapter import LoRAAdapter
+
+
+def scheduled_hook(patcher, rank, strengths, seed):
+    torch.manual_seed(seed)
+    hook = comfy.hooks.WeightHook()
+    hook.hook_keyframe = comfy.hooks.HookKeyframeGroup()
+    for i, strength in enumerate(strengths):
+        keyframe = comfy.hooks.HookKeyframe(strength, start_percent=i / len(strengths))
+        keyframe.start_t = 1.0 - i / len(strengths) # sigmas go from 1 to 0
+        hook.hook_keyframe.add(keyframe)
+    patches = {}
+    for key, weight in patcher.model.state_dict().items():
+        if key.endswith(".weight"):
+            patches[key] = LoRAAdapter(set(), (torch.randn(weight.shape[0], rank) * 0.01, torch.randn(rank, weight.shape[1]) * 0.01, None, None, None, None))
+    patcher.add_hook_patches(hook, patches, 1.0)
+    group = comfy.hooks.HookGroup()
+    group.add(hook)
+    return group
+
+
+def sample(patcher, groups, steps):
+    sigmas = torch.linspace(1.0, 0.0, steps + 1)
+    model_options = {"transformer_options": {"sample_sigmas": sigmas}}
+    for group in groups:
+        group.reset()
+    start = time.perf_counter()
+    for t in sigmas[:-1]:
+        for group in groups:
+            patcher.prepare_hook_patches_current_keyframe(t.reshape(1), group, model_options)
+            patcher.apply_hooks(group)
+    elapsed = time.perf_counter() - start
+    weights = {k: v.clone() for k, v in patcher.model.state_dict().items()}
+    patcher.clean_hooks()
+    return elapsed, weights
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden-size", type=int, default=1024)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--rank", type=int, default=32)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--keyframes", type=int, default=5)
+    parser.add_argument("--cache-size", type=float, default=1.0, help="GB")
+    bench_args = parser.parse_args()
+
+    torch.manual_seed(0)
+    h = bench_args.hidden_size
+    model = torch.nn.Sequential(*[torch.nn.Sequential(torch.nn.Linear(h, h * 4), torch.nn.Linear(h * 4, h)) for _ in range(bench_args.depth)])
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    fade = [1.0 - i / bench_args.keyframes for i in range(bench_args.keyframes)]
+    pulse = [1.0 if i % 2 == 0 else 0.5 for i in range(bench_args.keyframes)]
+    groups = [scheduled_hook(patcher, bench_args.rank, fade, 1), scheduled_hook(patcher, bench_args.rank, pulse, 2)]
+    model_mb = sum(p.nbytes for p in model.parameters()) / (1024 * 1024)
+    print("model {:.0f} MB, 2 LoRA hooks of rank {} with {} keyframes, {} steps".format(model_mb, bench_args.rank, bench_args.keyframes, bench_args.steps))  # noqa: T201
+
+    print("{:>8} {:>10} {:>8} {:>8} {:>10} {:>10}".format("cache", "patch s", "swapped", "scaled", "recomputed", "max diff"))  # noqa: T201
+    reference = None
+    for cache_size in [0, bench_args.cache_size]:
+        comfy.hook_keyframe_cache.CACHE = None
+        if cache_size > 0:
+            comfy.hook_keyframe_cache.enable_cache(int(cache_size * 1024 * 1024 * 1024))
+        elapsed, weights = sample(patcher, groups, bench_args.steps)
+        if reference is None:
+            reference = weights
+        diff = max((weights[k] - reference[k]).abs().max().item() for k in weights)
+        counts = ["-"] * 3
+        if comfy.hook_keyframe_cache.CACHE is not None:
+            counts = [comfy.hook_keyframe_cache.CACHE.counts[k] for k in ("swaps", "scaled", "recomputes")]
+        print("{:>8} {:>10.3f} {:>8} {:>8} {:>10} {:>10.2e}".format("on" if cache_size > 0 else "off", elapsed, *counts, diff))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
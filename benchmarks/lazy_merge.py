@@ -0,0 +1,104 @@
+"""
+CPU benchmark of --lazy-merge: two randomly initialized transformer style models are merged with ModelMergeBlocks
+for a sweep of ratios of one block (the other blocks keep their ratio) and with ModelMergeSimple for a sweep of the
+global ratio. Every merge is loaded and run for a few steps, with the merge computed at load time as before and
+lazily with the evaluated layer cache. Reports the load time, the time of the steps and the RAM the merged model adds.
+
+    python -m benchmarks.lazy_merge --hidden-size 1024 --depth 8 --ratios 10 --steps 4
+"""
+import argparse
+import gc
+import time
+
+import psutil
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.lazy_merge
+import comfy.model_patcher
+import comfy.ops
+from comfy_extras.nodes_model_merging import ModelMergeBlocks, ModelMergeSimple
+
+
+class Model(torch.nn.Module):
+    def __init__(self, hidden_size, depth):
+        super().__init__()
+        ops = comfy.ops.manual_cast
+        self.diffusion_model = torch.nn.ModuleList([torch.nn.Sequential(ops.Linear(hidden_size, hidden_size * 4, dtype=torch.bfloat16),
+                                                                        torch.nn.GELU(),
+                                                                        ops.Linear(hidden_size * 4, hidden_size, dtype=torch.bfloat16)) for _ in range(depth)])
+        for m in self.modules():
+            if hasattr(m, "comfy_cast_weights"):
+                m.weight_function = []
+                m.bias_function = []
+
+    def forward(self, x):
+        for block in self.diffusion_model:
+            x = x + block(x)
+        return x
+
+
+def make_patcher(hidden_size, depth, seed):
+    torch.manual_seed(seed)
+    model = Model(hidden_size, depth)
+    for p in model.parameters():
+        torch.nn.init.normal_(p, std=0.02)
+    return comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+
+
+def rss():
+    return psutil.Process().memory_info().rss
+
+
+def sweep(merges, x, steps):
+    load = run = extra = 0.0
+    for merge in merges:
+        merged = merge()
+        gc.collect()
+        before = rss()
+        start = time.perf_counter()
+        merged.patch_model(torch.device("cpu"), lowvram_model_memory=0)
+        load += time.perf_counter() - start
+        start = time.perf_counter()
+        with torch.inference_mode():
+            for _ in range(steps):
+                merged.model(x)
+        run += time.perf_counter() - start
+        extra = max(extra, rss() - before)
+        merged.unpatch_model(torch.device("cpu"))
+    return load, run, extra
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden-size", type=int, default=1024)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--ratios", type=int, default=10)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--cache", type=float, default=4.0, help="GB of evaluated layer cache.")
+    bench_args = parser.parse_args()
+
+    p1 = make_patcher(bench_args.hidden_size, bench_args.depth, 0)
+    p2 = make_patcher(bench_args.hidden_size, bench_args.depth, 1)
+    x = torch.randn(1, 256, bench_args.hidden_size, dtype=torch.bfloat16)
+    ratios = [i / max(1, bench_args.ratios - 1) for i in range(bench_args.ratios)]
+    model_mb = sum(p.nbytes for p in p1.model.parameters()) / (1024 * 1024)
+    print("model {:.0f} MB, {} ratios, {} steps per merge".format(model_mb, len(ratios), bench_args.steps))  # noqa: T201
+
+    block_ratios = {"{}.".format(i): 0.5 for i in range(bench_args.depth)}
+    sweeps = {
+        "ModelMergeBlocks": [lambda r=r: ModelMergeBlocks().merge(p1, p2, **dict(block_ratios, **{"0.": r}))[0] for r in ratios],
+        "ModelMergeSimple": [lambda r=r: ModelMergeSimple().merge(p1, p2, r)[0] for r in ratios],
+    }
+    print("{:>18} {:>6} {:>10} {:>10} {:>12}".format("sweep", "mode", "load s", "steps s", "extra RAM MB"))  # noqa: T201
+    for name, merges in sweeps.items():
+        for mode in ["load", "lazy"]:
+            comfy.lazy_merge.CACHE = comfy.lazy_merge.EvaluatedLayerCache(int(bench_args.cache * 1024 ** 3)) if mode == "lazy" else None
+            load, run, extra = sweep(merges, x, bench_args.steps)
+            print("{:>18} {:>6} {:>10.3f} {:>10.3f} {:>12.1f}".format(name, mode, load, run, extra / (1024 * 1024)))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
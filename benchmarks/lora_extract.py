@@ -0,0 +1,73 @@
+"""
+CPU benchmark of the lora extraction of LoraSave on synthetic weight diffs (a low rank fine tune plus noise) with the
+shapes of the Linear layers of a transformer block stack: the full svd of every layer one after the other as before,
+the randomized svd and the randomized svd with several workers. Reports the time and the mean relative
+reconstruction error of each.
+
+    python -m benchmarks.lora_extract --hidden-size 1536 --blocks 4 --rank 32 --workers 4
+"""
+import argparse
+import time
+
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.model_patcher
+from comfy_extras import nodes_lora_extract
+
+
+class Block(torch.nn.Module):
+    def __init__(self, hidden_size):
+        super().__init__()
+        self.qkv = torch.nn.Linear(hidden_size, hidden_size * 3, bias=False)
+        self.proj = torch.nn.Linear(hidden_size, hidden_size, bias=False)
+        self.mlp_in = torch.nn.Linear(hidden_size, hidden_size * 4, bias=False)
+        self.mlp_out = torch.nn.Linear(hidden_size * 4, hidden_size, bias=False)
+
+
+class Model(torch.nn.Module):
+    def __init__(self, hidden_size, blocks, true_rank):
+        super().__init__()
+        self.diffusion_model = torch.nn.ModuleList([Block(hidden_size) for _ in range(blocks)])
+        torch.manual_seed(0)
+        with torch.no_grad():
+            for p in self.parameters():
+                out_dim, in_dim = p.shape
+                p.copy_(torch.randn(out_dim, true_rank) @ torch.randn(true_rank, in_dim) / true_rank + torch.randn(out_dim, in_dim) * 0.02)
+
+
+def run(patcher, bench_args, svd_method, workers):
+    errors = {}
+    start = time.perf_counter()
+    nodes_lora_extract.calc_lora_model(patcher, bench_args.rank, "diffusion_model.", "diffusion_model.", {}, nodes_lora_extract.LORAType.STANDARD,
+                                       svd_method=svd_method, workers=workers, errors=errors)
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(errors.values()) / len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden-size", type=int, default=1536)
+    parser.add_argument("--blocks", type=int, default=4)
+    parser.add_argument("--rank", type=int, default=32)
+    parser.add_argument("--true-rank", type=int, default=16, help="Rank of the synthetic fine tune.")
+    parser.add_argument("--workers", type=int, default=4)
+    bench_args = parser.parse_args()
+
+    model = Model(bench_args.hidden_size, bench_args.blocks, bench_args.true_rank)
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    layers = sum(1 for _ in model.parameters())
+    print("{} layers, {:.0f} MB of weight diffs, rank {}".format(layers, sum(p.nbytes for p in model.parameters()) / (1024 * 1024), bench_args.rank))  # noqa: T201
+
+    baseline = None
+    for name, svd_method, workers in [("full, serial", "full", 1), ("randomized, serial", "randomized", 1), ("randomized, {} workers".format(bench_args.workers), "randomized", bench_args.workers)]:
+        elapsed, error = run(patcher, bench_args, svd_method, workers)
+        if baseline is None:
+            baseline = elapsed
+        print("{:>24}: {:7.2f}s ({:5.1f}x)  mean relative error {:.4f}".format(name, elapsed, baseline / elapsed, error))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
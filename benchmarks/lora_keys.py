@@ -0,0 +1,66 @@
+"""
+CPU microbenchmark of applying a LoRA to a large model: the lora key map of a Flux sized model (built on the meta
+device, no weights) is computed with comfy.lora.model_lora_keys_unet and a kohya format LoRA with a LoRA on every
+linear layer is loaded with comfy.lora.load_lora, as comfy.sd.load_lora_for_models does, the first time and then
+repeatedly.
+
+    python -m benchmarks.lora_keys --repeat 10 --rank 16
+"""
+import argparse
+import time
+
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.lora
+import comfy.supported_models
+
+FLUX = {"image_model": "flux", "in_channels": 16, "patch_size": 2, "out_channels": 16, "vec_in_dim": 768, "context_in_dim": 4096,
+        "hidden_size": 3072, "mlp_ratio": 4.0, "num_heads": 24, "depth": 19, "depth_single_blocks": 38, "axes_dim": [16, 56, 56],
+        "theta": 10000, "qkv_bias": True, "guidance_embed": True}
+
+
+def make_lora(model, rank):
+    sd = model.state_dict()
+    lora = {}
+    for k in sd:
+        if k.startswith("diffusion_model.") and k.endswith(".weight") and sd[k].ndim == 2:
+            name = "lora_unet_{}".format(k[len("diffusion_model."):-len(".weight")].replace(".", "_"))
+            lora["{}.lora_up.weight".format(name)] = torch.zeros(sd[k].shape[0], rank)
+            lora["{}.lora_down.weight".format(name)] = torch.zeros(rank, sd[k].shape[1])
+            lora["{}.alpha".format(name)] = torch.tensor(float(rank))
+    return lora
+
+
+def apply(model, lora):
+    start = time.perf_counter()
+    key_map = comfy.lora.model_lora_keys_unet(model, {})
+    keys = time.perf_counter() - start
+    patches = comfy.lora.load_lora(lora, key_map)
+    return keys, time.perf_counter() - start - keys, len(key_map), len(patches)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--rank", type=int, default=16)
+    bench_args = parser.parse_args()
+
+    model = comfy.supported_models.Flux(FLUX).get_model({}, device=torch.device("meta"))
+    lora = make_lora(model, bench_args.rank)
+    keys, load, key_map_size, patches = apply(model, lora)
+    print("Flux key map: {} keys, LoRA: {} tensors, {} patches".format(key_map_size, len(lora), patches))  # noqa: T201
+    print("{:>10} {:>12} {:>12}".format("", "key map ms", "load_lora ms"))  # noqa: T201
+    print("{:>10} {:>12.2f} {:>12.2f}".format("first", keys * 1000, load * 1000))  # noqa: T201
+    keys = load = 0.0
+    for _ in range(bench_args.repeat):
+        k, t, _, _ = apply(model, lora)
+        keys += k
+        load += t
+    print("{:>10} {:>12.2f} {:>12.2f}".format("repeated", keys * 1000 / bench_args.repeat, load * 1000 / bench_args.repeat))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+CPU benchmark of applying stacks of 1 to 10 LoRAs to a weight with comfy.lora.calculate_weight, one matmul per LoRA
+as before against the stacked LoRAs applied with a single matmul. Reports the time per weight and the largest
+difference between the two results.
+
+    python -m benchmarks.lora_stack --size 3072 --rank 32 --max-loras 10 --repeat 3
+"""
+import argparse
+import time
+
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.lora
+from comfy.weight_adapter import LoRAAdapter
+
+
+def one_by_one(patches, weight, key):
+    for p in patches:
+        weight = comfy.lora.calculate_weight([p], weight, key)
+    return weight
+
+
+def timed(f, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=3072)
+    parser.add_argument("--rank", type=int, default=32)
+    parser.add_argument("--max-loras", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dtype", choices=["float32", "bfloat16"], default="float32", help="dtype of the weight and the lora factors.")
+    a = parser.parse_args()
+    dtype = getattr(torch, a.dtype)
+
+    torch.manual_seed(0)
+    weight = torch.randn(a.size, a.size, dtype=dtype)
+    loras = [LoRAAdapter(set(), (torch.randn(a.size, a.rank, dtype=dtype) * 0.01, torch.randn(a.rank, a.size, dtype=dtype) * 0.01, float(a.rank), None, None, None))
+             for _ in range(a.max_loras)]
+
+    print("{}x{} {} weight, rank {} loras".format(a.size, a.size, a.dtype, a.rank))  # noqa: T201
+    print("{:>6} {:>12} {:>12} {:>8} {:>10}".format("loras", "per lora", "stacked", "speedup", "max diff"))  # noqa: T201
+    for n in range(1, a.max_loras + 1):
+        patches = [(1.0 / n, lora, 1.0, None, None) for lora in loras[:n]]
+        t_old, old = timed(lambda: one_by_one(patches, weight.clone(), "w"), a.repeat)
+        t_new, new = timed(lambda: comfy.lora.calculate_weight(patches, weight.clone(), "w"), a.repeat)
+        diff = (old.float() - new.float()).abs().max().item()
+        print("{:>6} {:>10.1f}ms {:>10.1f}ms {:>7.2f}x {:>10.2e}".format(n, t_old * 1000, t_new * 1000, t_old / t_new, diff))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
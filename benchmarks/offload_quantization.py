@@ -0,0 +1,76 @@
+"""
+CPU benchmark of --offload-quantize: a randomly initialized Flux style model is loaded fully offloaded (lowvram) with
+full precision, int8 and fp8 copies of the offloaded weights. Reports the size of the weights copied per pass, the step time
+and the drift of the output relative to full precision.
+
+    python -m benchmarks.offload_quantization --hidden-size 768 --depth 4 --steps 5
+"""
+import argparse
+import time
+
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.model_patcher
+import comfy.offload_quantization
+import comfy.ops
+from comfy.ldm.flux.model import Flux
+
+
+def make_model(hidden_size, depth, dtype):
+    torch.manual_seed(0)
+    model = Flux(in_channels=16, out_channels=16, vec_in_dim=768, context_in_dim=1024, hidden_size=hidden_size, mlp_ratio=4.0, num_heads=hidden_size // 64,
+                 depth=depth, depth_single_blocks=depth * 2, axes_dim=[16, 24, 24], theta=10000, patch_size=2, qkv_bias=True, guidance_embed=False,
+                 dtype=dtype, operations=comfy.ops.manual_cast)
+    for p in model.parameters():
+        torch.nn.init.normal_(p, std=0.02)
+    return model
+
+
+def run(layout, bench_args, inputs):
+    comfy.offload_quantization.LAYOUT = layout
+    model = make_model(bench_args.hidden_size, bench_args.depth, torch.bfloat16)
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    patcher.patch_model(torch.device("cpu"), lowvram_model_memory=1)
+    weight_bytes = 0 # copied to the compute device per pass
+    for m in model.modules():
+        for name, p in m.named_parameters(recurse=False):
+            q = comfy.offload_quantization.quantized_weight(m) if name == "weight" else None
+            weight_bytes += p.nbytes if q is None else q._qdata.nbytes + q._layout_params["scale"].nbytes
+    with torch.inference_mode():
+        out = model(*inputs[:2], context=inputs[2], y=inputs[3]).float()
+        start = time.perf_counter()
+        for _ in range(bench_args.steps):
+            model(*inputs[:2], context=inputs[2], y=inputs[3])
+        step = (time.perf_counter() - start) / bench_args.steps
+    patcher.unpatch_model(torch.device("cpu"))
+    return weight_bytes, step, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden-size", type=int, default=768)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--resolution", type=int, default=512, help="Image size in pixels (latent / 8).")
+    bench_args = parser.parse_args()
+
+    torch.manual_seed(1)
+    size = bench_args.resolution // 8
+    inputs = (torch.randn(1, 16, size, size, dtype=torch.bfloat16), torch.tensor([0.5]),
+              torch.randn(1, 77, 1024, dtype=torch.bfloat16), torch.randn(1, 768, dtype=torch.bfloat16))
+
+    print("{:>6} {:>12} {:>10} {:>12}".format("layout", "copied MB", "step s", "rel. drift"))  # noqa: T201
+    reference = None
+    for layout in [None, "int8", "fp8"]:
+        weight_bytes, step, out = run(layout, bench_args, inputs)
+        if reference is None:
+            reference = out
+        drift = ((out - reference).norm() / reference.norm()).item()
+        print("{:>6} {:>12.1f} {:>10.3f} {:>12.5f}".format(layout or "full", weight_bytes / (1024 * 1024), step, drift))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+CPU benchmark of ModelPatcher.clone in clone heavy workflows: a model with LoRAs on all its weights and a few attention
+patches goes through a chain of nodes that each clone the patcher and add to it (a LoRA on a part of the layers, a
+model sampling object patch or an attention patch), the way stacks of Lora/ModelSampling*/attention nodes do.
+
+The chain is run with the clones sharing the patch lists and the model_options values with their parent and with the
+copies clone used to make (every patch list sliced, model_options deep copied), which are done on top of the new clone.
+
+    python -m benchmarks.patcher_clone --layers 1000 --loras 4 --nodes 32
+"""
+import argparse
+import copy
+import time
+
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.model_patcher
+
+
+class CopyingModelPatcher(comfy.model_patcher.ModelPatcher):
+    def clone(self):
+        n = super().clone()
+        n.patches = {k: v[:] for k, v in self.patches.items()}
+        n.model_options = copy.deepcopy(self.model_options)
+        n.hook_patches = comfy.model_patcher.create_hook_patches_clone(self.hook_patches)
+        return n
+
+
+class AttentionPatch:
+    def __init__(self, size):
+        self.embeds = torch.zeros(size)
+
+    def __call__(self, q, k, v, extra_options):
+        return q, k, v
+
+
+def chain(patcher_class, layers, loras, nodes):
+    model = torch.nn.ModuleList([torch.nn.Linear(64, 64, device="meta") for _ in range(layers)])
+    m = patcher_class(model, torch.device("cpu"), torch.device("cpu"), size=1)
+    keys = list(model.state_dict())
+    for _ in range(loras):
+        m.add_patches({k: torch.zeros(1) for k in keys}, 1.0)
+    m.set_model_attn2_patch(AttentionPatch(1024 * 1024))
+
+    clone_time = 0.0
+    start = time.perf_counter()
+    for i in range(nodes):
+        clone_start = time.perf_counter()
+        m = m.clone()
+        clone_time += time.perf_counter() - clone_start
+        if i % 3 == 0:
+            m.add_patches({k: torch.zeros(1) for k in keys[:len(keys) // 4]}, 0.5)
+        elif i % 3 == 1:
+            m.add_object_patch("model_sampling", object())
+        else:
+            m.set_model_attn1_patch(AttentionPatch(256 * 1024))
+    return clone_time, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--layers", type=int, default=1000)
+    parser.add_argument("--loras", type=int, default=4, help="LoRAs applied to all the weights before the chain.")
+    parser.add_argument("--nodes", type=int, default=32, help="Nodes in the chain, every one clones the patcher.")
+    bench_args = parser.parse_args()
+
+    print("{} weights with {} patches each, {} nodes".format(bench_args.layers * 2, bench_args.loras, bench_args.nodes))  # noqa: T201
+    print("{:>8} {:>12} {:>12}".format("clone", "clone ms", "chain ms"))  # noqa: T201
+    for name, patcher_class in [("copying", CopyingModelPatcher), ("sharing", comfy.model_patcher.ModelPatcher)]:
+        clone_time, total = chain(patcher_class, bench_args.layers, bench_args.loras, bench_args.nodes)
+        print("{:>8} {:>12.2f} {:>12.1f}".format(name, clone_time * 1000 / bench_args.nodes, total * 1000))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
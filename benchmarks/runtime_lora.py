@@ -0,0 +1,96 @@
+"""
+CPU benchmark of --runtime-lora: a randomly initialized transformer style model is loaded with one LoRA set after
+the other (every set has a LoRA on every Linear), the way switching LoRAs between prompts does, with the LoRAs merged
+into the weights as before and applied at runtime. Reports the time to switch to the next set and the time of a step.
+
+    python -m benchmarks.runtime_lora --hidden-size 1024 --depth 8 --rank 32 --sets 4 --steps 4
+"""
+import argparse
+import time
+
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.model_patcher
+import comfy.ops
+import comfy.runtime_lora
+from comfy.weight_adapter import LoRAAdapter
+
+
+class Model(torch.nn.Module):
+    def __init__(self, hidden_size, depth):
+        super().__init__()
+        ops = comfy.ops.manual_cast
+        self.diffusion_model = torch.nn.ModuleList([torch.nn.Sequential(ops.Linear(hidden_size, hidden_size * 4, dtype=torch.bfloat16),
+                                                                        torch.nn.GELU(),
+                                                                        ops.Linear(hidden_size * 4, hidden_size, dtype=torch.bfloat16)) for _ in range(depth)])
+        for m in self.modules():
+            if hasattr(m, "comfy_cast_weights"):
+                m.weight_function = []
+                m.bias_function = []
+
+    def forward(self, x):
+        for block in self.diffusion_model:
+            x = x + block(x)
+        return x
+
+
+def lora_set(patcher, rank, seed):
+    torch.manual_seed(seed)
+    out = patcher.clone()
+    patches = {}
+    for key, weight in patcher.model.state_dict().items():
+        if key.endswith(".weight"):
+            up = torch.randn(weight.shape[0], rank, dtype=torch.bfloat16) * 0.01
+            down = torch.randn(rank, weight.shape[1], dtype=torch.bfloat16) * 0.01
+            patches[key] = LoRAAdapter(set(), (up, down, float(rank), None, None, None))
+    out.add_patches(patches, 1.0)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden-size", type=int, default=1024)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--rank", type=int, default=32)
+    parser.add_argument("--sets", type=int, default=4, help="LoRA sets to switch between.")
+    parser.add_argument("--steps", type=int, default=4)
+    bench_args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = Model(bench_args.hidden_size, bench_args.depth)
+    for p in model.parameters():
+        torch.nn.init.normal_(p, std=0.02)
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    sets = [lora_set(patcher, bench_args.rank, i) for i in range(bench_args.sets)]
+    x = torch.randn(1, 256, bench_args.hidden_size, dtype=torch.bfloat16)
+    model_mb = sum(p.nbytes for p in model.parameters()) / (1024 * 1024)
+    print("model {:.0f} MB, {} LoRA sets of rank {}, {} steps per set".format(model_mb, len(sets), bench_args.rank, bench_args.steps))  # noqa: T201
+
+    print("{:>8} {:>10} {:>10} {:>10}".format("mode", "switch s", "step s", "rel diff"))  # noqa: T201
+    outputs = {}
+    for mode in ["merged", "runtime"]:
+        comfy.runtime_lora.ENABLED = mode == "runtime"
+        switch = step = 0.0
+        outputs[mode] = []
+        for i, lora in enumerate(sets + sets[:1]): # the first set is loaded again at the end
+            start = time.perf_counter()
+            lora.partially_load(torch.device("cpu"), 1e32)
+            if i > 0:
+                switch += time.perf_counter() - start
+            start = time.perf_counter()
+            with torch.inference_mode():
+                for _ in range(bench_args.steps):
+                    out = lora.model(x)
+            step += time.perf_counter() - start
+            outputs[mode].append(out.float())
+            lora.detach(unpatch_all=False)
+        sets[0].unpatch_model(torch.device("cpu"))
+        diff = max(((a - b).abs().max() / b.abs().max()).item() for a, b in zip(outputs[mode], outputs["merged"]))
+        print("{:>8} {:>10.3f} {:>10.3f} {:>10.2e}".format(mode, switch / len(sets), step / (bench_args.steps * (len(sets) + 1)), diff))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+CPU microbenchmark of SDTokenizer.tokenize_with_weights on generated prompts: the uncached path against the memoised
+one (cold and warm word caches) and tokenize_with_weights_batch.
+
+    python -m benchmarks.tokenizer --prompts 10000
+"""
+import argparse
+import random
+import time
+
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+from comfy.sd1_clip import SDTokenizer, parse_prompt_weights
+
+SUBJECTS = ["a cat", "a dog", "an old man", "a castle", "a red fox", "a robot", "a portrait of a woman", "a landscape", "a spaceship", "a dragon"]
+STYLES = ["masterpiece", "best quality", "highly detailed", "oil painting", "photorealistic", "8k", "cinematic lighting", "watercolor", "anime style", "sharp focus"]
+PLACES = ["in the snow", "on a beach", "in a forest", "at night", "in the city", "under the sea", "on mars", "in a library"]
+
+
+def make_prompts(count, seed=0):
+    rng = random.Random(seed)
+    prompts = []
+    for _ in range(count):
+        parts = ["{} {}".format(rng.choice(SUBJECTS), rng.choice(PLACES))]
+        for style in rng.sample(STYLES, rng.randint(1, 6)):
+            if rng.random() < 0.3:
+                style = "({}:{:.1f})".format(style, rng.uniform(0.5, 1.5))
+            parts.append(style)
+        if rng.random() < 0.2:
+            parts.append("seed {}".format(rng.randint(0, 100000))) # some never seen words
+        prompts.append(", ".join(parts))
+    return prompts
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=int, default=10000)
+    bench_args = parser.parse_args()
+
+    prompts = make_prompts(bench_args.prompts)
+    tokenizer = SDTokenizer()
+
+    def run_each():
+        for p in prompts:
+            tokenizer.tokenize_with_weights(p)
+
+    tokenizer.memoize = False
+    uncached = timed(run_each)
+
+    tokenizer.memoize = True
+    parse_prompt_weights.cache_clear()
+    tokenizer.word_cache.clear()
+    cold = timed(run_each)
+    warm = timed(run_each)
+
+    parse_prompt_weights.cache_clear()
+    tokenizer.word_cache.clear()
+    batch_cold = timed(lambda: tokenizer.tokenize_with_weights_batch(prompts))
+    batch_warm = timed(lambda: tokenizer.tokenize_with_weights_batch(prompts))
+
+    print("{} prompts, {} cached words, torch {}".format(len(prompts), len(tokenizer.word_cache), torch.__version__))  # noqa: T201
+    print("{:>14} {:>10} {:>12} {:>8}".format("mode", "total s", "prompts/s", "speedup"))  # noqa: T201
+    for name, t in [("uncached", uncached), ("memoised cold", cold), ("memoised warm", warm), ("batch cold", batch_cold), ("batch warm", batch_warm)]:
+        print("{:>14} {:>10.3f} {:>12.0f} {:>7.2f}x".format(name, t, len(prompts) / t, uncached / t))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
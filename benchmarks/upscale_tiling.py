@@ -0,0 +1,63 @@
+"""
+CPU benchmark of ImageUpscaleWithModel tiling: the old fixed 512 tile against the tile size and tiles per batch
+picked by comfy.upscale_tiling from the measured memory model, for a few spandrel architectures (random weights).
+
+    python -m benchmarks.upscale_tiling --sizes 1024 2048 4096 --memory 4
+"""
+import argparse
+import time
+
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+from spandrel import ModelLoader
+from spandrel.architectures.Compact.__arch.SRVGG import SRVGGNetCompact
+from spandrel.architectures.ESRGAN.__arch.RRDB import RRDBNet
+from spandrel.architectures.SPAN.__arch.span import SPAN
+from spandrel.architectures.SwinIR.__arch.SwinIR import SwinIR
+
+import comfy.upscale_tiling
+import comfy.utils
+
+ARCHITECTURES = {
+    "compact": lambda: SRVGGNetCompact(num_feat=64, num_conv=16, upscale=4),
+    "esrgan_lite": lambda: RRDBNet(num_filters=32, num_blocks=6, scale=4),
+    "span": lambda: SPAN(num_in_ch=3, num_out_ch=3, feature_channels=48, upscale=4),
+    "swinir_light": lambda: SwinIR(upscale=2, img_size=64, window_size=8, embed_dim=60, depths=[6, 6, 6, 6], num_heads=[6, 6, 6, 6], mlp_ratio=2, upsampler="pixelshuffledirect"),
+}
+
+
+def run(upscale_model, image, tile, tile_batch, overlap=32):
+    start = time.perf_counter()
+    comfy.utils.tiled_scale(image, lambda a: upscale_model(a), tile_x=tile, tile_y=tile, overlap=overlap, upscale_amount=upscale_model.scale, tile_batch=tile_batch)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arch", type=str, nargs="+", default=list(ARCHITECTURES.keys()), choices=list(ARCHITECTURES.keys()))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048, 4096], help="Square input sizes in pixels.")
+    parser.add_argument("--memory", type=float, default=4.0, help="Memory budget in GB for the tuned tiling.")
+    parser.add_argument("--tile-batch", action="store_true", help="Batch tiles like --upscale-tile-batch.")
+    bench_args = parser.parse_args()
+
+    torch.manual_seed(0)
+    print("{:>14} {:>6} {:>10} {:>10} {:>6} {:>6} {:>10} {:>8}".format("arch", "size", "bytes/px", "fixed s", "tile", "batch", "tuned s", "speedup"))  # noqa: T201
+    with torch.inference_mode():
+        for name in bench_args.arch:
+            upscale_model = ModelLoader().load_from_state_dict(ARCHITECTURES[name]().state_dict()).eval()
+            memory_model = comfy.upscale_tiling.measure(upscale_model, "cpu")
+            for size in bench_args.sizes:
+                image = torch.rand((1, 3, size, size))
+                tile, tile_batch = comfy.upscale_tiling.plan_tiles(memory_model, size, size, bench_args.memory * 1024 ** 3, max_tile=comfy.upscale_tiling.MAX_TILE)
+                if not bench_args.tile_batch:
+                    tile_batch = 1
+                fixed = run(upscale_model, image, 512, 1)
+                tuned = run(upscale_model, image, tile, tile_batch)
+                print("{:>14} {:>6} {:>10.0f} {:>10.2f} {:>6} {:>6} {:>10.2f} {:>7.2f}x".format(name, size, memory_model.per_pixel, fixed, tile, tile_batch, tuned, fixed / tuned))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Post-training quantization of checkpoints to the mixed precision format loaded by MixedPrecisionOps (see QUANTIZATION.md).
+
+The Linear layers of the diffusion model are calibrated by sampling a few steps with forward hooks on them. The hooks
+record the absolute maximum of the input of every layer, used for its input_scale, and the relative error that fp8
+quantization of the weight and of the input causes on each output channel. The layers with an error below a threshold
+are stored as float8_e4m3fn with a weight_scale and an input_scale, the other weights are kept as they are and the
+quantized layers are listed in the _quantization_metadata of the safetensors file.
+
+    python -m comfy.checkpoint_quantization model.safetensors model_fp8.safetensors --prompt "a photo of a cat"
+"""
+import argparse
+import json
+import logging
+
+import torch
+
+import comfy.model_management
+import comfy.ops
+import comfy.sample
+import comfy.sd
+import comfy.utils
+from comfy.quant_ops import QUANT_ALGOS
+
+FORMAT = "float8_e4m3fn"
+MIN_NUMEL = 4096 # smaller layers are not worth it
+MAX_ROWS = 1024 # rows of the input used to measure the error of a call
+MAX_ERROR = 0.1
+
+
+def fp8_scale(amax):
+    storage = QUANT_ALGOS[FORMAT]["storage_t"]
+    return (amax.to(torch.float32) / torch.finfo(storage).max).clamp(min=1e-12)
+
+
+def fake_quantize(t, scale):
+    return (t / scale).to(QUANT_ALGOS[FORMAT]["storage_t"]).to(torch.float32) * scale
+
+
+def linear_layers(diffusion_model):
+    """{name: module} of the Linear layers of the diffusion model that MixedPrecisionOps can load quantized."""
+    out = {}
+    for n, m in diffusion_model.named_modules():
+        if isinstance(m, torch.nn.Linear) and hasattr(m, "comfy_cast_weights") and m.weight.numel() >= MIN_NUMEL:
+            out[n] = m
+    return out
+
+
+class LayerStats:
+    def __init__(self):
+        self.amax = None # absolute maximum of the input
+        self.error = 0.0 # sum of the relative output errors
+        self.calls = 0
+
+    def mean_error(self):
+        if self.calls == 0:
+            return None
+        return self.error / self.calls
+
+    def input_scale(self):
+        return fp8_scale(self.amax).cpu()
+
+
+class Calibrator:
+    """Context manager recording LayerStats for the layers {name: module} while the model runs."""
+    def __init__(self, layers, stats=None):
+        self.layers = layers
+        self.stats = stats if stats is not None else {}
+        self.handles = []
+
+    def hook(self, name, module, args, output):
+        x = args[0].detach().reshape(-1, module.in_features)
+        if x.shape[0] > MAX_ROWS:
+            x = x[::x.shape[0] // MAX_ROWS][:MAX_ROWS]
+        x = x.to(torch.float32)
+        weight, bias = comfy.ops.cast_bias_weight(module, device=x.device, dtype=torch.float32, bias_dtype=torch.float32)
+        amax = x.abs().amax()
+        reference = torch.nn.functional.linear(x, weight, bias)
+        quantized = torch.nn.functional.linear(fake_quantize(x, fp8_scale(amax)), fake_quantize(weight, fp8_scale(weight.abs().amax())), bias)
+        # per output channel so that a few large channels can't hide the others
+        error = ((quantized - reference).norm(dim=0) / reference.norm(dim=0).clamp(min=1e-12)).mean().item()
+
+        s = self.stats.setdefault(name, LayerStats())
+        s.amax = amax if s.amax is None else torch.maximum(s.amax, amax)
+        if error == error: # a nan would disable the layer
+            s.error += error
+            s.calls += 1
+
+    def __enter__(self):
+        for n, m in self.layers.items():
+            self.handles.append(m.register_forward_hook(lambda m, args, output, n=n: self.hook(n, m, args, output)))
+        return self.stats
+
+    def __exit__(self, *exc):
+        for h in self.handles:
+            h.remove()
+        self.handles = []
+        return False
+
+
+def calibrate(model, positive, negative, latent_image, steps=4, cfg=1.0, sampler_name="euler", scheduler="simple", seed=0, stats=None):
+    """
+    Samples latent_image for a few steps with the conditioning and returns the {layer name: LayerStats} of the Linear
+    layers of the diffusion model. Pass the stats of a previous call to accumulate several prompts or latents.
+    """
+    latent_image = comfy.sample.fix_empty_latent_channels(model, latent_image)
+    noise = comfy.sample.prepare_noise(latent_image, seed)
+    with Calibrator(linear_layers(model.model.diffusion_model), stats) as stats:
+        comfy.sample.sample(model, noise, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, disable_pbar=True, seed=seed)
+    return stats
+
+
+def select_layers(layers, stats=None, max_error=MAX_ERROR):
+    """Names of the layers to quantize: all of them without calibration, else the ones called with an error <= max_error."""
+    if stats is None:
+        return sorted(layers)
+    out = []
+    for n in sorted(layers):
+        s = stats.get(n, None)
+        if s is not None and s.calls > 0 and s.mean_error() <= max_error:
+            out.append(n)
+    return out
+
+
+def quantize_state_dict(sd, model_config, layers, stats=None, lazy={}):
+    """
+    Replaces the weights of the diffusion model layers in the checkpoint state dict sd by their fp8 version and
+    scales, input scales are only added with calibration stats. The weights of entries of lazy (see
+    comfy.sd.lazy_patched_state_dict) are patched one at a time and their entries removed. Returns the
+    _quantization_metadata.
+    """
+    keys = model_config.process_unet_state_dict_for_saving({"{}.weight".format(n): n for n in layers})
+    config = {}
+    for k, n in keys.items():
+        if k in lazy:
+            patcher, key = lazy.pop(k)
+            sd[k] = patcher.patched_weight(key, device_to=patcher.load_device)
+        w = sd[k].to(torch.float32)
+        scale = fp8_scale(w.abs().amax())
+        prefix = k[:-len("weight")]
+        sd[k] = (w / scale).to(QUANT_ALGOS[FORMAT]["storage_t"])
+        sd["{}weight_scale".format(prefix)] = scale
+        if stats is not None:
+            sd["{}input_scale".format(prefix)] = stats[n].input_scale()
+        config[n] = {"format": FORMAT}
+    return {"format_version": "1.0", "layers": config}
+
+
+def save_quantized_checkpoint(output_path, model, clip=None, vae=None, stats=None, max_error=MAX_ERROR, metadata=None):
+    """Saves a checkpoint like comfy.sd.save_checkpoint with the selected layers of the diffusion model quantized, returns their names."""
+    model_config = model.model.model_config
+    if model_config.layer_quant_config or model_config.scaled_fp8 is not None:
+        raise ValueError("The model is already quantized.")
+
+    sd, lazy = comfy.sd.checkpoint_state_dict(model, clip=clip, vae=vae)
+    layers = select_layers(linear_layers(model.model.diffusion_model), stats, max_error)
+    quant_metadata = quantize_state_dict(sd, model_config, layers, stats, lazy=lazy)
+
+    metadata = dict(metadata) if metadata is not None else {}
+    metadata["_quantization_metadata"] = json.dumps(quant_metadata)
+    comfy.sd.save_state_dict(sd, output_path, metadata=metadata, lazy=lazy)
+    logging.info("Saved {} with {} quantized layers".format(output_path, len(layers)))
+    return layers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the Linear layers of the diffusion model of a checkpoint to {}.".format(FORMAT))
+    parser.add_argument("checkpoint")
+    parser.add_argument("output")
+    parser.add_argument("--prompt", action="append", default=[], help="Calibration prompt, can be repeated. Without one the weights are quantized without calibration (no input scales, all layers).")
+    parser.add_argument("--negative-prompt", default="")
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--steps", type=int, default=4, help="Number of sigmas sampled per prompt.")
+    parser.add_argument("--cfg", type=float, default=1.0)
+    parser.add_argument("--sampler", default="euler")
+    parser.add_argument("--scheduler", default="simple")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-error", type=float, default=MAX_ERROR, help="Layers with a larger mean relative output error during calibration are not quantized.")
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    model, clip, vae, _ = comfy.sd.load_checkpoint_guess_config(cli_args.checkpoint)
+    stats = None
+    if len(cli_args.prompt) > 0:
+        if clip is None:
+            raise RuntimeError("The checkpoint has no text encoder to calibrate with.")
+        negative = clip.encode_from_tokens_scheduled(clip.tokenize(cli_args.negative_prompt))
+        latent = torch.zeros([1, 4, cli_args.height // 8, cli_args.width // 8], device=comfy.model_management.intermediate_device())
+        stats = {}
+        for i, prompt in enumerate(cli_args.prompt):
+            positive = clip.encode_from_tokens_scheduled(clip.tokenize(prompt))
+            calibrate(model, positive, negative, latent, steps=cli_args.steps, cfg=cli_args.cfg, sampler_name=cli_args.sampler, scheduler=cli_args.scheduler, seed=cli_args.seed + i, stats=stats)
+    save_quantized_checkpoint(cli_args.output, model, clip, vae, stats=stats, max_error=cli_args.max_error)
+
+
+if __name__ == "__main__":
+    main()
@@ -100,6 +100,8 @@ class LatentPreviewMethod(enum.Enum):
 parser.add_argument("--preview-method", type=LatentPreviewMethod, default=LatentPreviewMethod.NoPreviews, help="Default preview method for sampler nodes.", action=EnumAction)
 
 parser.add_argument("--preview-size", type=int, default=512, help="Sets the maximum preview size for sampler nodes.")
+parser.add_argument("--preview-interval", type=int, default=1, metavar="STEPS", help="Only decode a sampler preview every N steps.")
+parser.add_argument("--preview-max-fps", type=float, default=0, help="Maximum number of sampler previews decoded per second, 0 for no limit.")
 
 cache_group = parser.add_mutually_exclusive_group()
 cache_group.add_argument("--cache-classic", action="store_true", help="Use the old style (aggressive) caching.")
@@ -120,6 +122,8 @@ upcast = parser.add_mutually_exclusive_group()
 upcast.add_argument("--force-upcast-attention", action="store_true", help="Force enable attention upcasting, please report if it fixes black images.")
 upcast.add_argument("--dont-upcast-attention", action="store_true", help="Disable all upcasting of attention. Should be unnecessary except for debugging.")
 
+parser.add_argument("--cpu-attention-memory", type=float, default=1.0, metavar="GB", help="Target peak working set in GB for the split and sub-quadratic attention chunking when running on the CPU. Chunk sizes are picked to stay under this instead of the free system RAM. Set to 0 to use the free system RAM like on other devices.")
+
 
 vram_group = parser.add_mutually_exclusive_group()
 vram_group.add_argument("--gpu-only", action="store_true", help="Store and run everything (text encoders/CLIP models, etc... on the GPU).")
@@ -138,6 +142,8 @@ parser.add_argument("--force-non-blocking", action="store_true", help="Force Com
 parser.add_argument("--default-hashing-function", type=str, choices=['md5', 'sha1', 'sha256', 'sha512'], default='sha256', help="Allows you to choose the hash function to use for duplicate filename / contents comparison. Default is sha256.")
 
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
+parser.add_argument("--model-eviction-policy", type=str, choices=["default", "cost"], default="default", help="How to pick the models to offload when vram is needed. default: prefer models that are already partially offloaded, then the smallest ones. cost: prefer the models that are cheapest to load back (size, pinned memory, number of patches) and that the running prompt or the queue won't need soon.")
+parser.add_argument("--model-eviction-trace", type=str, default=None, metavar="PATH", help="Append every model load request to this jsonl file so eviction policies can be compared offline.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
 
 class PerformanceFeature(enum.Enum):
@@ -150,6 +156,36 @@ parser.add_argument("--fast", nargs="*", type=PerformanceFeature, help="Enable s
 
 parser.add_argument("--disable-pinned-memory", action="store_true", help="Disable pinned memory use.")
 
+parser.add_argument("--shared-weight-pool", nargs='?', const=32.0, type=float, default=0, metavar="GB", help="Share the weights of safetensors models between ComfyUI processes running on the same machine through a shared memory pool of this size: each base model is held in RAM once and every process only keeps its own patched weights. Default 32GB")
+parser.add_argument("--shared-weight-pool-dir", type=str, default="/dev/shm/comfyui_weight_pool", help="Directory used for the shared weight pool, it should be on a RAM backed filesystem.")
+
+parser.add_argument("--patched-weight-cache", nargs='?', const=4.0, type=float, default=0, metavar="GB", help="Keep the merged weights of LoRA (and other weight patch) stacks in a RAM cache of this size so loading the same model with the same patches again copies them instead of recomputing them. Default 4GB")
+parser.add_argument("--patched-weight-cache-dir", type=str, default=None, help="Spill merged weights that don't fit in the patched weight cache RAM budget to this directory.")
+parser.add_argument("--patched-weight-cache-disk", type=float, default=16.0, metavar="GB", help="Maximum size of the merged weights spilled to --patched-weight-cache-dir.")
+
+parser.add_argument("--lazy-merge", nargs='?', const=4.0, type=float, default=None, metavar="GB", help="Don't compute model merges (ModelMergeSimple, ModelMergeBlocks...) when the merged model is loaded: evaluate the merged weight of each layer when it runs and keep up to this much of the evaluated layers in a cache on the compute device, so changing the ratios of a merge only recomputes the layers whose ratios changed. Default 4GB")
+parser.add_argument("--runtime-lora", action="store_true", help="Don't merge LoRAs into the weights of the model: apply them when the layers run, so switching LoRAs or their strength doesn't patch the weights again, at the cost of some extra compute every step.")
+parser.add_argument("--hook-keyframe-cache", nargs='?', const=4.0, type=float, default=0, metavar="GB", help="Keep the weights patched by scheduled hooks (LoRA hooks with keyframes) for every keyframe strength they were used with, and the weight deltas of LoRA hooks, in a RAM cache of this size so keyframe changes during sampling swap or scale cached weights instead of merging the hooks again. Default 4GB")
+parser.add_argument("--hook-keyframe-cache-vram", type=float, default=0, metavar="GB", help="Keep up to this much of the hook keyframe cache on the device of the weights instead of in RAM.")
+
+parser.add_argument("--text-encoder-cache", nargs='?', const=1.0, type=float, default=0, metavar="GB", help="Keep text encoder outputs in a RAM cache of this size, reused whenever the same text encoder, LoRAs and tokens are encoded again. Default 1GB")
+parser.add_argument("--text-encoder-cache-dir", type=str, default=None, help="Also persist the text encoder outputs of models loaded from files to this directory so they are reused after a restart.")
+parser.add_argument("--text-encoder-cache-disk", type=float, default=8.0, metavar="GB", help="Maximum size of --text-encoder-cache-dir.")
+
+parser.add_argument("--pinned-staging-pool", nargs='?', const=8.0, type=float, default=0, metavar="GB", help="When a model only partially fits in VRAM, pack its offloaded weights into pinned RAM slabs of up to this total size in execution order and copy the weights of the next layers to the GPU while the current one runs. Default 8GB")
+
+parser.add_argument("--prefetch-weights", nargs='?', const=2, type=int, default=0, metavar="LAYERS", help="When a model only partially fits in VRAM, record the order its layers run in and copy the offloaded weights of this many layers ahead to the GPU while the current one runs. Defaults to 2 when --pinned-staging-pool is used.")
+parser.add_argument("--execution-order-trace-dir", type=str, default=None, help="Write the recorded layer execution order of the models as chrome://tracing json files to this directory.")
+
+parser.add_argument("--training-cache-size", type=float, default=8.0, metavar="GB", help="Maximum size of the encoded images and captions of training datasets kept in the user directory (user/training_cache), the least recently used datasets are removed first.")
+parser.add_argument("--upscale-tile-batch", action="store_true", help="Let Upscale Image (using Model) run several tiles per model call when they fit in memory. Faster on some models but the output then depends slightly on how the tiles were batched.")
+
+parser.add_argument("--offload-quantize", type=str, default=None, choices=["int8", "fp8"], help="Copy the weights of the layers offloaded when a model only partially fits in VRAM to the GPU as int8 or fp8 with per channel scales, about halving the data copied for each use at the cost of an int8/fp8 copy of them in RAM. The weights of the model are not changed.")
+
+parser.add_argument("--prefetch-models", nargs='?', const=8.0, type=float, default=0, metavar="GB", help="Read the checkpoints, diffusion models, LoRAs and VAEs needed by queued prompts into RAM in the background while the current prompt runs. The value is the maximum amount of RAM used for staged files. Default 8GB")
+
+parser.add_argument("--save-fsync", nargs='?', const=256, type=int, default=0, metavar="MB", help="Flush the checkpoints written by the save nodes to disk in a background thread every this many MB, so that large saves don't fill the page cache with dirty pages. Default 256MB")
+
 parser.add_argument("--mmap-torch-files", action="store_true", help="Use mmap when loading ckpt/pt files.")
 parser.add_argument("--disable-mmap", action="store_true", help="Don't use mmap when loading safetensors.")
 
@@ -0,0 +1,166 @@
+"""
+Bounded cache of the weights of scheduled weight hooks (comfy.hooks.WeightHook with keyframes).
+
+ModelPatcher.patch_hooks merges the patches of the weight hooks of a hook group into the weights, and they were merged
+again every time the keyframe of one of the hooks changed during sampling. With the cache:
+
+- the patched weights are kept per keyframe state, the hook group and the current strength of each of its weight
+  hooks, so going back to a state (the uncond and cond hook groups taking turns, keyframes that return to a strength)
+  is a swap: the cached weights are copied into the model.
+- for hooks whose patches on a weight are all plain LoRAs the weight delta of the hook is kept too. The patched weight
+  at any strength is the original weight plus the deltas of the hooks scaled by their current strengths, so a
+  transition to a new keyframe is an add instead of a LoRA merge.
+
+Only hook groups with a scheduled hook are cached, the weights of the others never change during sampling and are
+kept by the MaxSpeed hook mode of the ModelPatcher (cached_hook_patches), like the states that don't fit in the cache.
+Entries belong to the weights of one ModelPatcher (ModelPatcher.hook_cache_owner), are kept in host RAM unless the
+device budget lets them stay on the device of the weight and the least recently used ones are evicted when the cache
+is over budget, patched weights before deltas. The counts of swapped, scaled and recomputed (merged) weights are in HookKeyframeCache.counts.
+"""
+import collections
+import logging
+import threading
+
+
+class CachedTensors:
+    def __init__(self, tensors, size, device_size):
+        self.tensors = tensors
+        self.size = size
+        self.device_size = device_size
+
+
+class KeyframeWeights(dict):
+    """
+    The patched weights of a keyframe state ({key: (weight, device)}) collected for HookKeyframeCache.put_weights, kept
+    on the device of the weight while the device budget of the cache allows it. Collection stops (full) at the first
+    weight that doesn't fit in the cache.
+    """
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+        self.size = 0
+        self.device_size = 0
+        self.full = False
+
+    def add(self, key, weight, device):
+        """Returns False if weight wasn't kept because the state doesn't fit in the cache."""
+        if self.full or self.size + weight.nbytes > self.cache.max_bytes:
+            self.full = True
+            return False
+        if device.type != "cpu" and self.cache.used_device_bytes + self.device_size + weight.nbytes <= self.cache.device_bytes:
+            self.device_size += weight.nbytes
+            weight = weight.to(device=device)
+        else:
+            weight = weight.to(device="cpu")
+        self.size += weight.nbytes
+        self[key] = (weight, device)
+        return True
+
+
+class HookKeyframeCache:
+    def __init__(self, max_bytes, device_bytes=0):
+        self.max_bytes = max_bytes
+        self.device_bytes = device_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.used_bytes = 0
+        self.used_device_bytes = 0
+        self.counts = collections.Counter() # swaps, scaled, recomputes and evictions
+
+    def store(self, tensor, device):
+        """Where a tensor of a new entry is kept: moved to device while the device budget allows it, in host RAM otherwise."""
+        if device is not None and device.type != "cpu" and self.used_device_bytes + tensor.nbytes <= self.device_bytes:
+            self.used_device_bytes += tensor.nbytes
+            return tensor.to(device=device), tensor.nbytes
+        return tensor.to(device="cpu"), 0
+
+    def get_weights(self, owner, state):
+        """The patched weights ({key: (weight, device)}) of a keyframe state, None if they aren't cached."""
+        with self.lock:
+            entry = self.entries.get((owner, "weights", state), None)
+            if entry is None:
+                return None
+            self.entries.move_to_end((owner, "weights", state))
+            self.counts["swaps"] += len(entry.tensors)
+            return entry.tensors
+
+    def put_weights(self, owner, state, weights):
+        """Stores the KeyframeWeights of a keyframe state."""
+        if weights.full:
+            return
+        with self.lock:
+            tensors = dict(weights)
+            device_size = weights.device_size
+            if self.used_device_bytes + device_size > self.device_bytes: # the device budget was taken since they were collected
+                tensors = {key: (weight.to(device="cpu"), device) for key, (weight, device) in tensors.items()}
+                device_size = 0
+            self.used_device_bytes += device_size
+            self.add((owner, "weights", state), CachedTensors(tensors, weights.size, device_size))
+
+    def get_delta(self, owner, hook_ref, key):
+        with self.lock:
+            entry = self.entries.get((owner, "delta", hook_ref, key), None)
+            if entry is None:
+                return None
+            self.entries.move_to_end((owner, "delta", hook_ref, key))
+            return entry.tensors
+
+    def put_delta(self, owner, hook_ref, key, delta, device=None):
+        if delta.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            delta, device_size = self.store(delta, device)
+            self.add((owner, "delta", hook_ref, key), CachedTensors(delta, delta.nbytes, device_size))
+
+    def add(self, cache_key, entry):
+        old = self.entries.pop(cache_key, None)
+        if old is not None:
+            self.remove_entry(old)
+        self.entries[cache_key] = entry
+        self.used_bytes += entry.size
+        # the patched weights of keyframe states are evicted before the deltas, which serve every keyframe of a hook
+        for kind in ("weights", "delta"):
+            for k in [k for k in self.entries if k[1] == kind]:
+                if self.used_bytes <= self.max_bytes:
+                    return
+                self.remove_entry(self.entries.pop(k))
+                self.counts["evictions"] += 1
+
+    def remove_entry(self, entry):
+        self.used_bytes -= entry.size
+        self.used_device_bytes -= entry.device_size
+
+    def discard(self, owner):
+        """Drops the entries of owner, the weights of the patcher they were computed for are gone."""
+        with self.lock:
+            for cache_key in [k for k in self.entries if k[0] == owner]:
+                self.remove_entry(self.entries.pop(cache_key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used_bytes = 0
+            self.used_device_bytes = 0
+
+
+CACHE = None
+
+
+def enable_cache(max_bytes, device_bytes=0):
+    global CACHE
+    CACHE = HookKeyframeCache(max_bytes, device_bytes=device_bytes)
+    logging.info("Using hook keyframe cache ({:.0f} MB RAM, {:.0f} MB VRAM)".format(max_bytes / (1024 * 1024), device_bytes / (1024 * 1024)))
+    return CACHE
+
+
+def log_counts():
+    if CACHE is not None:
+        counts = CACHE.counts
+        logging.debug("Hook keyframe cache: {} swapped, {} scaled and {} recomputed weights, {} evictions".format(counts["swaps"], counts["scaled"], counts["recomputes"], counts["evictions"]))
+
+
+def scale_deltas(weight, deltas):
+    """weight + the sum of the deltas ((strength, delta) pairs) scaled by their strength, in place."""
+    for strength, delta in deltas:
+        weight.add_(delta.to(device=weight.device), alpha=strength)
+    return weight
@@ -0,0 +1,211 @@
+"""
+Lazily evaluated model merges.
+
+ModelMergeSimple, ModelMergeBlocks, ModelAdd/Subtract and the model specific merge nodes express a merge as patches
+that reference the weights of the other model, normally computed for every weight when the merged model is loaded.
+When enabled, the patch list of a weight that is a linear combination of weights (merges of merges, diffs) is
+flattened to a MergeExpression sum(coefficient * weight) and evaluated by a LazyMergePatch weight function when
+its layer casts the weight for execution. Evaluated layers are kept in a cache on the compute device keyed by the
+source weights and the coefficients, so sampling steps and merges that only change the ratios of some blocks reuse
+the layers whose inputs are unchanged. Every cache entry keeps its source weights alive, so their storage can't be
+reused while the entry exists.
+
+The cache memory is managed by comfy.model_management: it is freed before models are unloaded when memory is needed,
+the entries of a model are dropped when it is unloaded and the cache doesn't grow into the memory inference needs.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+CACHE = None # EvaluatedLayerCache, None when lazy merging is disabled
+
+
+def linear_terms(patches):
+    """
+    (coefficient of the weight, [(coefficient, tensor, convert_func)]) computed by the patch list of a weight if it
+    is a linear combination of the weight and other tensors, else None.
+    """
+    base = 1.0
+    terms = []
+    for strength, v, strength_model, offset, function in patches:
+        if offset is not None or function is not None:
+            return None
+        if strength_model != 1.0:
+            base *= strength_model
+            terms = [(c * strength_model, t, f) for c, t, f in terms]
+        if isinstance(v, list): # the weight of another model with its own patches
+            sub = linear_terms(v[1:])
+            if sub is None:
+                return None
+            terms.append((strength * sub[0], v[0][0], v[0][1]))
+            terms.extend((strength * c, t, f) for c, t, f in sub[1])
+        elif isinstance(v, tuple) and len(v) == 1 and torch.is_tensor(v[0]): # diff
+            terms.append((strength, v[0], None))
+        else:
+            return None
+    return base, terms
+
+
+def tensor_fingerprint(t):
+    """Source weights are identified by their storage: the state dict tensors of get_key_patches are new objects every time."""
+    try:
+        return (t.data_ptr(), t.dtype, tuple(t.shape), tuple(t.stride()))
+    except Exception:
+        return ("o", id(t))
+
+
+def function_fingerprint(f):
+    """get_key_patches also makes a new identity convert function every time, functions without a closure are identified by their code."""
+    if f is None:
+        return None
+    func = getattr(f, "__func__", f)
+    code = getattr(func, "__code__", None)
+    if code is None or getattr(func, "__closure__", None) is not None:
+        return ("o", id(f))
+    return (code, id(getattr(f, "__self__", None)))
+
+
+class MergeExpression:
+    def __init__(self, base, terms):
+        self.base = base
+        self.terms = [(c, t, f) for c, t, f in terms if c != 0.0]
+        self.fingerprint = (base, tuple((c, tensor_fingerprint(t), function_fingerprint(f)) for c, t, f in self.terms))
+
+    def evaluate(self, weight):
+        out = weight.to(torch.float32, copy=True)
+        out *= self.base
+        for c, t, convert_func in self.terms:
+            w = t.to(device=weight.device, dtype=torch.float32, copy=convert_func is not None)
+            if convert_func is not None:
+                w = convert_func(w, inplace=True)
+            out.add_(w, alpha=c)
+        return out.to(weight.dtype)
+
+
+def expression(patches, weight):
+    """The MergeExpression of the patches of weight, None if they can't be evaluated lazily."""
+    terms = linear_terms(patches)
+    if terms is None:
+        return None
+    base, terms = terms
+    if any(tuple(t.shape) != tuple(weight.shape) for c, t, f in terms):
+        return None
+    return MergeExpression(base, terms)
+
+
+class EvaluatedLayerCache:
+    """LRU of evaluated weights on their compute device, at most max_bytes."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (weight, expression), the expression keeps the fingerprinted tensors alive
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # set by comfy.model_management: free_memory_function(device) is the memory of device the cache can use without
+        # taking the memory inference needs
+        self.free_memory_function = None
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, weight, expression):
+        if weight.nbytes > self.max_bytes:
+            return
+        if self.free_memory_function is not None and weight.device.type != "cpu":
+            shortfall = weight.nbytes - self.free_memory_function(weight.device)
+            if shortfall > 0 and self.free(shortfall, weight.device) < shortfall:
+                return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (weight, expression)
+            self.bytes += weight.nbytes
+            while self.bytes > self.max_bytes:
+                old, _ = self.entries.popitem(last=False)[1]
+                self.bytes -= old.nbytes
+
+    def memory_used(self, device):
+        with self.lock:
+            return sum(w.nbytes for w, _ in self.entries.values() if w.device == device)
+
+    def free(self, memory_to_free, device):
+        """Evicts the least recently used entries on device until memory_to_free bytes are freed, returns the bytes freed."""
+        freed = 0
+        with self.lock:
+            for key in [k for k, (w, _) in self.entries.items() if w.device == device]:
+                if freed >= memory_to_free:
+                    break
+                weight, _ = self.entries.pop(key)
+                self.bytes -= weight.nbytes
+                freed += weight.nbytes
+        return freed
+
+    def discard(self, model_weights_uuid):
+        """Drops the entries of the model with these weights, which was unloaded."""
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == model_weights_uuid]:
+                weight, _ = self.entries.pop(key)
+                self.bytes -= weight.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+
+class LazyMergePatch:
+    """Weight function evaluating the merged weight of key when its layer casts the weight."""
+    def __init__(self, model, key, expression):
+        self.model_weights_uuid = model.model_weights_uuid
+        self.key = key
+        self.expression = expression
+
+    def cache_key(self, device, dtype):
+        return (self.model_weights_uuid, self.key, device, dtype, self.expression.fingerprint)
+
+    def cached(self, device, dtype):
+        """The evaluated weight if it is in the cache, which saves casting the unmerged weight."""
+        if CACHE is None or CACHE.max_bytes <= 0 or device is None:
+            return None
+        return CACHE.get(self.cache_key(torch.device(device), dtype))
+
+    def __call__(self, weight):
+        if CACHE is None or CACHE.max_bytes <= 0:
+            return self.expression.evaluate(weight)
+        out = self.expression.evaluate(weight)
+        CACHE.put(self.cache_key(weight.device, weight.dtype), out, self.expression)
+        return out
+
+
+def has_patch(functions):
+    return any(isinstance(f, LazyMergePatch) for f in functions)
+
+
+def remove_patches(model):
+    """Removes the LazyMergePatch weight functions from the modules of model, returns how many there were."""
+    removed = 0
+    for m in model.modules():
+        for attr in ("weight_function", "bias_function"):
+            functions = getattr(m, attr, None)
+            if functions is not None and has_patch(functions):
+                kept = [f for f in functions if not isinstance(f, LazyMergePatch)]
+                removed += len(functions) - len(kept)
+                setattr(m, attr, kept)
+    return removed
+
+
+def enable(max_bytes):
+    global CACHE
+    CACHE = EvaluatedLayerCache(max_bytes)
+    logging.info("Using lazy model merging ({:.0f} MB evaluated layer cache)".format(max_bytes / (1024 * 1024)))
+    return CACHE
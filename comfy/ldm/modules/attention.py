@@ -202,6 +202,54 @@ def attention_basic(q, k, v, heads, mask=None, attn_precision=None, skip_reshape
         )
     return out
 
+# per head score tile the cpu chunk planner aims for so the softmax passes stay in the last level cache
+CPU_ATTENTION_TILE_BYTES = 8 * 1024 * 1024
+CPU_ATTENTION_QUERY_CHUNKS = [4096, 2048, 1024, 512, 256, 128, 64]
+CPU_ATTENTION_MIN_KV_CHUNK = 256
+
+def attention_memory_budget(device):
+    mem_free_total = model_management.get_free_memory(device)
+    if model_management.is_device_cpu(device) and args.cpu_attention_memory > 0:
+        mem_free_total = min(mem_free_total, int(args.cpu_attention_memory * (1024 ** 3)))
+    return mem_free_total
+
+def sub_quad_working_set(batch_x_heads, query_chunk_size, kv_chunk_size, k_tokens, dim_head, bytes_per_token):
+    if kv_chunk_size >= k_tokens:
+        # scores, softmax and the cast for the value matmul
+        return batch_x_heads * query_chunk_size * k_tokens * bytes_per_token * 4
+    # the score tile and its exp copy, then every chunk summary twice (list + torch.stack)
+    kv_chunks = math.ceil(k_tokens / kv_chunk_size)
+    tile = batch_x_heads * query_chunk_size * kv_chunk_size * bytes_per_token * 2
+    summaries = batch_x_heads * query_chunk_size * kv_chunks * (dim_head + 2) * bytes_per_token * 2
+    return tile + summaries
+
+def plan_sub_quad_chunks(batch_x_heads, q_tokens, k_tokens, dim_head, bytes_per_token, mem_budget, tile_bytes=CPU_ATTENTION_TILE_BYTES):
+    """Pick (query_chunk_size, kv_chunk_size) for the cpu: the largest chunks whose working set fits mem_budget,
+    keeping each head's score tile around tile_bytes. Chunks are multiples of 64 to keep the matmuls aligned."""
+    kv_candidates = [k_tokens]
+    kv = 1 << (max(k_tokens - 1, 1).bit_length() - 1)
+    while kv >= CPU_ATTENTION_MIN_KV_CHUNK:
+        if kv < k_tokens:
+            kv_candidates.append(kv)
+        kv //= 2
+
+    for max_tile in (tile_bytes, None): # relax the tile size before giving up on the memory budget
+        best = None
+        for query_chunk_size in CPU_ATTENTION_QUERY_CHUNKS:
+            q_chunk = min(query_chunk_size, q_tokens)
+            for kv_chunk_size in kv_candidates:
+                if max_tile is not None and q_chunk * kv_chunk_size * bytes_per_token > max_tile:
+                    continue
+                if sub_quad_working_set(batch_x_heads, q_chunk, kv_chunk_size, k_tokens, dim_head, bytes_per_token) > mem_budget:
+                    continue
+                if best is None or q_chunk * kv_chunk_size > best[0] * best[1]:
+                    best = (q_chunk, kv_chunk_size)
+                break
+        if best is not None:
+            return best
+
+    return (min(CPU_ATTENTION_QUERY_CHUNKS[-1], q_tokens), kv_candidates[-1])
+
 @wrap_attn
 def attention_sub_quad(query, key, value, heads, mask=None, attn_precision=None, skip_reshape=False, skip_output_reshape=False, **kwargs):
     attn_precision = get_attn_precision(attn_precision, query.dtype)
@@ -231,21 +279,24 @@ def attention_sub_quad(query, key, value, heads, mask=None, attn_precision=None,
     batch_x_heads, q_tokens, _ = query.shape
     _, _, k_tokens = key.shape
 
-    mem_free_total, _ = model_management.get_free_memory(query.device, True)
-
     kv_chunk_size_min = None
     kv_chunk_size = None
     query_chunk_size = None
 
-    for x in [4096, 2048, 1024, 512, 256]:
-        count = mem_free_total / (batch_x_heads * bytes_per_token * x * 4.0)
-        if count >= k_tokens:
-            kv_chunk_size = k_tokens
-            query_chunk_size = x
-            break
+    if model_management.is_device_cpu(query.device):
+        query_chunk_size, kv_chunk_size = plan_sub_quad_chunks(batch_x_heads, q_tokens, k_tokens, dim_head, bytes_per_token, attention_memory_budget(query.device))
+    else:
+        mem_free_total, _ = model_management.get_free_memory(query.device, True)
 
-    if query_chunk_size is None:
-        query_chunk_size = 512
+        for x in [4096, 2048, 1024, 512, 256]:
+            count = mem_free_total / (batch_x_heads * bytes_per_token * x * 4.0)
+            if count >= k_tokens:
+                kv_chunk_size = k_tokens
+                query_chunk_size = x
+                break
+
+        if query_chunk_size is None:
+            query_chunk_size = 512
 
     if mask is not None:
         if len(mask.shape) == 2:
@@ -302,7 +353,7 @@ def attention_split(q, k, v, heads, mask=None, attn_precision=None, skip_reshape
 
     r1 = torch.zeros(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
 
-    mem_free_total = model_management.get_free_memory(q.device)
+    mem_free_total = attention_memory_budget(q.device)
 
     if attn_precision == torch.float32:
         element_size = 4
@@ -316,6 +367,7 @@ def attention_split(q, k, v, heads, mask=None, attn_precision=None, skip_reshape
     modifier = 3
     mem_required = tensor_size * modifier
     steps = 1
+    max_steps = 64
 
 
     if mem_required > mem_free_total:
@@ -323,7 +375,12 @@ def attention_split(q, k, v, heads, mask=None, attn_precision=None, skip_reshape
         # print(f"Expected tensor size:{tensor_size/gb:0.1f}GB, cuda free:{mem_free_cuda/gb:0.1f}GB "
         #      f"torch free:{mem_free_torch/gb:0.1f} total:{mem_free_total/gb:0.1f} steps:{steps}")
 
-    if steps > 64:
+    if model_management.is_device_cpu(q.device):
+        # the cpu budget is a working set target, not the available memory: slice further instead of erroring out
+        max_steps = max(max_steps, 2**math.floor(math.log2(max(q.shape[1] // 64, 1))))
+        steps = min(steps, max_steps)
+
+    if steps > max_steps:
         max_res = math.floor(math.sqrt(math.sqrt(mem_free_total / 2.5)) / 8) * 64
         raise RuntimeError(f'Not enough memory, use lower resolution (max approx. {max_res}x{max_res}). '
                             f'Need: {mem_required/64/gb:0.1f}GB free, Have:{mem_free_total/gb:0.1f}GB free')
@@ -340,7 +397,7 @@ def attention_split(q, k, v, heads, mask=None, attn_precision=None, skip_reshape
     cleared_cache = False
     while True:
         try:
-            slice_size = q.shape[1] // steps if (q.shape[1] % steps) == 0 else q.shape[1]
+            slice_size = math.ceil(q.shape[1] / steps)
             for i in range(0, q.shape[1], slice_size):
                 end = i + slice_size
                 if upcast:
@@ -373,7 +430,7 @@ def attention_split(q, k, v, heads, mask=None, attn_precision=None, skip_reshape
                     logging.warning("out of memory error, emptying cache and trying again")
                     continue
                 steps *= 2
-                if steps > 64:
+                if steps > max_steps:
                     raise e
                 logging.warning("out of memory error, increasing steps and trying again {}".format(steps))
             else:
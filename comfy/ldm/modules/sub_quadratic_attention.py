@@ -262,14 +262,19 @@ def efficient_dot_product_attention(
             mask=mask,
         )
 
-    # TODO: maybe we should use torch.empty_like(query) to allocate storage in-advance,
-    # and pass slices to be mutated, instead of torch.cat()ing the returned slices
-    res = torch.cat([
-        compute_query_chunk_attn(
-            query=get_query_chunk(i * query_chunk_size),
+    # write every query chunk into storage allocated in advance instead of torch.cat()ing the returned slices,
+    # which would keep all the slices and the concatenated result alive at the same time
+    res = None
+    for i in range(math.ceil(q_tokens / query_chunk_size)):
+        chunk_idx = i * query_chunk_size
+        chunk = compute_query_chunk_attn(
+            query=get_query_chunk(chunk_idx),
             key_t=key_t,
             value=value,
-            mask=get_mask_chunk(i * query_chunk_size)
-        ) for i in range(math.ceil(q_tokens / query_chunk_size))
-    ], dim=1)
+            mask=get_mask_chunk(chunk_idx)
+        )
+        if res is None:
+            res = torch.empty((batch_x_heads, q_tokens, chunk.shape[-1]), device=chunk.device, dtype=chunk.dtype)
+        res[:, chunk_idx:chunk_idx + chunk.shape[1]] = chunk
+        del chunk
     return res
@@ -34,9 +34,39 @@ LORA_CLIP_MAP = {
 }
 
 
+def lora_key_prefixes(name):
+    """The lora keys a tensor name of a lora file can belong to: every prefix ending before a dot (or _lora. of the diffusers format)."""
+    i = name.find("_lora.")
+    if i > 0:
+        yield name[:i]
+    i = name.find(".")
+    while i > 0:
+        yield name[:i]
+        i = name.find(".", i + 1)
+
+def match_lora_keys(names, key_map):
+    """
+    Looks up the lora keys the tensor names of a lora file can belong to in key_map, which avoids walking the whole key
+    map of a big model for a lora that only has a few layers. Returns the part of key_map the lora has tensors for and
+    the names of those tensors.
+    """
+    to_load = {}
+    matched = []
+    for name in names:
+        found = False
+        for prefix in lora_key_prefixes(name):
+            target = key_map.get(prefix, None)
+            if target is not None:
+                to_load[prefix] = target
+                found = True
+        if found:
+            matched.append(name)
+    return to_load, matched
+
 def load_lora(lora, to_load, log_missing=True):
     patch_dict = {}
     loaded_keys = set()
+    to_load = match_lora_keys(lora.keys(), to_load)[0]
     for x in to_load:
         alpha_name = "{}.alpha".format(x)
         alpha = None
@@ -94,7 +124,24 @@ def load_lora(lora, to_load, log_missing=True):
 
     return patch_dict
 
+def cached_lora_keys(model, name, build):
+    """The key map built by build(model, {}), computed once and kept on the model: it is tens of thousands of string operations for big models."""
+    attr = "lora_key_map_{}".format(name)
+    key_map = getattr(model, attr, None)
+    if key_map is None:
+        key_map = build(model, {})
+        setattr(model, attr, key_map)
+    return key_map
+
 def model_lora_keys_clip(model, key_map={}):
+    key_map.update(cached_lora_keys(model, "clip", build_lora_keys_clip))
+    return key_map
+
+def model_lora_keys_unet(model, key_map={}):
+    key_map.update(cached_lora_keys(model, "unet", build_lora_keys_unet))
+    return key_map
+
+def build_lora_keys_clip(model, key_map):
     sdk = model.state_dict().keys()
     for k in sdk:
         if k.endswith(".weight"):
@@ -172,7 +219,7 @@ def model_lora_keys_clip(model, key_map={}):
 
     return key_map
 
-def model_lora_keys_unet(model, key_map={}):
+def build_lora_keys_unet(model, key_map):
     sd = model.state_dict()
     sdk = sd.keys()
 
@@ -349,8 +396,26 @@ def pad_tensor_to_shape(tensor: torch.Tensor, new_shape: list[int]) -> torch.Ten
 
     return padded_tensor
 
+def calculate_lora_stack(patches, weight, key, intermediate_dtype=torch.float32, original_weights=None):
+    """Applies consecutive plain LoRA patches of a weight, with a single matmul if there are several of them."""
+    if len(patches) > 1:
+        output = weight_adapter.LoRAAdapter.calculate_stacked_weight(patches, weight, key, intermediate_dtype)
+        if output is not None:
+            return output
+    for strength, v, strength_model, offset, function in patches:
+        weight = v.calculate_weight(weight, key, strength, strength_model, offset, lambda a: a, intermediate_dtype, original_weights)
+    return weight
+
 def calculate_weight(patches, weight, key, intermediate_dtype=torch.float32, original_weights=None):
+    lora_stack = []
     for p in patches:
+        if weight_adapter.LoRAAdapter.stackable(p):
+            lora_stack.append(p)
+            continue
+        if len(lora_stack) > 0:
+            weight = calculate_lora_stack(lora_stack, weight, key, intermediate_dtype, original_weights)
+            lora_stack = []
+
         strength = p[0]
         v = p[1]
         strength_model = p[2]
@@ -412,4 +477,6 @@ def calculate_weight(patches, weight, key, intermediate_dtype=torch.float32, ori
         if old_weight is not None:
             weight = old_weight
 
+    if len(lora_stack) > 0:
+        weight = calculate_lora_stack(lora_stack, weight, key, intermediate_dtype, original_weights)
     return weight
@@ -33,11 +33,19 @@ def convert_uso_lora(sd):
     return sd_out
 
 
+def converter(keys):
+    """The function converting a lora with these keys to a format load_lora understands, None if it doesn't need it."""
+    if "img_in.lora_A.weight" in keys and "single_blocks.0.norm.key_norm.scale" in keys:
+        return convert_lora_bfl_control
+    if "lora_unet__blocks_0_cross_attn_k.lora_down.weight" in keys:
+        return convert_lora_wan_fun
+    if "single_blocks.37.processor.qkv_lora.up.weight" in keys and "double_blocks.18.processor.qkv_lora2.up.weight" in keys:
+        return convert_uso_lora
+    return None
+
+
 def convert_lora(sd):
-    if "img_in.lora_A.weight" in sd and "single_blocks.0.norm.key_norm.scale" in sd:
-        return convert_lora_bfl_control(sd)
-    if "lora_unet__blocks_0_cross_attn_k.lora_down.weight" in sd:
-        return convert_lora_wan_fun(sd)
-    if "single_blocks.37.processor.qkv_lora.up.weight" in sd and "double_blocks.18.processor.qkv_lora2.up.weight" in sd:
-        return convert_uso_lora(sd)
+    convert = converter(sd)
+    if convert is not None:
+        return convert(sd)
     return sd
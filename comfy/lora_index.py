@@ -0,0 +1,150 @@
+"""
+Index of LoRA files built from their safetensors headers.
+
+For every file the index records the names and shapes of its tensors, its rank, the base model it was trained for
+(detected from the key names and shapes, or from the training metadata) and its size, without reading any tensor.
+Entries are kept until the size or modification time of the file changes.
+
+The key names let a loader match the file against the lora key map of a model before reading it and only read the
+tensors of the layers the model has (see comfy.sd.load_lora_file_for_models), the base models let the /models/loras
+listing be filtered by the base model of the workflow.
+"""
+import json
+import logging
+import os
+import threading
+
+import safetensors
+
+import comfy.lora
+import comfy.lora_convert
+import comfy.model_prefetch
+import comfy.utils
+
+DOWN_SUFFIXES = (".lora_down.weight", "_lora.down.weight", ".lora_A.weight", ".lora.down.weight", ".lora_A",
+                 ".lora_linear_layer.down.weight", ".lora_A.default.weight")
+
+CROSS_ATTENTION_DIMS = {768: "SD1", 1024: "SD2", 2048: "SDXL"}
+
+METADATA_BASE_MODELS = [("sdxl", "SDXL"), ("stable-diffusion-xl", "SDXL"), ("sd_v1", "SD1"), ("stable-diffusion-v1", "SD1"),
+                        ("sd_v2", "SD2"), ("stable-diffusion-v2", "SD2"), ("sd3", "SD3"), ("stable-diffusion-3", "SD3"), ("flux", "Flux")]
+
+BASE_MODELS = ("SD1", "SD2", "SDXL", "SD3", "Flux", "QwenImage", "Wan")
+
+
+def detect_base_model(shapes, metadata):
+    """One of BASE_MODELS or None if it can't be told from the tensor names and shapes or the training metadata."""
+    names = list(shapes)
+
+    def has(part):
+        return any(part in n for n in names)
+
+    if has("double_blocks") or has("single_transformer_blocks"):
+        return "Flux"
+    if has("joint_blocks"):
+        return "SD3"
+    if has("img_mlp") and has("txt_mlp"):
+        return "QwenImage"
+    if has("cross_attn") and has("self_attn") and has("ffn"):
+        return "Wan"
+    if has("lora_te2_") or has("text_encoder_2."):
+        return "SDXL"
+    for n in names:
+        if "attn2" in n and "to_k" in n and n.endswith(DOWN_SUFFIXES) and len(shapes[n]) == 2:
+            base = CROSS_ATTENTION_DIMS.get(shapes[n][1], None)
+            if base is not None:
+                return base
+
+    for key in ("ss_base_model_version", "modelspec.architecture"):
+        value = (metadata or {}).get(key, "").lower()
+        for pattern, base in METADATA_BASE_MODELS:
+            if value.startswith(pattern):
+                return base
+    return None
+
+
+class LoraFile:
+    def __init__(self, path, size, mtime, shapes, metadata):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.shapes = shapes
+        self.metadata = metadata
+        ranks = [shape[0] for name, shape in shapes.items() if name.endswith(DOWN_SUFFIXES) and len(shape) > 0]
+        self.rank = max(ranks) if len(ranks) > 0 else None
+        self.base_model = detect_base_model(shapes, metadata)
+        self.convert = comfy.lora_convert.converter(shapes)
+
+    def match(self, key_map):
+        """
+        Matches the file against a lora key map (comfy.lora.model_lora_keys_unet/clip): returns the part of key_map the
+        file has tensors for, to pass to comfy.lora.load_lora, and the names of the tensors of those layers.
+        """
+        return comfy.lora.match_lora_keys(self.shapes, key_map)
+
+    def load(self, names):
+        """Reads the tensors names from the file, or takes them from the copy staged by --prefetch-models."""
+        sd = {}
+        if len(names) == 0:
+            return sd
+        staged = comfy.model_prefetch.take_staged(self.path)
+        if staged is not None:
+            return {name: staged[0][name] for name in names}
+        with safetensors.safe_open(self.path, framework="pt", device="cpu") as f:
+            for name in names:
+                tensor = f.get_tensor(name)
+                if comfy.utils.DISABLE_MMAP:
+                    tensor = tensor.to(device="cpu", copy=True)
+                sd[name] = tensor
+        return sd
+
+
+def read_lora_file(path, stat):
+    header = comfy.utils.safetensors_header(path)
+    if header is None:
+        return None
+    header = json.loads(header)
+    metadata = header.pop("__metadata__", None)
+    shapes = {name: tuple(entry["shape"]) for name, entry in header.items()}
+    return LoraFile(path, stat.st_size, stat.st_mtime_ns, shapes, metadata)
+
+
+class LoraIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, path):
+        """The LoraFile of path, None if it isn't a readable safetensors file."""
+        if path is None or not path.lower().endswith((".safetensors", ".sft")):
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get(path, None)
+        if entry is not None and entry[0] == (stat.st_size, stat.st_mtime_ns):
+            return entry[1]
+        try:
+            lora_file = read_lora_file(path, stat)
+        except Exception as e:
+            logging.warning("Couldn't index lora {}: {}".format(path, e))
+            lora_file = None
+        with self.lock:
+            self.entries[path] = ((stat.st_size, stat.st_mtime_ns), lora_file)
+        return lora_file
+
+    def compatible(self, path, base_model):
+        """If the lora at path can be used with base_model: files whose base model can't be detected are."""
+        lora_file = self.get(path)
+        if lora_file is None or lora_file.base_model is None:
+            return True
+        return lora_file.base_model.lower() == base_model.lower()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+INDEX = LoraIndex()
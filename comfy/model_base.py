@@ -52,6 +52,8 @@ import comfy.model_management
 import comfy.patcher_extension
 import comfy.conds
 import comfy.ops
+import comfy.shared_weights
+import comfy.weight_streaming
 from enum import Enum
 from . import utils
 import comfy.latent_formats
@@ -200,7 +202,8 @@ class BaseModel(torch.nn.Module):
         if "latent_shapes" in extra_conds:
             xc = utils.unpack_latents(xc, extra_conds.pop("latent_shapes"))
 
-        model_output = self.diffusion_model(xc, t, context=context, control=control, transformer_options=transformer_options, **extra_conds)
+        with comfy.weight_streaming.forward_pass(self.current_patcher, xc):
+            model_output = self.diffusion_model(xc, t, context=context, control=control, transformer_options=transformer_options, **extra_conds)
         if len(model_output) > 1 and not torch.is_tensor(model_output):
             model_output, _ = utils.pack_latents(model_output)
 
@@ -304,7 +307,7 @@ class BaseModel(torch.nn.Module):
                 to_load[k[len(unet_prefix):]] = sd.pop(k)
 
         to_load = self.model_config.process_unet_state_dict(to_load)
-        m, u = self.diffusion_model.load_state_dict(to_load, strict=False)
+        m, u = comfy.shared_weights.load_state_dict(self.diffusion_model, to_load, strict=False)
         if len(m) > 0:
             logging.warning("unet missing: {}".format(m))
 
@@ -0,0 +1,184 @@
+"""
+Eviction policies used by model_management.free_memory to pick which loaded models to offload.
+
+A policy takes a list of EvictionCandidate (most recently used first) and the amount of memory that
+has to be freed and returns the candidates in the order they should be unloaded. The same candidates
+can be built from a recorded trace so policies can be compared offline with simulate().
+"""
+import heapq
+import json
+import logging
+import threading
+import time
+from typing import NamedTuple, Optional
+
+# approximate host to device bandwidths (bytes/s) used to estimate the cost of loading weights back
+SOURCE_BANDWIDTH = {
+    "pinned": 20 * 1024 ** 3,
+    "ram": 8 * 1024 ** 3,
+    "disk": 1 * 1024 ** 3,
+}
+# approximate cost in seconds of recomputing the patches (LoRA...) of one weight when it is loaded back
+PATCH_COST_PER_KEY = 0.002
+# reuse probability of a model that isn't needed by the running prompt or the queue, decayed by recency
+UNPREDICTED_REUSE = 0.5
+
+
+class EvictionCandidate(NamedTuple):
+    key: object
+    loaded_bytes: int
+    total_bytes: int
+    patch_count: int
+    source: str
+    recency: int # 0 is the most recently used model
+    refcount: int = 0
+    reuse_distance: Optional[int] = None # 0 is the running prompt, 1 the next queued prompt, None not expected
+
+
+def reload_cost(candidate, bytes_freed=None):
+    """Estimated seconds to load bytes_freed of the candidate back (all of it if None)."""
+    if bytes_freed is None or bytes_freed >= candidate.loaded_bytes:
+        bytes_freed = candidate.loaded_bytes
+        patch_cost = candidate.patch_count * PATCH_COST_PER_KEY
+    else:
+        patch_cost = candidate.patch_count * PATCH_COST_PER_KEY * (bytes_freed / max(candidate.loaded_bytes, 1))
+    return bytes_freed / SOURCE_BANDWIDTH.get(candidate.source, SOURCE_BANDWIDTH["ram"]) + patch_cost
+
+
+def reuse_probability(candidate):
+    if candidate.reuse_distance is not None:
+        return 1.0 / (1 + candidate.reuse_distance)
+    return UNPREDICTED_REUSE / (1 + candidate.recency)
+
+
+def legacy_policy(candidates, memory_to_free):
+    # partially offloaded models first, then the ones with the least references, then the smallest
+    return sorted(candidates, key=lambda c: (c.loaded_bytes - c.total_bytes, c.refcount, c.total_bytes, c.recency))
+
+
+def cost_policy(candidates, memory_to_free):
+    # evict the model with the smallest expected reload cost for the memory we need from it
+    def score(c):
+        return (reload_cost(c, min(c.loaded_bytes, memory_to_free)) * reuse_probability(c), -c.recency)
+    return sorted(candidates, key=score)
+
+
+POLICIES = {
+    "default": legacy_policy,
+    "cost": cost_policy,
+}
+
+
+class ReusePredictor:
+    """Maps a model source file to how soon the running prompt or the queued prompts will use it."""
+    def __init__(self, prompt_queue, prompt_model_files, lookahead=4):
+        self.prompt_queue = prompt_queue
+        self.prompt_model_files = prompt_model_files
+        self.lookahead = lookahead
+
+    def reuse_distances(self):
+        running, queued = self.prompt_queue.get_current_queue_volatile()
+        distances = {}
+        for item in running:
+            for path in self.prompt_model_files(item[2]):
+                distances.setdefault(path, 0)
+        for i, item in enumerate(heapq.nsmallest(self.lookahead, queued)):
+            for path in self.prompt_model_files(item[2]):
+                distances.setdefault(path, i + 1)
+        return distances
+
+
+REUSE_PREDICTOR = None
+
+def set_reuse_predictor(predictor):
+    global REUSE_PREDICTOR
+    REUSE_PREDICTOR = predictor
+
+def reuse_distances():
+    if REUSE_PREDICTOR is None:
+        return {}
+    try:
+        return REUSE_PREDICTOR.reuse_distances()
+    except Exception as e:
+        logging.debug("Model reuse prediction failed: {}".format(e))
+        return {}
+
+
+class TraceRecorder:
+    """Appends every model load request to a jsonl file that simulate() can replay."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record_load(self, device, models, memory_required):
+        event = {"t": time.time(), "device": str(device), "memory_required": int(memory_required), "models": models}
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(event) + "\n")
+
+
+TRACE_RECORDER = None
+
+def set_trace_recorder(path):
+    global TRACE_RECORDER
+    TRACE_RECORDER = TraceRecorder(path) if path is not None else None
+
+
+def load_trace(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def simulate(trace, policy, memory_capacity, lookahead=4):
+    """
+    Replay the load events of a trace on a device with memory_capacity bytes using policy.
+    The next lookahead load events are used as the queue reuse prediction.
+    Returns a dict with the number of loads, full/partial evictions and the estimated reload seconds.
+    """
+    if isinstance(policy, str):
+        policy = POLICIES[policy]
+
+    resident = {} # key -> loaded bytes, most recently used last
+    info = {}
+    stats = {"loads": 0, "misses": 0, "evictions": 0, "partial_evictions": 0, "reload_seconds": 0.0, "bytes_loaded": 0}
+
+    for index, event in enumerate(trace):
+        wanted = {m["id"]: m for m in event["models"]}
+        info.update(wanted)
+        upcoming = {}
+        for distance, future in enumerate(trace[index + 1:index + 1 + lookahead]):
+            for m in future["models"]:
+                upcoming.setdefault(m["id"], distance + 1)
+
+        required = sum(m["size"] - resident.get(k, 0) for k, m in wanted.items()) + event.get("memory_required", 0)
+        free = memory_capacity - sum(resident.values())
+        if required > free:
+            order = list(reversed(list(resident.keys())))
+            candidates = []
+            for recency, k in enumerate(order):
+                if k in wanted:
+                    continue
+                m = info[k]
+                candidates.append(EvictionCandidate(k, resident[k], m["size"], m.get("patches", 0), m.get("source", "ram"), recency, reuse_distance=upcoming.get(k, None)))
+            for c in policy(candidates, required - free):
+                to_free = required - free
+                if to_free <= 0:
+                    break
+                if c.loaded_bytes > to_free:
+                    resident[c.key] -= to_free
+                    free += to_free
+                    stats["partial_evictions"] += 1
+                else:
+                    free += resident.pop(c.key)
+                    stats["evictions"] += 1
+
+        for k, m in wanted.items():
+            stats["loads"] += 1
+            missing = m["size"] - resident.pop(k, 0)
+            if missing > 0:
+                stats["misses"] += 1
+                stats["bytes_loaded"] += missing
+                c = EvictionCandidate(k, m["size"], m["size"], m.get("patches", 0), m.get("source", "ram"), 0)
+                stats["reload_seconds"] += reload_cost(c, missing)
+            resident[k] = min(m["size"], memory_capacity) # bigger models get partially loaded
+    return stats
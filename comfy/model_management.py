@@ -26,6 +26,17 @@ import importlib
 import platform
 import weakref
 import gc
+import comfy.model_eviction
+import comfy.shared_weights
+import comfy.hook_keyframe_cache
+import comfy.lazy_merge
+import comfy.runtime_lora
+import comfy.offload_quantization
+import comfy.patched_weight_cache
+import comfy.safetensors_writer
+import comfy.staging_pool
+import comfy.text_encoder_cache
+import comfy.weight_streaming
 
 class VRAMState(Enum):
     DISABLED = 0    #No vram present: no need to move models to vram
@@ -416,6 +427,32 @@ logging.info(f"Set vram state to: {vram_state.name}")
 
 DISABLE_SMART_MEMORY = args.disable_smart_memory
 
+if args.shared_weight_pool > 0:
+    comfy.shared_weights.enable_shared_pool(args.shared_weight_pool_dir, int(args.shared_weight_pool * 1024 * 1024 * 1024))
+
+if args.patched_weight_cache > 0:
+    comfy.patched_weight_cache.enable_cache(int(args.patched_weight_cache * 1024 * 1024 * 1024), directory=args.patched_weight_cache_dir, max_disk_bytes=int(args.patched_weight_cache_disk * 1024 * 1024 * 1024))
+
+if args.text_encoder_cache > 0:
+    comfy.text_encoder_cache.enable_cache(int(args.text_encoder_cache * 1024 * 1024 * 1024), directory=args.text_encoder_cache_dir, max_disk_bytes=int(args.text_encoder_cache_disk * 1024 * 1024 * 1024))
+
+if args.lazy_merge is not None:
+    comfy.lazy_merge.enable(int(args.lazy_merge * 1024 * 1024 * 1024))
+    comfy.lazy_merge.CACHE.free_memory_function = lambda device: get_free_memory(device) - minimum_inference_memory()
+
+if args.runtime_lora:
+    comfy.runtime_lora.enable()
+
+if args.hook_keyframe_cache > 0:
+    comfy.hook_keyframe_cache.enable_cache(int(args.hook_keyframe_cache * 1024 * 1024 * 1024), device_bytes=int(args.hook_keyframe_cache_vram * 1024 * 1024 * 1024))
+
+if args.save_fsync > 0:
+    comfy.safetensors_writer.enable_fsync(args.save_fsync * 1024 * 1024)
+
+EVICTION_POLICY = comfy.model_eviction.POLICIES[args.model_eviction_policy]
+if args.model_eviction_trace is not None:
+    comfy.model_eviction.set_trace_recorder(args.model_eviction_trace)
+
 if DISABLE_SMART_MEMORY:
     logging.info("Disabling smart memory management")
 
@@ -527,11 +564,24 @@ class LoadedModel:
                 if freed >= memory_to_free:
                     return False
         self.model.detach(unpatch_weights)
+        if comfy.lazy_merge.CACHE is not None:
+            comfy.lazy_merge.CACHE.discard(self.model.model.model_weights_uuid)
         self.model_finalizer.detach()
         self.model_finalizer = None
         self.real_model = None
         return True
 
+    def eviction_candidate(self, index, reuse_distances={}):
+        model = self.model
+        source = "pinned" if len(model.pinned) > 0 else "ram"
+        return comfy.model_eviction.EvictionCandidate(index, self.model_loaded_memory(), self.model_memory(), len(model.patches), source, index,
+                                                      refcount=sys.getrefcount(model), reuse_distance=reuse_distances.get(getattr(model.model, "model_source_path", None), None))
+
+    def trace_info(self):
+        model = self.model
+        return {"id": "{:x}".format(id(model.model)), "name": model.model.__class__.__name__, "size": self.model_memory(),
+                "patches": len(model.patches), "source": "pinned" if len(model.pinned) > 0 else "ram"}
+
     def model_use_more_vram(self, extra_memory, force_patch_weights=False):
         return self.model.partially_load(self.device, extra_memory, force_patch_weights=force_patch_weights)
 
@@ -580,19 +630,25 @@ def minimum_inference_memory():
 
 def free_memory(memory_required, device, keep_loaded=[]):
     cleanup_models_gc()
+    if comfy.lazy_merge.CACHE is not None and device != torch.device("cpu"):
+        # evaluated merge layers are cheaper to recompute than models to reload
+        if comfy.lazy_merge.CACHE.free(memory_required - get_free_memory(device), device) > 0:
+            soft_empty_cache()
     unloaded_model = []
     can_unload = []
     unloaded_models = []
 
+    distances = comfy.model_eviction.reuse_distances() if EVICTION_POLICY is not comfy.model_eviction.legacy_policy else {}
     for i in range(len(current_loaded_models) -1, -1, -1):
         shift_model = current_loaded_models[i]
         if shift_model.device == device:
             if shift_model not in keep_loaded and not shift_model.is_dead():
-                can_unload.append((-shift_model.model_offloaded_memory(), sys.getrefcount(shift_model.model), shift_model.model_memory(), i))
+                can_unload.append(shift_model.eviction_candidate(i, distances))
                 shift_model.currently_used = False
 
-    for x in sorted(can_unload):
-        i = x[-1]
+    memory_to_free_estimate = max(memory_required - get_free_memory(device), 0) if len(can_unload) > 0 else 0
+    for x in EVICTION_POLICY(can_unload, memory_to_free_estimate):
+        i = x.key
         memory_to_free = None
         if not DISABLE_SMART_MEMORY:
             free_mem = get_free_memory(device)
@@ -666,6 +722,10 @@ def load_models_gpu(models, memory_required=0, force_patch_weights=False, minimu
     for loaded_model in models_to_load:
         total_memory_required[loaded_model.device] = total_memory_required.get(loaded_model.device, 0) + loaded_model.model_memory_required(loaded_model.device)
 
+    if comfy.model_eviction.TRACE_RECORDER is not None:
+        for device in total_memory_required:
+            comfy.model_eviction.TRACE_RECORDER.record_load(device, [m.trace_info() for m in models_to_load if m.device == device], memory_required)
+
     for device in total_memory_required:
         if device != torch.device("cpu"):
             free_memory(total_memory_required[device] * 1.1 + extra_mem, device)
@@ -1098,6 +1158,21 @@ if not args.disable_pinned_memory:
             MAX_PINNED_MEMORY = get_total_memory(torch.device("cpu")) * 0.95
         logging.info("Enabled pinned memory {}".format(MAX_PINNED_MEMORY // (1024 * 1024)))
 
+if args.offload_quantize is not None:
+    comfy.offload_quantization.enable(args.offload_quantize)
+
+if args.prefetch_weights > 0:
+    comfy.weight_streaming.PREFETCH_DEPTH = args.prefetch_weights
+elif args.pinned_staging_pool > 0:
+    comfy.weight_streaming.PREFETCH_DEPTH = 2
+comfy.weight_streaming.TRACE_DIRECTORY = args.execution_order_trace_dir
+
+if args.pinned_staging_pool > 0:
+    if MAX_PINNED_MEMORY > 0:
+        comfy.staging_pool.enable_pool(min(int(args.pinned_staging_pool * 1024 * 1024 * 1024), int(MAX_PINNED_MEMORY)))
+    else: # no pinned memory (cpu...), same packing without it
+        comfy.staging_pool.enable_pool(int(args.pinned_staging_pool * 1024 * 1024 * 1024), pin=False)
+
 
 def pin_memory(tensor):
     global TOTAL_PINNED_MEMORY
@@ -1301,6 +1376,12 @@ def is_device_xpu(device):
 def is_device_cuda(device):
     return is_device_type(device, 'cuda')
 
+def tile_workers(device):
+    # tiles run concurrently by comfy.utils.tiled_scale, on cpu this overlaps the blending and python overhead of one tile with the model call of the next
+    if is_device_cpu(device) and psutil.cpu_count(logical=False) is not None and psutil.cpu_count(logical=False) >= 4:
+        return 2
+    return 1
+
 def is_directml_enabled():
     global directml_enabled
     if directml_enabled:
@@ -1482,6 +1563,16 @@ def soft_empty_cache(force=False):
 def unload_all_models():
     free_memory(1e30, get_torch_device())
 
+def unload_model_clones(model):
+    """Unloads model and the ModelPatchers sharing its weights, leaving the unpatched weights on the offload device."""
+    for i in range(len(current_loaded_models) - 1, -1, -1):
+        if model.is_clone(current_loaded_models[i].model):
+            current_loaded_models.pop(i).model_unload()
+    if comfy.lazy_merge.CACHE is not None:
+        comfy.lazy_merge.CACHE.discard(model.model.model_weights_uuid)
+    if model.model.current_weight_patches_uuid is not None or model.model.model_lowvram:
+        model.unpatch_model(model.offload_device)
+
 
 #TODO: might be cleaner to put this somewhere else
 import threading
@@ -19,7 +19,6 @@
 from __future__ import annotations
 
 import collections
-import copy
 import inspect
 import logging
 import math
@@ -29,11 +28,20 @@ from typing import Callable, Optional
 import torch
 
 import comfy.float
+import comfy.hook_keyframe_cache
 import comfy.hooks
+import comfy.lazy_merge
 import comfy.lora
 import comfy.model_management
+import comfy.offload_quantization
+import comfy.patched_weight_cache
 import comfy.patcher_extension
+import comfy.runtime_lora
+import comfy.shared_weights
+import comfy.staging_pool
 import comfy.utils
+import comfy.weight_adapter
+import comfy.weight_streaming
 from comfy.comfy_types import UnetWrapperFunction
 from comfy.patcher_extension import CallbacksMP, PatcherInjection, WrappersMP
 
@@ -106,6 +114,10 @@ def wipe_lowvram_weight(m):
     if hasattr(m, "bias_function"):
         m.bias_function = []
 
+def has_cast_patch(functions):
+    """If functions apply the patches of the weight in place of patching it: lazy merges and runtime loras."""
+    return comfy.lazy_merge.has_patch(functions) or comfy.runtime_lora.has_patch(functions)
+
 def move_weight_functions(m, device):
     if device is None:
         return 0
@@ -219,6 +231,8 @@ class ModelPatcher:
     def __init__(self, model, load_device, offload_device, size=0, weight_inplace_update=False):
         self.size = size
         self.model = model
+        if not hasattr(self.model, 'model_weights_uuid'):
+            self.model.model_weights_uuid = uuid.uuid4() # identifies the base weights for the patched weight cache
         if not hasattr(self.model, 'device'):
             logging.debug("Model doesn't have a device attribute.")
             self.model.device = offload_device
@@ -239,6 +253,7 @@ class ModelPatcher:
         self.patches_uuid = uuid.uuid4()
         self.parent = None
         self.pinned = set()
+        self.execution_orders = {}
 
         self.attachments: dict[str] = {}
         self.additional_models: dict[str, list[ModelPatcher]] = {}
@@ -286,19 +301,27 @@ class ModelPatcher:
         return self.model.lowvram_patch_counter
 
     def clone(self):
+        """
+        A new ModelPatcher of the same model with the patches of this one.
+
+        The clone shares the per key patch lists of patches, the per hook dicts of hook_patches and the objects in
+        model_options (the nested dicts and lists of model_options are copied) with this patcher. add_patches and
+        add_hook_patches replace a list instead of modifying it: code changing the patches of a clone must do the same
+        (clone.patches[key] = clone.patches[key] + [...]), appending to the list in place would also patch this
+        patcher and every other clone of it. create_hook_patches_clone makes a private copy of hook_patches.
+        """
         n = self.__class__(self.model, self.load_device, self.offload_device, self.size, weight_inplace_update=self.weight_inplace_update)
-        n.patches = {}
-        for k in self.patches:
-            n.patches[k] = self.patches[k][:]
+        n.patches = self.patches.copy()
         n.patches_uuid = self.patches_uuid
 
         n.object_patches = self.object_patches.copy()
         n.weight_wrapper_patches = self.weight_wrapper_patches.copy()
-        n.model_options = copy.deepcopy(self.model_options)
+        n.model_options = create_model_options_clone(self.model_options)
         n.backup = self.backup
         n.object_patches_backup = self.object_patches_backup
         n.parent = self
         n.pinned = self.pinned
+        n.execution_orders = self.execution_orders
 
         n.force_cast_weights = self.force_cast_weights
 
@@ -328,8 +351,8 @@ class ModelPatcher:
         for k, i in self.injections.items():
             n.injections[k] = i.copy()
         # hooks
-        n.hook_patches = create_hook_patches_clone(self.hook_patches)
-        n.hook_patches_backup = create_hook_patches_clone(self.hook_patches_backup) if self.hook_patches_backup else self.hook_patches_backup
+        n.hook_patches = self.hook_patches.copy()
+        n.hook_patches_backup = self.hook_patches_backup.copy() if self.hook_patches_backup else self.hook_patches_backup
         for group in self.cached_hook_patches:
             n.cached_hook_patches[group] = {}
             for k in self.cached_hook_patches[group]:
@@ -569,9 +592,7 @@ class ModelPatcher:
 
                 if key in model_sd:
                     p.add(k)
-                    current_patches = self.patches.get(key, [])
-                    current_patches.append((strength_patch, patches[k], strength_model, offset, function))
-                    self.patches[key] = current_patches
+                    self.patches[key] = self.patches.get(key, []) + [(strength_patch, patches[k], strength_model, offset, function)]
 
             self.patches_uuid = uuid.uuid4()
             return list(p)
@@ -616,9 +637,24 @@ class ModelPatcher:
         weight, set_func, convert_func = get_key_weight(self.model, key)
         inplace_update = self.weight_inplace_update or inplace_update
 
+        cache = comfy.patched_weight_cache.PATCHED_WEIGHT_CACHE
+        cache_key = None
+        if cache is not None and set_func is None and convert_func is None and key not in self.backup: # the weight is the unpatched base weight
+            cache_key = cache.cache_key(self.model, key, self.patches[key], weight)
+
         if key not in self.backup:
             self.backup[key] = collections.namedtuple('Dimension', ['weight', 'inplace_update'])(weight.to(device=self.offload_device, copy=inplace_update), inplace_update)
 
+        if cache_key is not None:
+            out_weight = cache.get(cache_key)
+            if out_weight is not None:
+                out_weight = out_weight.to(device=weight.device if device_to is None else device_to, copy=True)
+                if inplace_update:
+                    comfy.utils.copy_to_param(self.model, key, out_weight)
+                else:
+                    comfy.utils.set_attr_param(self.model, key, out_weight)
+                return
+
         if device_to is not None:
             temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
         else:
@@ -629,6 +665,8 @@ class ModelPatcher:
         out_weight = comfy.lora.calculate_weight(self.patches[key], temp_weight, key)
         if set_func is None:
             out_weight = comfy.float.stochastic_rounding(out_weight, weight.dtype, seed=string_to_seed(key))
+            if cache_key is not None:
+                cache.put(cache_key, out_weight, list(self.patches[key]))
             if inplace_update:
                 comfy.utils.copy_to_param(self.model, key, out_weight)
             else:
@@ -636,8 +674,37 @@ class ModelPatcher:
         else:
             set_func(out_weight, inplace_update=inplace_update, seed=string_to_seed(key))
 
+    def cast_patch_function(self, key):
+        """Weight function applying the patches of key when its module casts the weight."""
+        weight, set_func, convert_func = get_key_weight(self.model, key)
+        if comfy.lazy_merge.CACHE is not None and set_func is None and convert_func is None:
+            expression = comfy.lazy_merge.expression(self.patches[key], weight)
+            if expression is not None:
+                return comfy.lazy_merge.LazyMergePatch(self.model, key, expression)
+        if comfy.runtime_lora.ENABLED and set_func is None and convert_func is None and key.endswith(".weight"):
+            if all(comfy.weight_adapter.LoRAAdapter.stackable(p) for p in self.patches[key]):
+                if comfy.runtime_lora.supported(comfy.utils.get_attr(self.model, key[:-len(".weight")])):
+                    patch = comfy.runtime_lora.patch(key, self.patches[key], weight)
+                    if patch is not None:
+                        return patch
+        return LowVramPatch(key, self.patches, convert_func, set_func)
+
+    def patched_weight(self, key, device_to=None):
+        """The weight of key with its patches applied, computed from the unpatched model without changing it."""
+        weight = comfy.utils.get_attr(self.model, key)
+        if key not in self.patches:
+            return weight
+        if device_to is not None:
+            temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+        else:
+            temp_weight = weight.to(torch.float32, copy=True)
+        out_weight = comfy.lora.calculate_weight(self.patches[key], temp_weight, key)
+        return comfy.float.stochastic_rounding(out_weight, weight.dtype, seed=string_to_seed(key))
+
     def pin_weight_to_device(self, key):
         weight, set_func, convert_func = get_key_weight(self.model, key)
+        if comfy.shared_weights.is_shared(weight): # registering the shared mapping would make private copies of it
+            return
         if comfy.model_management.pin_memory(weight):
             self.pinned.add(key)
 
@@ -651,6 +718,28 @@ class ModelPatcher:
         for key in list(self.pinned):
             self.unpin_weight(key)
 
+    def latest_execution_order(self):
+        return next(reversed(self.execution_orders.values()), None)
+
+    def pin_offloaded_weights(self, offloaded):
+        if comfy.offload_quantization.LAYOUT is not None:
+            comfy.offload_quantization.quantize_modules(comfy.weight_streaming.offloaded_modules(self._load_list()))
+        pool = comfy.staging_pool.STAGING_POOL
+        if pool is not None:
+            self.unpin_all_weights()
+            if pool.stage(self.model, self._load_list(), self.latest_execution_order()):
+                return
+        for x in offloaded:
+            n = x[1]
+            params = x[3]
+            for param in params:
+                self.pin_weight_to_device("{}.{}".format(n, param))
+
+    def schedule_prefetch(self, order=None):
+        if order is None:
+            order = self.latest_execution_order()
+        return comfy.weight_streaming.schedule(self.model, self._load_list(), order)
+
     def _load_list(self):
         loading = []
         for n, m in self.model.named_modules():
@@ -707,15 +796,13 @@ class ModelPatcher:
                         if force_patch_weights:
                             self.patch_weight_to_device(weight_key)
                         else:
-                            _, set_func, convert_func = get_key_weight(self.model, weight_key)
-                            m.weight_function = [LowVramPatch(weight_key, self.patches, convert_func, set_func)]
+                            m.weight_function = [self.cast_patch_function(weight_key)]
                             patch_counter += 1
                     if bias_key in self.patches:
                         if force_patch_weights:
                             self.patch_weight_to_device(bias_key)
                         else:
-                            _, set_func, convert_func = get_key_weight(self.model, bias_key)
-                            m.bias_function = [LowVramPatch(bias_key, self.patches, convert_func, set_func)]
+                            m.bias_function = [self.cast_patch_function(bias_key)]
                             patch_counter += 1
 
                     cast_weight = True
@@ -723,6 +810,13 @@ class ModelPatcher:
                 else:
                     if hasattr(m, "comfy_cast_weights"):
                         wipe_lowvram_weight(m)
+                        if (comfy.lazy_merge.CACHE is not None or comfy.runtime_lora.ENABLED) and not force_patch_weights:
+                            for key, functions in ((weight_key, "weight_function"), (bias_key, "bias_function")):
+                                if key in self.patches:
+                                    f = self.cast_patch_function(key)
+                                    if not isinstance(f, LowVramPatch): # applied when the module runs instead of patched now
+                                        setattr(m, functions, [f])
+                                        patch_counter += 1
 
                     if full_load or mem_counter + module_mem < lowvram_model_memory:
                         mem_counter += module_mem
@@ -749,9 +843,12 @@ class ModelPatcher:
                     if m.comfy_patched_weights == True:
                         continue
 
+                comfy.offload_quantization.drop_module(m)
                 for param in params:
                     key = "{}.{}".format(n, param)
                     self.unpin_weight(key)
+                    if has_cast_patch(getattr(m, "{}_function".format(param), [])):
+                        continue
                     self.patch_weight_to_device(key, device_to=device_to)
 
                 logging.debug("lowvram: loaded module regularly {} {}".format(n, m))
@@ -760,11 +857,8 @@ class ModelPatcher:
             for x in load_completely:
                 x[2].to(device_to)
 
-            for x in offloaded:
-                n = x[1]
-                params = x[3]
-                for param in params:
-                    self.pin_weight_to_device("{}.{}".format(n, param))
+            self.pin_offloaded_weights(offloaded)
+            self.schedule_prefetch()
 
             if lowvram_counter > 0:
                 logging.info("loaded partially; {:.2f} MB usable, {:.2f} MB loaded, {:.2f} MB offloaded, lowvram patches: {}".format(lowvram_model_memory / (1024 * 1024), mem_counter / (1024 * 1024), lowvram_mem_counter / (1024 * 1024), patch_counter))
@@ -808,7 +902,9 @@ class ModelPatcher:
         if unpatch_weights:
             self.unpatch_hooks()
             self.unpin_all_weights()
+            comfy.weight_streaming.unschedule(self.model)
             if self.model.model_lowvram:
+                comfy.offload_quantization.drop_model(self.model)
                 for m in self.model.modules():
                     move_weight_functions(m, device_to)
                     wipe_lowvram_weight(m)
@@ -816,6 +912,14 @@ class ModelPatcher:
                 self.model.model_lowvram = False
                 self.model.lowvram_patch_counter = 0
 
+            removed = 0
+            if comfy.lazy_merge.CACHE is not None:
+                removed += comfy.lazy_merge.remove_patches(self.model)
+            if comfy.runtime_lora.ENABLED:
+                removed += comfy.runtime_lora.remove_patches(self.model)
+            if removed > 0:
+                self.model.lowvram_patch_counter = 0
+
             keys = list(self.backup.keys())
 
             for k in keys:
@@ -829,6 +933,7 @@ class ModelPatcher:
             self.backup.clear()
 
             if device_to is not None:
+                comfy.shared_weights.reattach(self.model, device_to)
                 self.model.to(device_to)
                 self.model.device = device_to
             self.model.model_loaded_weight_memory = 0
@@ -848,6 +953,7 @@ class ModelPatcher:
             hooks_unpatched = False
             memory_freed = 0
             patch_counter = 0
+            offloaded = []
             unload_list = self._load_list()
             unload_list.sort()
             for unload in unload_list:
@@ -883,22 +989,21 @@ class ModelPatcher:
                     bias_key = "{}.bias".format(n)
                     if move_weight:
                         cast_weight = self.force_cast_weights
+                        comfy.shared_weights.reattach(m, device_to)
                         m.to(device_to)
                         module_mem += move_weight_functions(m, device_to)
                         if lowvram_possible:
-                            if weight_key in self.patches:
+                            if weight_key in self.patches and not has_cast_patch(m.weight_function):
                                 if force_patch_weights:
                                     self.patch_weight_to_device(weight_key)
                                 else:
-                                    _, set_func, convert_func = get_key_weight(self.model, weight_key)
-                                    m.weight_function.append(LowVramPatch(weight_key, self.patches, convert_func, set_func))
+                                    m.weight_function.append(self.cast_patch_function(weight_key))
                                     patch_counter += 1
-                            if bias_key in self.patches:
+                            if bias_key in self.patches and not has_cast_patch(m.bias_function):
                                 if force_patch_weights:
                                     self.patch_weight_to_device(bias_key)
                                 else:
-                                    _, set_func, convert_func = get_key_weight(self.model, bias_key)
-                                    m.bias_function.append(LowVramPatch(bias_key, self.patches, convert_func, set_func))
+                                    m.bias_function.append(self.cast_patch_function(bias_key))
                                     patch_counter += 1
                             cast_weight = True
 
@@ -908,9 +1013,10 @@ class ModelPatcher:
                         m.comfy_patched_weights = False
                         memory_freed += module_mem
                         logging.debug("freed {}".format(n))
+                        offloaded.append(unload)
 
-                        for param in params:
-                            self.pin_weight_to_device("{}.{}".format(n, param))
+            self.pin_offloaded_weights(offloaded)
+            self.schedule_prefetch()
 
             self.model.model_lowvram = True
             self.model.lowvram_patch_counter += patch_counter
@@ -923,7 +1029,10 @@ class ModelPatcher:
             unpatch_weights = self.model.current_weight_patches_uuid is not None and (self.model.current_weight_patches_uuid != self.patches_uuid or force_patch_weights)
             # TODO: force_patch_weights should not unload + reload full model
             used = self.model.model_loaded_weight_memory
-            self.unpatch_model(self.offload_device, unpatch_weights=unpatch_weights)
+            unpatch_device = self.offload_device
+            if unpatch_weights and not force_patch_weights and comfy.runtime_lora.ENABLED and len(self.backup) == 0 and not self.model.model_lowvram:
+                unpatch_device = None # no weight was patched, only the runtime loras are swapped and the weights stay loaded
+            self.unpatch_model(unpatch_device, unpatch_weights=unpatch_weights)
             if unpatch_weights:
                 extra_memory += (used - self.model.model_loaded_weight_memory)
 
@@ -1143,7 +1252,7 @@ class ModelPatcher:
                 registered.add(hook)
         if len(weight_hooks_to_register) > 0:
             # clone hook_patches to become backup so that any non-dynamic hooks will return to their original state
-            self.hook_patches_backup = create_hook_patches_clone(self.hook_patches)
+            self.hook_patches_backup = self.hook_patches.copy()
             for hook in weight_hooks_to_register:
                 hook.add_hook_patches(self, model_options, target_dict, registered)
         for callback in self.get_all_callbacks(CallbacksMP.ON_REGISTER_ALL_HOOK_PATCHES):
@@ -1153,7 +1262,7 @@ class ModelPatcher:
     def add_hook_patches(self, hook: comfy.hooks.WeightHook, patches, strength_patch=1.0, strength_model=1.0):
         with self.use_ejected():
             # NOTE: this mirrors behavior of add_patches func
-            current_hook_patches: dict[str,list] = self.hook_patches.get(hook.hook_ref, {})
+            current_hook_patches: dict[str,list] = self.hook_patches.get(hook.hook_ref, {}).copy()
             p = set()
             model_sd = self.model.state_dict()
             for k in patches:
@@ -1169,9 +1278,7 @@ class ModelPatcher:
 
                 if key in model_sd:
                     p.add(k)
-                    current_patches: list[tuple] = current_hook_patches.get(key, [])
-                    current_patches.append((strength_patch, patches[k], strength_model, offset, function))
-                    current_hook_patches[key] = current_patches
+                    current_hook_patches[key] = current_hook_patches.get(key, []) + [(strength_patch, patches[k], strength_model, offset, function)]
             self.hook_patches[hook.hook_ref] = current_hook_patches
             # since should care about these patches too to determine if same model, reroll patches_uuid
             self.patches_uuid = uuid.uuid4()
@@ -1216,6 +1323,11 @@ class ModelPatcher:
                                                 minimum=comfy.model_management.minimum_inference_memory()*2)
                 # if have cached weights for hooks, use it
                 cached_weights = self.cached_hook_patches.get(hooks, None)
+                cache = comfy.hook_keyframe_cache.CACHE
+                keyframe_state = None
+                if cached_weights is None and cache is not None and self.has_scheduled_weight_hooks(hooks):
+                    keyframe_state = self.hook_keyframe_state(hooks)
+                    cached_weights = cache.get_weights(self.hook_cache_owner(), keyframe_state)
                 if cached_weights is not None:
                     model_sd_keys_set = set(model_sd_keys)
                     for key in cached_weights:
@@ -1231,12 +1343,18 @@ class ModelPatcher:
                     original_weights = None
                     if len(relevant_patches) > 0:
                         original_weights = self.get_key_patches()
+                    keyframe_weights = comfy.hook_keyframe_cache.KeyframeWeights(cache) if keyframe_state is not None else None
                     for key in relevant_patches:
                         if key not in model_sd_keys:
                             logging.warning(f"Cached hook would not patch. Key does not exist in model: {key}")
                             continue
                         self.patch_hook_weight_to_device(hooks=hooks, combined_patches=relevant_patches, key=key, original_weights=original_weights,
-                                                            memory_counter=memory_counter)
+                                                            memory_counter=memory_counter, keyframe_weights=keyframe_weights)
+                    if keyframe_weights is not None and not keyframe_weights.full:
+                        cache.put_weights(self.hook_cache_owner(), keyframe_state, keyframe_weights)
+                    elif keyframe_weights is not None and self.hook_mode == comfy.hooks.EnumHookMode.MaxSpeed:
+                        # the state doesn't fit in the cache, the weights collected before that are kept like the rest
+                        self.cached_hook_patches.setdefault(hooks, {}).update(keyframe_weights)
             else:
                 self.unpatch_hooks()
             self.current_hooks = hooks
@@ -1256,7 +1374,47 @@ class ModelPatcher:
         self.cached_hook_patches.clear()
         self.patch_hooks(None)
 
-    def patch_hook_weight_to_device(self, hooks: comfy.hooks.HookGroup, combined_patches: dict, key: str, original_weights: dict, memory_counter: MemoryCounter):
+    def hook_cache_owner(self):
+        return (self.model.model_weights_uuid, self.patches_uuid)
+
+    def has_scheduled_weight_hooks(self, hooks: comfy.hooks.HookGroup):
+        """If the strength of one of the weight hooks of hooks changes during sampling (it has more than one keyframe)."""
+        return any(len(hook.hook_keyframe.keyframes) > 1 for hook in hooks.get_type(comfy.hooks.EnumHookType.Weight))
+
+    def hook_keyframe_state(self, hooks: comfy.hooks.HookGroup):
+        """What the patched weights of hooks depend on: its weight hooks and their current keyframe strengths."""
+        return tuple((hook.hook_ref, hook.strength) for hook in hooks.get_type(comfy.hooks.EnumHookType.Weight))
+
+    def scaled_hook_weight(self, hooks: comfy.hooks.HookGroup, key: str, weight: torch.Tensor):
+        """
+        The weight patched by the scheduled hooks of hooks computed from their cached weight deltas (see
+        comfy.hook_keyframe_cache), None if one of the hooks patches key with something else than plain LoRAs.
+        """
+        cache = comfy.hook_keyframe_cache.CACHE
+        deltas = []
+        scheduled = False
+        for hook in hooks.get_type(comfy.hooks.EnumHookType.Weight):
+            patches = self.hook_patches.get(hook.hook_ref, {}).get(key, None)
+            if patches is None:
+                continue
+            if not all(comfy.weight_adapter.LoRAAdapter.stackable(p) for p in patches):
+                return None
+            scheduled = scheduled or len(hook.hook_keyframe.keyframes) > 1
+            deltas.append((hook, patches))
+        if not scheduled:
+            return None
+
+        scaled = []
+        for hook, patches in deltas:
+            delta = cache.get_delta(self.hook_cache_owner(), hook.hook_ref, key)
+            if delta is None:
+                delta = comfy.lora.calculate_weight(patches, torch.zeros_like(weight), key)
+                cache.put_delta(self.hook_cache_owner(), hook.hook_ref, key, delta, device=weight.device)
+            scaled.append((hook.strength, delta))
+        return comfy.hook_keyframe_cache.scale_deltas(weight, scaled)
+
+    def patch_hook_weight_to_device(self, hooks: comfy.hooks.HookGroup, combined_patches: dict, key: str, original_weights: dict, memory_counter: MemoryCounter,
+                                    keyframe_weights: comfy.hook_keyframe_cache.KeyframeWeights=None):
         if key not in combined_patches:
             return
 
@@ -1274,16 +1432,22 @@ class ModelPatcher:
         if convert_func is not None:
             temp_weight = convert_func(temp_weight, inplace=True)
 
-        out_weight = comfy.lora.calculate_weight(combined_patches[key],
-                                                 temp_weight,
-                                                 key, original_weights=original_weights)
+        out_weight = None
+        if keyframe_weights is not None:
+            out_weight = self.scaled_hook_weight(hooks, key, temp_weight)
+            comfy.hook_keyframe_cache.CACHE.counts["scaled" if out_weight is not None else "recomputes"] += 1
+        if out_weight is None:
+            out_weight = comfy.lora.calculate_weight(combined_patches[key],
+                                                     temp_weight,
+                                                     key, original_weights=original_weights)
         del original_weights[key]
         if set_func is None:
             out_weight = comfy.float.stochastic_rounding(out_weight, weight.dtype, seed=string_to_seed(key))
             comfy.utils.copy_to_param(self.model, key, out_weight)
         else:
             set_func(out_weight, inplace_update=True, seed=string_to_seed(key))
-        if self.hook_mode == comfy.hooks.EnumHookMode.MaxSpeed:
+        kept = keyframe_weights is not None and keyframe_weights.add(key, out_weight, weight.device)
+        if not kept and self.hook_mode == comfy.hooks.EnumHookMode.MaxSpeed:
             # TODO: disable caching if not enough system RAM to do so
             target_device = self.offload_device
             used = memory_counter.use(weight)
@@ -1316,6 +1480,9 @@ class ModelPatcher:
     def clean_hooks(self):
         self.unpatch_hooks()
         self.clear_cached_hook_weights()
+        if comfy.hook_keyframe_cache.CACHE is not None:
+            comfy.hook_keyframe_cache.CACHE.discard(self.hook_cache_owner())
+            comfy.hook_keyframe_cache.log_counts()
 
     def __del__(self):
         self.unpin_all_weights()
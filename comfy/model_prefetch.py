@@ -0,0 +1,149 @@
+"""
+Host RAM staging for model files.
+
+Files staged here are read from disk ahead of time (on a background thread) so the loader that
+eventually calls comfy.utils.load_torch_file gets the state dict from RAM instead of waiting on the disk.
+A staged state dict is handed over to the first load_torch_file call that asks for it: the loaders are
+free to mutate it, so it is removed from the store when taken.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import psutil
+import torch
+
+# do not stage a file if it would leave less than this much system RAM available
+STAGING_RAM_HEADROOM = 2 * 1024 * 1024 * 1024
+
+
+class StagedFile:
+    def __init__(self, path, stat):
+        self.path = path
+        self.stat = stat
+        self.sd = None
+        self.metadata = None
+        self.size = 0
+        self.ready = threading.Event()
+
+    def matches(self, path, stat):
+        return self.path == path and self.stat == stat
+
+
+def file_stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+class ModelStagingStore:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.staged = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def total_bytes(self):
+        with self.lock:
+            return sum(s.size if s.ready.is_set() else s.stat[0] for s in self.staged.values())
+
+    def is_staged(self, path):
+        with self.lock:
+            return path in self.staged
+
+    def stage(self, path, pin=False):
+        """Read path into host RAM. Returns False if it is already staged or does not fit the budget."""
+        stat = file_stat(path)
+        if stat is None:
+            return False
+        size = stat[0]
+
+        with self.lock:
+            if path in self.staged:
+                return False
+            used = sum(s.size if s.ready.is_set() else s.stat[0] for s in self.staged.values())
+            if used + size > self.max_bytes:
+                return False
+            if psutil.virtual_memory().available - size < STAGING_RAM_HEADROOM:
+                return False
+            entry = StagedFile(path, stat)
+            self.staged[path] = entry
+
+        try:
+            import comfy.utils
+            sd, metadata = comfy.utils.load_torch_file(path, safe_load=True, return_metadata=True, use_staged=False)
+            for k in sd:
+                sd[k] = materialize(sd[k], pin=pin)
+            entry.sd = sd
+            entry.metadata = metadata
+            entry.size = sum(t.nbytes for t in sd.values() if isinstance(t, torch.Tensor))
+            logging.debug("Staged model file {} ({:.1f} MB)".format(path, entry.size / (1024 * 1024)))
+        except Exception as e:
+            logging.warning("Failed to stage model file {}: {}".format(path, e))
+            with self.lock:
+                if self.staged.get(path) is entry:
+                    self.staged.pop(path)
+        finally:
+            entry.ready.set()
+        return entry.sd is not None
+
+    def take(self, path):
+        """Hand over the staged (state_dict, metadata) for path or return None if it isn't staged."""
+        with self.lock:
+            entry = self.staged.get(path, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        entry.ready.wait()
+        with self.lock:
+            if self.staged.get(path) is entry:
+                self.staged.pop(path)
+        if entry.sd is None or not entry.matches(path, file_stat(path)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.sd, entry.metadata
+
+    def retain(self, paths):
+        """Drop every staged file that isn't in paths."""
+        paths = set(paths)
+        with self.lock:
+            for path in list(self.staged.keys()):
+                if path not in paths and self.staged[path].ready.is_set():
+                    self.staged.pop(path)
+
+    def clear(self):
+        self.retain(())
+
+
+def materialize(tensor, pin=False):
+    if not isinstance(tensor, torch.Tensor):
+        return tensor
+    if pin:
+        try:
+            out = torch.empty(tensor.shape, dtype=tensor.dtype, layout=tensor.layout, pin_memory=True)
+            out.copy_(tensor)
+            return out
+        except RuntimeError:
+            pass
+    return tensor.to(device="cpu", copy=True)
+
+
+STAGING_STORE = None
+
+
+def enable_staging(max_bytes):
+    global STAGING_STORE
+    STAGING_STORE = ModelStagingStore(max_bytes)
+    return STAGING_STORE
+
+
+def take_staged(path):
+    if STAGING_STORE is None:
+        return None
+    return STAGING_STORE.take(path)
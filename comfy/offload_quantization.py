@@ -0,0 +1,71 @@
+"""
+Compact transfers of the weights of partially loaded (lowvram) models.
+
+When enabled, a QuantizedTensor copy with a rowwise int8 or fp8 layout (one scale per output channel) is made of the
+weights of the modules a ModelPatcher offloads and cast_bias_weight copies it to the device and dequantizes it there
+instead of the weight, about halving the amount of data copied for each use. The weights themselves are not touched,
+so the model, its clones and what is saved from it keep the original values; the copies are dropped when the module
+is loaded on the device again or the model is unpatched.
+"""
+import logging
+
+import torch
+
+from comfy.quant_ops import QuantizedTensor
+
+LAYOUTS = {
+    "int8": "RowwiseInt8Layout",
+    "fp8": "RowwiseFP8Layout",
+}
+LAYOUT = None # key of LAYOUTS
+MIN_NUMEL = 4096 # smaller weights are not worth it
+
+
+def quantize_modules(modules):
+    """Makes the quantized copies of the weights of the offloaded modules, (name, module, {param name: param}) like comfy.weight_streaming.offloaded_modules()."""
+    if LAYOUT is None:
+        return 0
+    saved = 0
+    for n, m, params in modules:
+        w = params.get("weight", None)
+        if w is None or w.ndim < 2 or w.numel() < MIN_NUMEL or not w.dtype.is_floating_point or w.element_size() < 2:
+            continue
+        current = getattr(m, "comfy_offload_quantized", None)
+        if current is not None and current[0] == (w.data_ptr(), w._version):
+            continue
+        qt = QuantizedTensor.from_float(w.data, LAYOUTS[LAYOUT])
+        m.comfy_offload_quantized = ((w.data_ptr(), w._version), qt)
+        saved += w.nbytes - qt._qdata.nbytes - qt._layout_params["scale"].nbytes
+    if saved > 0:
+        logging.debug("offload quantization: {:.1f} MB less to copy per pass".format(saved / (1024 * 1024)))
+    return saved
+
+
+def quantized_weight(m):
+    """The quantized copy of the weight of m, None if there is none or the weight changed since it was made."""
+    current = getattr(m, "comfy_offload_quantized", None)
+    if current is None:
+        return None
+    w = m.weight
+    if current[0] != (w.data_ptr(), w._version):
+        return None
+    return current[1]
+
+
+def drop_module(m):
+    if hasattr(m, "comfy_offload_quantized"):
+        del m.comfy_offload_quantized
+
+
+def drop_model(model):
+    for m in model.modules():
+        drop_module(m)
+
+
+def enable(layout):
+    global LAYOUT
+    if layout == "fp8" and not hasattr(torch, "float8_e4m3fn"):
+        logging.warning("fp8 offload quantization needs a pytorch version with float8 support, using int8")
+        layout = "int8"
+    LAYOUT = layout
+    logging.info("Storing the weights of offloaded layers as {}".format(layout))
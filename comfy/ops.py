@@ -22,6 +22,10 @@ import comfy.model_management
 from comfy.cli_args import args, PerformanceFeature
 import comfy.float
 import comfy.rmsnorm
+import comfy.lazy_merge
+import comfy.runtime_lora
+import comfy.offload_quantization
+import comfy.weight_streaming
 import contextlib
 
 def run_every_op():
@@ -72,6 +76,22 @@ def cast_to_input(weight, input, non_blocking=False, copy=True):
     return comfy.model_management.cast_to(weight, input.dtype, input.device, non_blocking=non_blocking, copy=copy)
 
 
+def lazy_merged_weight(functions, device, dtype):
+    if len(functions) > 0 and isinstance(functions[0], comfy.lazy_merge.LazyMergePatch):
+        return functions[0].cached(device, dtype)
+    return None
+
+def runtime_lora_patch(functions):
+    if len(functions) > 0 and isinstance(functions[0], comfy.runtime_lora.RuntimeLoraPatch):
+        return functions[0]
+    return None
+
+def apply_runtime_lora(s, input, x):
+    patch = runtime_lora_patch(s.weight_function)
+    if patch is None:
+        return x
+    return patch.forward(s, input, x)
+
 def cast_bias_weight(s, input=None, dtype=None, device=None, bias_dtype=None, offloadable=False):
     # NOTE: offloadable=False is a a legacy and if you are a custom node author reading this please pass
     # offloadable=True and call uncast_bias_weight() after your last usage of the weight/bias. This
@@ -87,6 +107,11 @@ def cast_bias_weight(s, input=None, dtype=None, device=None, bias_dtype=None, of
         if device is None:
             device = input.device
 
+    if offloadable:
+        prefetched = comfy.weight_streaming.fetch(s, device, dtype, bias_dtype)
+        if prefetched is not None:
+            return prefetched[0], prefetched[1], None
+
     if offloadable and (device != s.weight.device or
                         (s.bias is not None and device != s.bias.device)):
         offload_stream = comfy.model_management.get_offload_stream(device)
@@ -100,24 +125,41 @@ def cast_bias_weight(s, input=None, dtype=None, device=None, bias_dtype=None, of
 
     non_blocking = comfy.model_management.device_supports_non_blocking(device)
 
-    weight_has_function = len(s.weight_function) > 0
-    bias_has_function = len(s.bias_function) > 0
-
-    weight = comfy.model_management.cast_to(s.weight, None, device, non_blocking=non_blocking, copy=weight_has_function, stream=offload_stream)
-
+    weight_function = s.weight_function
+    bias_function = s.bias_function
+    weight = lazy_merged_weight(weight_function, device, dtype)
+    if weight is not None or runtime_lora_patch(weight_function) is not None: # runtime loras are applied to the output by the forward of the layer
+        weight_function = weight_function[1:]
     bias = None
     if s.bias is not None:
-        bias = comfy.model_management.cast_to(s.bias, bias_dtype, device, non_blocking=non_blocking, copy=bias_has_function, stream=offload_stream)
+        bias = lazy_merged_weight(bias_function, device, bias_dtype)
+        if bias is not None:
+            bias_function = bias_function[1:]
+    weight_has_function = len(weight_function) > 0
+    bias_has_function = len(bias_function) > 0
+
+    if weight is None:
+        quantized = comfy.offload_quantization.quantized_weight(s)
+        if quantized is not None:
+            weight = comfy.model_management.cast_to(quantized, None, device, non_blocking=non_blocking, stream=offload_stream)
+            with wf_context:
+                weight = weight.dequantize()
+        else:
+            weight = comfy.model_management.cast_to(s.weight, None, device, non_blocking=non_blocking, copy=weight_has_function, stream=offload_stream)
+
+    if s.bias is not None:
+        if bias is None:
+            bias = comfy.model_management.cast_to(s.bias, bias_dtype, device, non_blocking=non_blocking, copy=bias_has_function, stream=offload_stream)
 
         if bias_has_function:
             with wf_context:
-                for f in s.bias_function:
+                for f in bias_function:
                     bias = f(bias)
 
     if weight_has_function or weight.dtype != dtype:
         with wf_context:
             weight = weight.to(dtype=dtype)
-            for f in s.weight_function:
+            for f in weight_function:
                 weight = f(weight)
 
     comfy.model_management.sync_stream(device, offload_stream)
@@ -154,7 +196,7 @@ class disable_weight_init:
             weight, bias, offload_stream = cast_bias_weight(self, input, offloadable=True)
             x = torch.nn.functional.linear(input, weight, bias)
             uncast_bias_weight(self, weight, bias, offload_stream)
-            return x
+            return apply_runtime_lora(self, input, x)
 
         def forward(self, *args, **kwargs):
             run_every_op()
@@ -171,7 +213,7 @@ class disable_weight_init:
             weight, bias, offload_stream = cast_bias_weight(self, input, offloadable=True)
             x = self._conv_forward(input, weight, bias)
             uncast_bias_weight(self, weight, bias, offload_stream)
-            return x
+            return apply_runtime_lora(self, input, x)
 
         def forward(self, *args, **kwargs):
             run_every_op()
@@ -188,7 +230,7 @@ class disable_weight_init:
             weight, bias, offload_stream = cast_bias_weight(self, input, offloadable=True)
             x = self._conv_forward(input, weight, bias)
             uncast_bias_weight(self, weight, bias, offload_stream)
-            return x
+            return apply_runtime_lora(self, input, x)
 
         def forward(self, *args, **kwargs):
             run_every_op()
@@ -214,7 +256,7 @@ class disable_weight_init:
             weight, bias, offload_stream = cast_bias_weight(self, input, offloadable=True)
             x = self._conv_forward(input, weight, bias)
             uncast_bias_weight(self, weight, bias, offload_stream)
-            return x
+            return apply_runtime_lora(self, input, x)
 
         def forward(self, *args, **kwargs):
             run_every_op()
@@ -368,6 +410,8 @@ class disable_weight_init:
             raise ValueError(f"unsupported dimensions: {dims}")
 
 
+comfy.runtime_lora.register(disable_weight_init.Linear, disable_weight_init.Conv1d, disable_weight_init.Conv2d, disable_weight_init.Conv3d)
+
 class manual_cast(disable_weight_init):
     class Linear(disable_weight_init.Linear):
         comfy_cast_weights = True
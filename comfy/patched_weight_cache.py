@@ -0,0 +1,184 @@
+"""
+Bounded cache of merged (patched) weights.
+
+ModelPatcher.patch_weight_to_device recomputes every patched weight (LoRA merges...) each time a model is
+loaded with a patch stack. When the same base weights are loaded again with the same ordered patches and
+strengths the merged weight is taken from here instead, which turns the merge into a copy.
+
+Entries are identified by the base model weights (ModelPatcher.model.model_weights_uuid), the weight key
+and a fingerprint of the patch list. Tensors in the fingerprint are identified by object id, every entry
+holds weak references to them so it doesn't keep the LoRA factors or the weights of merged models alive:
+once one of them is freed the entry is dropped, before its id can be reused by another object.
+Entries live in host RAM and can spill to a directory on disk when RAM budget is exceeded.
+"""
+import atexit
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+
+import torch
+
+
+def fingerprint(obj):
+    if isinstance(obj, torch.Tensor):
+        return ("t", id(obj), obj.dtype, tuple(obj.shape))
+    if isinstance(obj, (list, tuple)):
+        return tuple(fingerprint(x) for x in obj)
+    if isinstance(obj, dict):
+        return tuple((k, fingerprint(v)) for k, v in obj.items())
+    if obj is None or isinstance(obj, (int, float, str, bool)):
+        return obj
+    weights = getattr(obj, "weights", None) # WeightAdapterBase
+    if weights is not None:
+        return (obj.__class__.__name__, id(obj.__class__), fingerprint(weights))
+    return ("o", id(obj))
+
+
+def referenced(obj):
+    """The objects fingerprint identifies by id."""
+    if isinstance(obj, (list, tuple)):
+        for x in obj:
+            yield from referenced(x)
+    elif isinstance(obj, dict):
+        for x in obj.values():
+            yield from referenced(x)
+    elif obj is None or isinstance(obj, (int, float, str, bool)):
+        pass
+    elif not isinstance(obj, torch.Tensor) and getattr(obj, "weights", None) is not None:
+        yield from referenced(obj.weights)
+    else:
+        yield obj
+
+
+class CachedWeight:
+    def __init__(self, weight, patches, on_free=None):
+        self.weight = weight
+        self.path = None
+        self.refs = []
+        self.patches = [] # objects that can't be weakly referenced are kept alive instead
+        for obj in referenced(patches):
+            try:
+                self.refs.append(weakref.ref(obj, on_free))
+            except TypeError:
+                self.patches.append(obj)
+        self.size = weight.nbytes
+
+
+class PatchedWeightCache:
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.ram_bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.freed = [] # keys of the entries whose patches were freed, dropped on the next get/put
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.directory = tempfile.mkdtemp(prefix="patched_weights_", dir=directory) # spilled entries don't outlive the process
+            atexit.register(shutil.rmtree, self.directory, True)
+
+    def cache_key(self, model, key, patches, weight):
+        return (model.model_weights_uuid, key, weight.dtype, tuple(weight.shape), fingerprint(patches))
+
+    def drop_freed(self):
+        while len(self.freed) > 0:
+            entry = self.entries.pop(self.freed.pop(), None)
+            if entry is not None:
+                self.remove_entry(entry)
+
+    def get(self, cache_key):
+        with self.lock:
+            self.drop_freed()
+            entry = self.entries.get(cache_key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(cache_key)
+            self.hits += 1
+            weight = entry.weight
+            path = entry.path
+        if weight is None:
+            try:
+                weight = torch.load(path, weights_only=True)
+            except Exception as e:
+                logging.warning("Could not read cached patched weight {}: {}".format(path, e))
+                self.remove(cache_key)
+                return None
+        return weight
+
+    def put(self, cache_key, weight, patches):
+        weight = weight.detach().to(device="cpu", copy=True)
+        if weight.nbytes > self.max_bytes:
+            return
+        freed = self.freed
+        with self.lock:
+            self.drop_freed()
+            if cache_key in self.entries:
+                return
+            self.entries[cache_key] = CachedWeight(weight, patches, on_free=lambda ref: freed.append(cache_key))
+            self.ram_bytes += weight.nbytes
+            self.shrink()
+
+    def shrink(self):
+        for k in list(self.entries.keys()):
+            if self.ram_bytes <= self.max_bytes:
+                break
+            entry = self.entries[k]
+            if entry.weight is None:
+                continue
+            self.ram_bytes -= entry.size
+            if self.directory is not None and entry.size <= self.max_disk_bytes:
+                entry.path = os.path.join(self.directory, "{}.pt".format(uuid.uuid4().hex))
+                torch.save(entry.weight, entry.path)
+                entry.weight = None
+                self.disk_bytes += entry.size
+            else:
+                self.entries.pop(k)
+
+        if self.directory is not None:
+            for k in list(self.entries.keys()):
+                if self.disk_bytes <= self.max_disk_bytes:
+                    break
+                if self.entries[k].path is not None:
+                    self.remove_entry(self.entries.pop(k))
+
+    def remove_entry(self, entry):
+        if entry.path is not None:
+            self.disk_bytes -= entry.size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+        else:
+            self.ram_bytes -= entry.size
+
+    def remove(self, cache_key):
+        with self.lock:
+            entry = self.entries.pop(cache_key, None)
+            if entry is not None:
+                self.remove_entry(entry)
+
+    def clear(self):
+        with self.lock:
+            for entry in self.entries.values():
+                self.remove_entry(entry)
+            self.entries.clear()
+
+
+PATCHED_WEIGHT_CACHE = None
+
+
+def enable_cache(max_bytes, directory=None, max_disk_bytes=0):
+    global PATCHED_WEIGHT_CACHE
+    PATCHED_WEIGHT_CACHE = PatchedWeightCache(max_bytes, directory=directory, max_disk_bytes=max_disk_bytes)
+    logging.info("Using patched weight cache ({:.0f} MB RAM, {:.0f} MB disk)".format(max_bytes / (1024 * 1024), max_disk_bytes / (1024 * 1024) if directory is not None else 0))
+    return PATCHED_WEIGHT_CACHE
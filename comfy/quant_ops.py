@@ -404,6 +404,57 @@ class TensorCoreFP8Layout(QuantizedLayout):
     def get_plain_tensors(cls, qtensor):
         return qtensor._qdata, qtensor._layout_params['scale']
 
+class RowwiseInt8Layout(QuantizedLayout):
+    """
+    Storage format:
+    - qdata: int8 tensor
+    - scale: float32 tensor with one scale per output channel (first dimension), broadcastable to qdata
+    - orig_dtype: Original dtype before quantization (for casting back)
+    """
+    qdata_dtype = torch.int8
+    qmax = 127
+
+    @classmethod
+    def quantize(cls, tensor, **kwargs):
+        orig_dtype = tensor.dtype
+        tensor = tensor.float()
+        scale = torch.amax(tensor.abs(), dim=tuple(range(1, tensor.ndim)), keepdim=True).clamp(min=1e-12) / cls.qmax
+        qdata = cls.round(tensor / scale).to(cls.qdata_dtype, memory_format=torch.contiguous_format)
+        layout_params = {
+            'scale': scale,
+            'orig_dtype': orig_dtype
+        }
+        return qdata, layout_params
+
+    @classmethod
+    def round(cls, tensor):
+        return torch.round(tensor).clamp_(-cls.qmax, cls.qmax)
+
+    @staticmethod
+    def dequantize(qdata, scale, orig_dtype, **kwargs):
+        plain_tensor = torch.ops.aten._to_copy.default(qdata, dtype=scale.dtype)
+        return (plain_tensor * scale).to(orig_dtype)
+
+    @classmethod
+    def get_plain_tensors(cls, qtensor):
+        return qtensor._qdata, qtensor._layout_params['scale']
+
+
+class RowwiseFP8Layout(RowwiseInt8Layout):
+    """
+    Storage format:
+    - qdata: FP8 tensor (torch.float8_e4m3fn)
+    - scale: float32 tensor with one scale per output channel (first dimension), broadcastable to qdata
+    - orig_dtype: Original dtype before quantization (for casting back)
+    """
+    qdata_dtype = torch.float8_e4m3fn
+    qmax = torch.finfo(torch.float8_e4m3fn).max
+
+    @classmethod
+    def round(cls, tensor):
+        return tensor
+
+
 QUANT_ALGOS = {
     "float8_e4m3fn": {
         "storage_t": torch.float8_e4m3fn,
@@ -414,6 +465,8 @@ QUANT_ALGOS = {
 
 LAYOUTS = {
     "TensorCoreFP8Layout": TensorCoreFP8Layout,
+    "RowwiseInt8Layout": RowwiseInt8Layout,
+    "RowwiseFP8Layout": RowwiseFP8Layout,
 }
 
 
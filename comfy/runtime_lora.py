@@ -0,0 +1,118 @@
+"""
+Runtime (unmerged) LoRAs.
+
+Normally the LoRAs of a model are merged into its weights when it is loaded, so switching to other LoRAs or strengths
+unpatches and repatches every layer they touch. When enabled, the weights whose patches are all plain LoRAs are left
+untouched and a RuntimeLoraPatch is put in the weight_function list of their Linear/Conv layer instead: the layer adds
+up(down(x)) to its output, with the factors of all its LoRAs concatenated along the rank. Loading other LoRAs then
+only uploads their factors. The cost is the two small matmuls per layer and step.
+"""
+import logging
+
+import torch
+
+ENABLED = False
+FORWARDS = set() # forward_comfy_cast_weights of the ops that call RuntimeLoraPatch.forward, see register()
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+    logging.info("Using runtime LoRAs: LoRAs are applied when the layers run instead of merged into the weights")
+
+
+class RuntimeLoraPatch:
+    """
+    The stacked factors of the LoRAs of a weight. Calling it returns the weight unchanged, the LoRAs are applied to the
+    output of the layer by forward().
+    """
+    def __init__(self, key, up, down):
+        self.key = key
+        self.up = up
+        self.down = down
+        self.cast = {}
+
+    def move_to(self, device=None):
+        if device is None:
+            return 0
+        self.up = self.up.to(device)
+        self.down = self.down.to(device)
+        self.cast = {}
+        return self.up.nbytes + self.down.nbytes
+
+    def factors(self, device, dtype):
+        key = (device, dtype)
+        out = self.cast.get(key, None)
+        if out is None:
+            out = (self.up.to(device=device, dtype=dtype), self.down.to(device=device, dtype=dtype))
+            self.cast[key] = out
+        return out
+
+    def forward(self, module, input, output):
+        up, down = self.factors(output.device, output.dtype)
+        input = input.to(output.dtype)
+        if isinstance(module, torch.nn.Linear):
+            return output + torch.nn.functional.linear(torch.nn.functional.linear(input, down), up)
+        conv = (torch.nn.functional.conv1d, torch.nn.functional.conv2d, torch.nn.functional.conv3d)[down.ndim - 3]
+        return output + conv(conv(input, down, None, module.stride, module.padding, module.dilation), up)
+
+    def __call__(self, weight):
+        return weight
+
+
+def register(*ops):
+    """Ops classes whose forward_comfy_cast_weights applies the patch, subclasses overriding it don't."""
+    for op in ops:
+        FORWARDS.add(op.forward_comfy_cast_weights)
+
+
+def supported(module):
+    """If the LoRAs of the weight of module can be applied by its forward: grouped convs and convs padded with other modes than zeros can't."""
+    if getattr(type(module), "forward_comfy_cast_weights", None) not in FORWARDS:
+        return False
+    if isinstance(module, torch.nn.Linear):
+        return True
+    if isinstance(module, (torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Conv3d)):
+        return module.groups == 1 and module.padding_mode == "zeros"
+    return False
+
+
+def patch(key, patches, weight):
+    """The RuntimeLoraPatch applying patches, plain LoRAs (see LoRAAdapter.stackable), to weight, None if they don't match it."""
+    out_dim = weight.shape[0]
+    ups = []
+    downs = []
+    for strength, v, _, _, _ in patches:
+        up, down, alpha = v.weights[:3]
+        rank = down.shape[0]
+        if up.numel() != out_dim * rank or down.numel() != rank * weight.shape[1:].numel():
+            return None
+        if strength == 0.0:
+            continue
+        scale = strength * (alpha / rank if alpha is not None else 1.0)
+        ups.append(up.reshape(out_dim, rank).float() * scale)
+        downs.append(down.reshape((rank,) + tuple(weight.shape[1:])).float())
+    if len(ups) == 0:
+        up = torch.zeros((out_dim, 1))
+        down = torch.zeros((1,) + tuple(weight.shape[1:]))
+    else:
+        up = torch.cat(ups, dim=1)
+        down = torch.cat(downs, dim=0)
+    up = up.reshape(up.shape + (1,) * (weight.ndim - 2))
+    return RuntimeLoraPatch(key, up, down)
+
+
+def has_patch(functions):
+    return any(isinstance(f, RuntimeLoraPatch) for f in functions)
+
+
+def remove_patches(model):
+    """Removes the RuntimeLoraPatch weight functions from the modules of model, returns how many there were."""
+    removed = 0
+    for m in model.modules():
+        functions = getattr(m, "weight_function", None)
+        if functions is not None and has_patch(functions):
+            kept = [f for f in functions if not isinstance(f, RuntimeLoraPatch)]
+            removed += len(functions) - len(kept)
+            m.weight_function = kept
+    return removed
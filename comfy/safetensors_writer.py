@@ -0,0 +1,146 @@
+"""
+Incremental safetensors writer.
+
+The header is computed from the shapes and dtypes of the tensors before any data is written, after that tensors can
+be written one at a time in any order (from several threads) to their place in the file, so the whole state dict
+never has to be in memory. Tensors that are never written are left zeroed.
+
+With enable_fsync() a background thread flushes the file to disk every few hundred MB written, so that a large save
+doesn't build up gigabytes of dirty pages, and the file is on disk when close() returns.
+"""
+import json
+import os
+import struct
+import threading
+
+import torch
+
+DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+if hasattr(torch, "float8_e4m3fn"):
+    DTYPES[torch.float8_e4m3fn] = "F8_E4M3"
+    DTYPES[torch.float8_e5m2] = "F8_E5M2"
+
+FSYNC_BYTES = 0 # flush the file every that many bytes written, 0 to disable
+
+
+def enable_fsync(nbytes):
+    global FSYNC_BYTES
+    FSYNC_BYTES = nbytes
+
+
+def tensor_nbytes(shape, dtype):
+    n = 1
+    for s in shape:
+        n *= s
+    return n * dtype.itemsize
+
+
+class SafetensorsWriter:
+    """Writes the tensors {name: (shape, dtype)} to path, the file is only moved into place by close()."""
+    def __init__(self, path, tensors, metadata=None, fsync_bytes=None):
+        self.path = path
+        self.tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        self.tensors = {}
+        header = {}
+        if metadata is not None:
+            header["__metadata__"] = metadata
+        offset = 0
+        for name, (shape, dtype) in tensors.items():
+            shape = tuple(shape)
+            nbytes = tensor_nbytes(shape, dtype)
+            header[name] = {"dtype": DTYPES[dtype], "shape": list(shape), "data_offsets": [offset, offset + nbytes]}
+            self.tensors[name] = (shape, dtype, offset)
+            offset += nbytes
+
+        header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        header += b" " * (-len(header) % 8)
+        self.data_start = 8 + len(header)
+        self.size = self.data_start + offset
+        self.lock = threading.Lock()
+        self.written = set()
+        self.fsync_bytes = FSYNC_BYTES if fsync_bytes is None else fsync_bytes
+        self.unsynced = 0
+        self.sync_thread = None
+        self.file = open(self.tmp_path, "wb")
+        try:
+            self.file.write(struct.pack("<Q", len(header)))
+            self.file.write(header)
+            self.file.truncate(self.size)
+        except BaseException:
+            self.abort()
+            raise
+        if self.fsync_bytes > 0:
+            self.sync_event = threading.Event()
+            self.closing = False
+            self.sync_thread = threading.Thread(target=self.sync_loop, daemon=True)
+            self.sync_thread.start()
+
+    def sync_loop(self):
+        while True:
+            self.sync_event.wait()
+            self.sync_event.clear()
+            if self.closing:
+                return
+            with self.lock:
+                self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def stop_sync(self):
+        if self.sync_thread is not None:
+            self.closing = True
+            self.sync_event.set()
+            self.sync_thread.join()
+            self.sync_thread = None
+
+    def write(self, name, tensor):
+        shape, dtype, offset = self.tensors[name]
+        if tuple(tensor.shape) != shape or tensor.dtype != dtype:
+            raise ValueError("{}: expected {} {} but got {} {}".format(name, shape, dtype, tuple(tensor.shape), tensor.dtype))
+        data = tensor.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8).numpy()
+        with self.lock:
+            self.file.seek(self.data_start + offset)
+            self.file.write(memoryview(data))
+            self.written.add(name)
+            self.unsynced += data.nbytes
+            if self.sync_thread is not None and self.unsynced >= self.fsync_bytes:
+                self.unsynced = 0
+                self.sync_event.set()
+
+    __setitem__ = write
+
+    def missing(self):
+        return [n for n in self.tensors if n not in self.written]
+
+    def close(self):
+        self.stop_sync()
+        if self.fsync_bytes > 0:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.stop_sync()
+        self.file.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
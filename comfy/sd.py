@@ -23,8 +23,12 @@ import comfy.pixel_space_convert
 import yaml
 import math
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import comfy.utils
+import comfy.safetensors_writer
+import comfy.shared_weights
+import comfy.text_encoder_cache
 
 from . import clip_vision
 from . import gligen
@@ -62,12 +66,18 @@ import comfy.taesd.taesd
 
 import comfy.ldm.flux.redux
 
-def load_lora_for_models(model, clip, lora, strength_model, strength_clip):
+def lora_key_map(model, clip):
     key_map = {}
     if model is not None:
         key_map = comfy.lora.model_lora_keys_unet(model.model, key_map)
     if clip is not None:
         key_map = comfy.lora.model_lora_keys_clip(clip.cond_stage_model, key_map)
+    return key_map
+
+
+def load_lora_for_models(model, clip, lora, strength_model, strength_clip, key_map=None):
+    if key_map is None:
+        key_map = lora_key_map(model, clip)
 
     lora = comfy.lora_convert.convert_lora(lora)
     loaded = comfy.lora.load_lora(lora, key_map)
@@ -93,6 +103,22 @@ def load_lora_for_models(model, clip, lora, strength_model, strength_clip):
     return (new_modelpatcher, new_clip)
 
 
+def load_lora_file_for_models(model, clip, lora_file, strength_model, strength_clip, loaded=None):
+    """
+    load_lora_for_models for a comfy.lora_index.LoraFile that only reads the tensors of the layers model and clip have.
+    loaded is a dict of the tensors of the file that were already read, the tensors read are added to it.
+    """
+    to_load, names = lora_file.match(lora_key_map(model, clip))
+    if loaded is None:
+        loaded = {}
+    loaded.update(lora_file.load([n for n in names if n not in loaded]))
+    used = set(names)
+    for x in lora_file.shapes:
+        if x not in used:
+            logging.warning("lora key not loaded: {}".format(x))
+    return load_lora_for_models(model, clip, {n: loaded[n] for n in names}, strength_model, strength_clip, key_map=to_load)
+
+
 class CLIP:
     def __init__(self, target=None, embedding_directory=None, no_init=False, tokenizer_data={}, parameters=0, model_options={}):
         if no_init:
@@ -235,20 +261,33 @@ class CLIP:
         if return_pooled == "unprojected":
             self.cond_stage_model.set_clip_options({"projected_pooled": False})
 
-        self.load_model()
-        o = self.cond_stage_model.encode_token_weights(tokens)
-        cond, pooled = o[:2]
-        if return_dict:
+        cache = comfy.text_encoder_cache.TEXT_ENCODER_CACHE
+        cache_key = None
+        out = None
+        if cache is not None:
+            cache_key = cache.cache_key(self, tokens, return_pooled)
+            if cache_key is not None:
+                out = cache.get(*cache_key)
+
+        if out is None:
+            self.load_model()
+            o = self.cond_stage_model.encode_token_weights(tokens)
+            cond, pooled = o[:2]
             out = {"cond": cond, "pooled_output": pooled}
             if len(o) > 2:
                 for k in o[2]:
                     out[k] = o[2][k]
+            if cache_key is not None:
+                cache.put(cache_key[0], out, cache_key[1])
+
+        if return_dict:
+            out = out.copy()
             self.add_hooks_to_dict(out)
             return out
 
         if return_pooled:
-            return cond, pooled
-        return cond
+            return out["cond"], out["pooled_output"]
+        return out["cond"]
 
     def encode(self, text):
         tokens = self.tokenize(text)
@@ -580,7 +619,7 @@ class VAE:
             self.first_stage_model = AutoencoderKL(**(config['params']))
         self.first_stage_model = self.first_stage_model.eval()
 
-        m, u = self.first_stage_model.load_state_dict(sd, strict=False)
+        m, u = comfy.shared_weights.load_state_dict(self.first_stage_model, sd, strict=False)
         if len(m) > 0:
             logging.warning("Missing VAE keys {}".format(m))
 
@@ -635,10 +674,11 @@ class VAE:
         pbar = comfy.utils.ProgressBar(steps)
 
         decode_fn = lambda a: self.first_stage_model.decode(a.to(self.vae_dtype).to(self.device)).float()
+        workers = model_management.tile_workers(self.device)
         output = self.process_output(
-            (comfy.utils.tiled_scale(samples, decode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = self.upscale_ratio, output_device=self.output_device, pbar = pbar) +
-            comfy.utils.tiled_scale(samples, decode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = self.upscale_ratio, output_device=self.output_device, pbar = pbar) +
-             comfy.utils.tiled_scale(samples, decode_fn, tile_x, tile_y, overlap, upscale_amount = self.upscale_ratio, output_device=self.output_device, pbar = pbar))
+            (comfy.utils.tiled_scale(samples, decode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = self.upscale_ratio, output_device=self.output_device, pbar = pbar, workers=workers) +
+            comfy.utils.tiled_scale(samples, decode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = self.upscale_ratio, output_device=self.output_device, pbar = pbar, workers=workers) +
+             comfy.utils.tiled_scale(samples, decode_fn, tile_x, tile_y, overlap, upscale_amount = self.upscale_ratio, output_device=self.output_device, pbar = pbar, workers=workers))
             / 3.0)
         return output
 
@@ -663,9 +703,10 @@ class VAE:
         pbar = comfy.utils.ProgressBar(steps)
 
         encode_fn = lambda a: self.first_stage_model.encode((self.process_input(a)).to(self.vae_dtype).to(self.device)).float()
-        samples = comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x, tile_y, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar)
-        samples += comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar)
-        samples += comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar)
+        workers = model_management.tile_workers(self.device)
+        samples = comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x, tile_y, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar, workers=workers)
+        samples += comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar, workers=workers)
+        samples += comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar, workers=workers)
         samples /= 3.0
         return samples
 
@@ -692,8 +733,60 @@ class VAE:
         encode_fn = lambda a: self.first_stage_model.encode((self.process_input(a)).to(self.vae_dtype).to(self.device)).float()
         return comfy.utils.tiled_scale_multidim(samples, encode_fn, tile=(tile_t, tile_x, tile_y), overlap=overlap, upscale_amount=self.downscale_ratio, out_channels=self.latent_channels, downscale=True, index_formulas=self.downscale_index_formula, output_device=self.output_device)
 
+    def decode_pipelined(self, samples_in, batch_number, vae_options={}, pin_output=True):
+        """
+        Batch decode where the host transfer and float conversion of a chunk overlap with the decode of the
+        next one: on a side stream on cuda/xpu, on a worker thread otherwise. Chunks are written directly in a
+        preallocated output, pinned when possible so device to host copies are asynchronous.
+        """
+        pixel_samples = None
+        compute_stream = model_management.current_stream(self.device)
+        if compute_stream is not None:
+            copy_stream = torch.cuda.Stream(device=self.device) if model_management.is_device_cuda(self.device) else torch.xpu.Stream(device=self.device)
+            pin_output = pin_output and model_management.MAX_PINNED_MEMORY > 0 and model_management.is_device_cpu(self.output_device)
+            for x in range(0, samples_in.shape[0], batch_number):
+                samples = samples_in[x:x+batch_number].to(self.vae_dtype).to(self.device)
+                out = self.process_output(self.first_stage_model.decode(samples, **vae_options).float())
+                if pixel_samples is None:
+                    pixel_samples = torch.empty((samples_in.shape[0],) + tuple(out.shape[1:]), device=self.output_device, pin_memory=pin_output)
+                copy_stream.wait_stream(compute_stream)
+                with torch.cuda.stream(copy_stream) if model_management.is_device_cuda(self.device) else torch.xpu.stream(copy_stream):
+                    pixel_samples[x:x+batch_number].copy_(out, non_blocking=pin_output)
+                out.record_stream(copy_stream)
+            compute_stream.wait_stream(copy_stream)
+            copy_stream.synchronize()
+            return pixel_samples
+
+        inference_mode = torch.is_inference_mode_enabled() # not inherited by the worker thread
+
+        def write(x, out):
+            with torch.inference_mode(inference_mode):
+                pixel_samples[x:x+out.shape[0]] = self.process_output(out.to(self.output_device).float())
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = None
+            for x in range(0, samples_in.shape[0], batch_number):
+                samples = samples_in[x:x+batch_number].to(self.vae_dtype).to(self.device)
+                out = self.first_stage_model.decode(samples, **vae_options)
+                if pending is not None:
+                    pending.result() # at most one chunk waits for conversion
+                if pixel_samples is None:
+                    pixel_samples = torch.empty((samples_in.shape[0],) + tuple(out.shape[1:]), device=self.output_device)
+                pending = executor.submit(write, x, out)
+            if pending is not None:
+                pending.result()
+        return pixel_samples
+
     def decode(self, samples_in, vae_options={}):
+        """
+        vae_options are passed to the model decode function except for:
+        pipelined: overlap the host transfer of each batch chunk with the decode of the next one.
+        pin_output: with pipelined, decode into pinned memory (default True).
+        """
         self.throw_exception_if_invalid()
+        vae_options = vae_options.copy()
+        pipelined = vae_options.pop("pipelined", False)
+        pin_output = vae_options.pop("pin_output", True)
         pixel_samples = None
         do_tile = False
         try:
@@ -703,12 +796,15 @@ class VAE:
             batch_number = int(free_memory / memory_used)
             batch_number = max(1, batch_number)
 
-            for x in range(0, samples_in.shape[0], batch_number):
-                samples = samples_in[x:x+batch_number].to(self.vae_dtype).to(self.device)
-                out = self.process_output(self.first_stage_model.decode(samples, **vae_options).to(self.output_device).float())
-                if pixel_samples is None:
-                    pixel_samples = torch.empty((samples_in.shape[0],) + tuple(out.shape[1:]), device=self.output_device)
-                pixel_samples[x:x+batch_number] = out
+            if pipelined:
+                pixel_samples = self.decode_pipelined(samples_in, batch_number, vae_options, pin_output=pin_output)
+            else:
+                for x in range(0, samples_in.shape[0], batch_number):
+                    samples = samples_in[x:x+batch_number].to(self.vae_dtype).to(self.device)
+                    out = self.process_output(self.first_stage_model.decode(samples, **vae_options).to(self.output_device).float())
+                    if pixel_samples is None:
+                        pixel_samples = torch.empty((samples_in.shape[0],) + tuple(out.shape[1:]), device=self.output_device)
+                    pixel_samples[x:x+batch_number] = out
         except model_management.OOM_EXCEPTION:
             logging.warning("Warning: Ran out of memory when regular VAE decoding, retrying with tiled VAE decoding.")
             #NOTE: We don't know what tensors were allocated to stack variables at the time of the
@@ -918,7 +1014,9 @@ def load_clip(ckpt_paths, embedding_directory=None, clip_type=CLIPType.STABLE_DI
     clip_data = []
     for p in ckpt_paths:
         clip_data.append(comfy.utils.load_torch_file(p, safe_load=True))
-    return load_text_encoder_state_dicts(clip_data, embedding_directory=embedding_directory, clip_type=clip_type, model_options=model_options)
+    clip = load_text_encoder_state_dicts(clip_data, embedding_directory=embedding_directory, clip_type=clip_type, model_options=model_options)
+    clip.patcher.model.model_source_paths = list(ckpt_paths) # identifies the weights for the text encoder cache
+    return clip
 
 
 class TEModel(Enum):
@@ -1197,8 +1295,16 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
     out = load_state_dict_guess_config(sd, output_vae, output_clip, output_clipvision, embedding_directory, output_model, model_options, te_model_options=te_model_options, metadata=metadata)
     if out is None:
         raise RuntimeError("ERROR: Could not detect model type of: {}\n{}".format(ckpt_path, model_detection_error_hint(ckpt_path, sd)))
+    set_model_source_path(ckpt_path, *out)
     return out
 
+def set_model_source_path(path, *models):
+    """Remember which file the models were loaded from, shared by all the clones of their ModelPatcher."""
+    for m in models:
+        patcher = getattr(m, "patcher", m)
+        if isinstance(patcher, comfy.model_patcher.ModelPatcher):
+            patcher.model.model_source_path = path
+
 def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, model_options={}, te_model_options={}, metadata=None):
     clip = None
     clipvision = None
@@ -1230,7 +1336,10 @@ def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_c
     if unet_dtype is None:
         unet_dtype = model_management.unet_dtype(model_params=parameters, supported_dtypes=unet_weight_dtype, weight_dtype=weight_dtype)
 
-    manual_cast_dtype = model_management.unet_manual_cast(unet_dtype, load_device, model_config.supported_inference_dtypes)
+    if model_config.layer_quant_config is not None:
+        manual_cast_dtype = model_management.unet_manual_cast(None, load_device, model_config.supported_inference_dtypes)
+    else:
+        manual_cast_dtype = model_management.unet_manual_cast(unet_dtype, load_device, model_config.supported_inference_dtypes)
     model_config.set_inference_dtype(unet_dtype, manual_cast_dtype)
 
     if model_config.clip_vision_prefix is not None:
@@ -1372,6 +1481,7 @@ def load_diffusion_model(unet_path, model_options={}):
     if model is None:
         logging.error("ERROR UNSUPPORTED DIFFUSION MODEL {}".format(unet_path))
         raise RuntimeError("ERROR: Could not detect model type of: {}\n{}".format(unet_path, model_detection_error_hint(unet_path, sd)))
+    set_model_source_path(unet_path, model)
     return model
 
 def load_unet(unet_path, dtype=None):
@@ -1382,25 +1492,93 @@ def load_unet_state_dict(sd, dtype=None):
     logging.warning("The load_unet_state_dict function has been deprecated and will be removed please switch to: load_diffusion_model_state_dict")
     return load_diffusion_model_state_dict(sd, model_options={"dtype": dtype})
 
-def save_checkpoint(output_path, model, clip=None, vae=None, clip_vision=None, metadata=None, extra_keys={}):
-    clip_sd = None
-    load_models = [model]
+def checkpoint_state_dict(model, clip=None, vae=None, clip_vision=None):
+    """
+    The checkpoint state dict of the models as (sd, lazy) from lazy_patched_state_dict: the weight patches of model and
+    clip aren't applied to the whole models first, save_state_dict(sd, path, lazy=lazy) patches the weights as it
+    writes them.
+    """
+    patchers = [model]
     if clip is not None:
-        load_models.append(clip.load_model())
-        clip_sd = clip.get_sd()
-    vae_sd = None
-    if vae is not None:
-        vae_sd = vae.get_sd()
-
-    model_management.load_models_gpu(load_models, force_patch_weights=True)
-    clip_vision_sd = clip_vision.get_sd() if clip_vision is not None else None
-    sd = model.model.state_dict_for_saving(clip_sd, vae_sd, clip_vision_sd)
-    for k in extra_keys:
-        sd[k] = extra_keys[k]
+        patchers.append(clip.patcher)
+
+    def get_sd():
+        clip_sd = clip.get_sd() if clip is not None else None
+        vae_sd = vae.get_sd() if vae is not None else None
+        clip_vision_sd = clip_vision.get_sd() if clip_vision is not None else None
+        return model.model.state_dict_for_saving(clip_sd, vae_sd, clip_vision_sd)
+
+    return lazy_patched_state_dict(patchers, get_sd)
 
-    for k in sd:
-        t = sd[k]
-        if not t.is_contiguous():
-            sd[k] = t.contiguous()
+def tensor_storage_key(t):
+    if type(t) is not torch.Tensor and type(t) is not torch.nn.Parameter:
+        return None
+    if t.numel() == 0:
+        return None
+    return (t.data_ptr(), t.dtype, tuple(t.shape))
 
-    comfy.utils.save_torch_file(sd, output_path, metadata=metadata)
+def lazy_patched_state_dict(patchers, get_sd):
+    """
+    Builds the state dict get_sd() of the models of patchers without applying their weight patches first. Returns
+    (sd, lazy) where lazy {sd key: (patcher, weight key)} are the entries holding unpatched weights, to be replaced by
+    patcher.patched_weight(weight key) when saved. A patcher with weights that can't be patched one at a time
+    (quantized weights, or weights transformed by get_sd()) is loaded with its patches applied instead.
+    """
+    lazy_patchers = []
+    force_patch = []
+    for p in patchers:
+        if p.model.current_weight_patches_uuid == p.patches_uuid and not p.model.model_lowvram and p.model.lowvram_patch_counter == 0:
+            continue # loaded with its patches applied
+        model_management.unload_model_clones(p)
+        if len(p.patches) == 0:
+            continue
+        if any(comfy.model_patcher.get_key_weight(p.model, k)[1:] != (None, None) for k in p.patches):
+            force_patch.append(p)
+        else:
+            lazy_patchers.append(p)
+
+    while True:
+        if len(force_patch) > 0:
+            model_management.load_models_gpu(force_patch, force_patch_weights=True)
+        sd = get_sd()
+        weights = {}
+        for p in lazy_patchers:
+            for k in p.patches:
+                weights[tensor_storage_key(comfy.utils.get_attr(p.model, k))] = (p, k)
+        lazy = {}
+        for k, t in sd.items():
+            w = weights.get(tensor_storage_key(t), None)
+            if w is not None:
+                lazy[k] = w
+
+        saved = set(lazy.values())
+        unmatched = [p for p in lazy_patchers if any((p, k) not in saved for k in p.patches)]
+        if len(unmatched) == 0:
+            return sd, lazy
+        lazy_patchers = [p for p in lazy_patchers if p not in unmatched]
+        force_patch += unmatched
+
+def save_state_dict(sd, output_path, metadata=None, lazy={}):
+    """Streams sd to a safetensors file one tensor at a time, patching the entries of lazy (see lazy_patched_state_dict) as they are written."""
+    metadata = dict(metadata) if metadata is not None else {}
+    entries = {}
+    for k, t in sd.items():
+        if k.endswith("_quantization_metadata") and not torch.is_tensor(t): # read from the file metadata by model_detection.detect_layer_quantization
+            metadata["_quantization_metadata"] = json.dumps(t)
+            continue
+        entries[k] = (t.shape, t.dtype)
+
+    with comfy.safetensors_writer.SafetensorsWriter(output_path, entries, metadata=metadata if len(metadata) > 0 else None) as writer:
+        for k in entries:
+            w = lazy.get(k, None)
+            if w is not None:
+                patcher, key = w
+                writer[k] = patcher.patched_weight(key, device_to=patcher.load_device)
+            else:
+                writer[k] = sd[k]
+
+def save_checkpoint(output_path, model, clip=None, vae=None, clip_vision=None, metadata=None, extra_keys={}):
+    sd, lazy = checkpoint_state_dict(model, clip=clip, vae=vae, clip_vision=clip_vision)
+    for k in extra_keys:
+        sd[k] = extra_keys[k]
+    save_state_dict(sd, output_path, metadata=metadata, lazy=lazy)
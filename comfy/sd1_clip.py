@@ -1,6 +1,6 @@
 import os
 
-from transformers import CLIPTokenizer
+from transformers import CLIPTokenizer, PreTrainedTokenizerBase
 import comfy.ops
 import torch
 import traceback
@@ -11,6 +11,9 @@ import json
 import logging
 import numbers
 import re
+import functools
+import threading
+from collections import OrderedDict
 
 def gen_empty_tokens(special_tokens, length):
     start_token = special_tokens.get("start", None)
@@ -341,6 +344,11 @@ def token_weights(string, current_weight):
             out += [(x, current_weight)]
     return out
 
+@functools.lru_cache(maxsize=4096)
+def parse_prompt_weights(text):
+    """Memoised token_weights(text, 1.0), text is already escaped."""
+    return tuple(token_weights(text, 1.0))
+
 def escape_important(text):
     text = text.replace("\\)", "\0\1")
     text = text.replace("\\(", "\0\2")
@@ -388,14 +396,37 @@ def bundled_embed(embed, prefix, suffix): #bundled embedding in lora format
 
     return torch.cat(out_list, dim=0)
 
-def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=None):
-    if isinstance(embedding_directory, str):
-        embedding_directory = [embedding_directory]
-
-    embedding_directory = expand_directory_list(embedding_directory)
+EMBEDDING_DIRECTORIES = {} # tuple of embedding directories -> (mtimes, expanded directories, resolved embedding names)
+EMBEDDING_DIRECTORIES_LOCK = threading.Lock()
 
+def directory_mtimes(directories):
+    out = []
+    for d in directories:
+        try:
+            out.append(os.stat(d).st_mtime_ns)
+        except OSError:
+            out.append(None)
+    return tuple(out)
+
+def embedding_directory_cache(embedding_directory):
+    """
+    Returns (expanded directory list, resolved names dict) for embedding_directory. The os.walk of the
+    directories and the name resolutions are cached until a file or folder is added or removed in any of them.
+    """
+    key = tuple(embedding_directory)
+    with EMBEDDING_DIRECTORIES_LOCK:
+        cached = EMBEDDING_DIRECTORIES.get(key, None)
+    if cached is not None and directory_mtimes(cached[1]) == cached[0]:
+        return cached[1], cached[2]
+    expanded = expand_directory_list(embedding_directory)
+    cached = (directory_mtimes(expanded), expanded, {})
+    with EMBEDDING_DIRECTORIES_LOCK:
+        EMBEDDING_DIRECTORIES[key] = cached
+    return cached[1], cached[2]
+
+def resolve_embedding_path(embedding_name, embedding_directories):
     valid_file = None
-    for embed_dir in embedding_directory:
+    for embed_dir in embedding_directories:
         embed_path = os.path.abspath(os.path.join(embed_dir, embedding_name))
         embed_dir = os.path.abspath(embed_dir)
         try:
@@ -414,12 +445,10 @@ def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=No
             valid_file = embed_path
         if valid_file is not None:
             break
+    return valid_file
 
-    if valid_file is None:
-        return None
-
-    embed_path = valid_file
-
+@functools.lru_cache(maxsize=256)
+def load_embed_file(embed_path, mtime, embedding_name, embedding_size, embed_key):
     embed_out = None
 
     try:
@@ -459,6 +488,27 @@ def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=No
                 embed_out = next(iter(values))
     return embed_out
 
+def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=None):
+    if isinstance(embedding_directory, str):
+        embedding_directory = [embedding_directory]
+
+    embedding_directory, resolved = embedding_directory_cache(embedding_directory)
+    if embedding_name in resolved:
+        valid_file = resolved[embedding_name]
+    else:
+        valid_file = resolve_embedding_path(embedding_name, embedding_directory)
+        resolved[embedding_name] = valid_file
+
+    if valid_file is None:
+        return None
+
+    try:
+        mtime = os.stat(valid_file).st_mtime_ns
+    except OSError:
+        resolved.pop(embedding_name, None)
+        return None
+    return load_embed_file(valid_file, mtime, embedding_name, embedding_size, embed_key)
+
 class SDTokenizer:
     def __init__(self, tokenizer_path=None, max_length=77, pad_with_end=True, embedding_directory=None, embedding_size=768, embedding_key='clip_l', tokenizer_class=CLIPTokenizer, has_start_token=True, has_end_token=True, pad_to_max_length=True, min_length=None, pad_token=None, end_token=None, min_padding=None, pad_left=False, tokenizer_data={}, tokenizer_args={}):
         if tokenizer_path is None:
@@ -506,6 +556,38 @@ class SDTokenizer:
         self.embedding_identifier = "embedding:"
         self.embedding_size = embedding_size
         self.embedding_key = embedding_key
+        self.memoize = True
+        self.word_cache = OrderedDict() # text segment -> token ids
+        self.word_cache_size = 16384
+
+    def tokenize_words(self, words):
+        '''
+        Token ids (without start and end tokens) of every text segment in words, memoised per segment.
+        Segments missing from the cache are tokenized in a single tokenizer call.
+        '''
+        end = 999999999999
+        if self.tokenizer_adds_end_token:
+            end = -1
+
+        if not self.memoize:
+            return [self.tokenizer(word)["input_ids"][self.tokens_start:end] for word in words]
+
+        missing = list(dict.fromkeys(w for w in words if w not in self.word_cache))
+        if len(missing) > 0:
+            if len(missing) > 1 and isinstance(self.tokenizer, PreTrainedTokenizerBase):
+                ids = self.tokenizer(missing)["input_ids"]
+            else:
+                ids = [self.tokenizer(word)["input_ids"] for word in missing]
+            for word, word_ids in zip(missing, ids):
+                self.word_cache[word] = tuple(word_ids[self.tokens_start:end])
+
+        out = []
+        for word in words:
+            out.append(self.word_cache[word])
+            self.word_cache.move_to_end(word)
+        while len(self.word_cache) > self.word_cache_size:
+            self.word_cache.popitem(last=False)
+        return out
 
     def _try_get_embedding(self, embedding_name:str):
         '''
@@ -543,11 +625,14 @@ class SDTokenizer:
         text = escape_important(text)
         if kwargs.get("disable_weights", False):
             parsed_weights = [(text, 1.0)]
+        elif self.memoize:
+            parsed_weights = parse_prompt_weights(text)
         else:
             parsed_weights = token_weights(text, 1.0)
 
-        # tokenize words
+        # tokenize words, the text of each word is tokenized in one batch below
         tokens = []
+        words = []
         for weighted_segment, weight in parsed_weights:
             to_tokenize = unescape_important(weighted_segment)
             split = re.split(' {0}|\n{0}'.format(self.embedding_identifier), to_tokenize)
@@ -573,11 +658,12 @@ class SDTokenizer:
                         word = leftover
                     else:
                         continue
-                end = 999999999999
-                if self.tokenizer_adds_end_token:
-                    end = -1
                 #parse word
-                tokens.append([(t, weight) for t in self.tokenizer(word)["input_ids"][self.tokens_start:end]])
+                words.append((len(tokens), word, weight))
+                tokens.append(None)
+
+        for (i, _, weight), ids in zip(words, self.tokenize_words([w[1] for w in words])):
+            tokens[i] = [(t, weight) for t in ids]
 
         #reshape token array to CLIP input size
         batched_tokens = []
@@ -633,6 +719,19 @@ class SDTokenizer:
         return batched_tokens
 
 
+    def tokenize_with_weights_batch(self, texts, return_word_ids=False, tokenizer_options={}, **kwargs):
+        '''tokenize_with_weights for a list of prompts, the text of all of them is tokenized in a single tokenizer call.'''
+        if self.memoize and not kwargs.get("disable_weights", False):
+            words = []
+            for text in texts:
+                for weighted_segment, _ in parse_prompt_weights(escape_important(text)):
+                    split = re.split(' {0}|\n{0}'.format(self.embedding_identifier), unescape_important(weighted_segment))
+                    words.append(split[0])
+                    if self.embedding_directory is None: # otherwise the embedding name decides what is left to tokenize
+                        words += ["{}{}".format(self.embedding_identifier, x) for x in split[1:]]
+            self.tokenize_words([w for w in dict.fromkeys(words) if w != "" and w not in self.word_cache])
+        return [self.tokenize_with_weights(text, return_word_ids, tokenizer_options=tokenizer_options, **kwargs) for text in texts]
+
     def untokenize(self, token_weight_pair):
         return list(map(lambda a: (a, self.inv_vocab[a[0]]), token_weight_pair))
 
@@ -656,6 +755,10 @@ class SD1Tokenizer:
         out[self.clip_name] = getattr(self, self.clip).tokenize_with_weights(text, return_word_ids, **kwargs)
         return out
 
+    def tokenize_with_weights_batch(self, texts, return_word_ids=False, **kwargs):
+        batch = getattr(self, self.clip).tokenize_with_weights_batch(texts, return_word_ids, **kwargs)
+        return [{self.clip_name: tokens} for tokens in batch]
+
     def untokenize(self, token_weight_pair):
         return getattr(self, self.clip).untokenize(token_weight_pair)
 
@@ -0,0 +1,259 @@
+"""
+Host RAM weight pool shared between ComfyUI processes.
+
+Safetensors files are copied once into a shared memory directory (/dev/shm by default) and every
+process maps them copy-on-write: tensors returned by SharedWeightPool.attach() are views of that
+mapping, so N processes using the same base model share one copy of it in RAM. Writes (in place
+patching) only create private copies of the touched pages in the process that made them.
+
+Each process holding a file creates a <key>.<pid>.ref file next to it, removed when the mapping is
+freed; files without live references are evicted first when the pool grows past its size.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+import weakref
+
+import torch
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+    SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_safetensors_header(f):
+    header_size = struct.unpack("<Q", f.read(8))[0]
+    return json.loads(f.read(header_size)), 8 + header_size
+
+
+class SharedWeightPool:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.attached = {} # key -> weakref to the storage mapped in this process
+
+    def file_key(self, path):
+        st = os.stat(path)
+        return hashlib.sha1("{}:{}:{}".format(os.path.realpath(path), st.st_size, st.st_mtime_ns).encode("utf-8")).hexdigest()[:24]
+
+    def blob_path(self, key):
+        return os.path.join(self.directory, "{}.safetensors".format(key))
+
+    def ref_path(self, key, pid=None):
+        return os.path.join(self.directory, "{}.{}.ref".format(key, os.getpid() if pid is None else pid))
+
+    def lock(self):
+        f = open(os.path.join(self.directory, "pool.lock"), "a+")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def refcount(self, key):
+        count = 0
+        for name in os.listdir(self.directory):
+            if name.startswith(key + ".") and name.endswith(".ref"):
+                try:
+                    pid = int(name[len(key) + 1:-4])
+                except ValueError:
+                    continue
+                if pid_alive(pid):
+                    count += 1
+                else:
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+        return count
+
+    def blobs(self):
+        out = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".safetensors"):
+                path = os.path.join(self.directory, name)
+                st = os.stat(path)
+                out.append((st.st_mtime, st.st_size, name[:-len(".safetensors")]))
+        return sorted(out)
+
+    def evict(self, needed):
+        """Remove unreferenced files, least recently attached first, until needed more bytes fit."""
+        blobs = self.blobs()
+        used = sum(b[1] for b in blobs)
+        for _, size, key in blobs:
+            if used + needed <= self.max_bytes:
+                break
+            if self.refcount(key) == 0:
+                os.remove(self.blob_path(key))
+                used -= size
+                logging.debug("Evicted {} from the shared weight pool".format(key))
+        return used + needed <= self.max_bytes
+
+    def attach(self, path):
+        """Returns (state_dict, metadata) with tensors backed by the shared copy of path, or None if it doesn't fit."""
+        key = self.file_key(path)
+        blob = self.blob_path(key)
+        with self.lock():
+            if not os.path.exists(blob):
+                if not self.evict(os.path.getsize(path)):
+                    return None
+                tmp = "{}.{}.tmp".format(blob, os.getpid())
+                shutil.copyfile(path, tmp)
+                os.replace(tmp, blob)
+            else:
+                os.utime(blob)
+            open(self.ref_path(key), "a").close()
+
+        with open(blob, "rb") as f:
+            header, data_start = read_safetensors_header(f)
+        storage = self.mapped_storage(key, blob)
+
+        whole = torch.empty(0, dtype=torch.uint8).set_(storage)
+        metadata = header.pop("__metadata__", None)
+        sd = {}
+        for name, info in header.items():
+            dtype = SAFETENSORS_DTYPES[info["dtype"]]
+            start, end = info["data_offsets"]
+            start += data_start
+            end += data_start
+            t = whole[start:end]
+            if start % dtype.itemsize == 0:
+                t = t.view(dtype)
+            else:
+                t = t.clone().view(dtype) # misaligned, can't be viewed in place
+            sd[name] = t.reshape(info["shape"])
+        return sd, metadata
+
+    def mapped_storage(self, key, blob):
+        storage = self.attached.get(key, lambda: None)()
+        if storage is None:
+            storage = torch.UntypedStorage.from_file(blob, shared=False, nbytes=os.path.getsize(blob))
+            weakref.finalize(storage, self.release, key)
+            self.attached[key] = weakref.ref(storage)
+        return storage
+
+    def release(self, key):
+        self.attached.pop(key, None)
+        try:
+            os.remove(self.ref_path(key))
+        except OSError:
+            pass
+
+
+def is_shared(tensor):
+    if SHARED_POOL is None or not isinstance(tensor, torch.Tensor) or tensor.device.type != "cpu":
+        return False
+    storage = tensor.untyped_storage()
+    for ref in SHARED_POOL.attached.values():
+        s = ref()
+        if s is not None and s.data_ptr() == storage.data_ptr():
+            return True
+    return False
+
+
+def load_state_dict(module, sd, strict=False):
+    """
+    module.load_state_dict() that keeps the shared pool tensors of sd as the module weights when their
+    dtype and shape already match instead of copying them into private memory.
+    """
+    if SHARED_POOL is None:
+        return module.load_state_dict(sd, strict=strict)
+
+    current = module.state_dict(keep_vars=True)
+    shared = {}
+    rest = {}
+    for k, t in sd.items():
+        p = current.get(k, None)
+        if isinstance(p, torch.nn.Parameter) and p.dtype == t.dtype and p.shape == t.shape and p.device.type == "cpu" and is_shared(t):
+            module_name = k.rpartition(".")[0]
+            sub = module.get_submodule(module_name)
+            if type(sub)._load_from_state_dict is torch.nn.Module._load_from_state_dict:
+                shared[k] = t
+                continue
+        rest[k] = t
+
+    if len(shared) == 0:
+        return module.load_state_dict(sd, strict=strict)
+
+    m, u = module.load_state_dict(rest, strict=False)
+    _, u2 = module.load_state_dict(shared, strict=False, assign=True)
+    missing = [k for k in m if k not in shared]
+    unexpected = u + u2
+    if strict and (len(missing) > 0 or len(unexpected) > 0):
+        raise RuntimeError("Error(s) in loading state_dict for {}: missing {} unexpected {}".format(module.__class__.__name__, missing, unexpected))
+
+    for k, t in shared.items():
+        module_name, _, param_name = k.rpartition(".")
+        sub = module.get_submodule(module_name)
+        if not hasattr(sub, "comfy_shared_weights"):
+            sub.comfy_shared_weights = {}
+        sub.comfy_shared_weights[param_name] = t
+    return torch.nn.modules.module._IncompatibleKeys(missing, unexpected)
+
+
+def reattach(module, device):
+    """
+    Point the unpatched weights of module back at their shared copy when they are offloaded to the cpu,
+    which saves both the device to host copy and the private RAM it would use.
+    """
+    if SHARED_POOL is None or torch.device(device).type != "cpu":
+        return
+    for m in module.modules():
+        shared = getattr(m, "comfy_shared_weights", None)
+        if shared is None:
+            continue
+        for name, view in shared.items():
+            p = getattr(m, name, None)
+            if isinstance(p, torch.nn.Parameter) and p.dtype == view.dtype and p.shape == view.shape and p.data_ptr() != view.data_ptr():
+                p.data = view
+
+
+SHARED_POOL = None
+
+
+def enable_shared_pool(directory, max_bytes):
+    global SHARED_POOL
+    if fcntl is None:
+        logging.warning("The shared weight pool needs fcntl file locks which aren't available on this platform, disabling it.")
+        return None
+    SHARED_POOL = SharedWeightPool(directory, max_bytes)
+    logging.info("Using shared weight pool {} ({:.0f} MB)".format(directory, max_bytes / (1024 * 1024)))
+    return SHARED_POOL
+
+
+def attach(path):
+    if SHARED_POOL is None or not (path.lower().endswith(".safetensors") or path.lower().endswith(".sft")):
+        return None
+    try:
+        return SHARED_POOL.attach(path)
+    except Exception as e:
+        logging.warning("Could not use the shared weight pool for {}: {}".format(path, e))
+        return None
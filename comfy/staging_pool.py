@@ -0,0 +1,145 @@
+"""
+Pinned host memory staging for the weights of partially loaded (lowvram) models.
+
+Instead of pinning every offloaded weight on its own, the offloaded weights of a model are copied into a few large
+pinned slabs, packed contiguously in the order the modules run (the recorded execution order when there is one, see
+comfy.weight_streaming which prefetches them to the GPU), and the parameters are pointed at those copies.
+
+Without pinned memory (cpu...) the slabs are regular memory, which keeps the same code path testable on CPU only
+machines.
+"""
+import logging
+import threading
+import weakref
+
+import torch
+
+import comfy.weight_streaming
+
+ALIGNMENT = 256
+SLAB_BYTES = 256 * 1024 * 1024
+
+
+def aligned(size):
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class StagingGroup:
+    """The staged weights of one model: the slabs and the modules whose weights are in them."""
+    def __init__(self, pool, modules, order=None):
+        self.pool = pool
+        self.order = order
+        self.modules = [] # (name, module, {param name: param})
+        self.slabs = []
+        self.nbytes = 0
+        self.keys = set()
+        try:
+            self.pack(modules)
+        except Exception:
+            self.detach_modules()
+            pool.free(sum(s.numel() for s in self.slabs))
+            raise
+
+    def pack(self, modules):
+        slab = None
+        offset = 0
+        remaining = sum(aligned(p.nbytes) for n, m, params in modules for p in params.values())
+        for n, m, params in modules:
+            packed = {}
+            for name, p in params.items():
+                size = p.nbytes
+                if slab is None or offset + size > slab.numel():
+                    slab = self.pool.allocate(max(size, min(SLAB_BYTES, remaining)))
+                    self.slabs.append(slab)
+                    offset = 0
+                view = slab[offset:offset + size].view(p.dtype).view(p.shape)
+                view.copy_(p.data)
+                p.data = view
+                offset += aligned(size)
+                remaining -= aligned(size)
+                packed[name] = p
+                self.keys.add("{}.{}".format(n, name))
+            self.modules.append((n, m, packed))
+            m.comfy_staging_group = self
+        self.nbytes = sum(s.numel() for s in self.slabs)
+
+    def intact(self):
+        for n, m, params in self.modules:
+            for name, p in params.items():
+                if getattr(m, name, None) is not p or p.device.type != "cpu":
+                    return False
+        return True
+
+    def detach_modules(self):
+        for n, m, params in self.modules:
+            if getattr(m, "comfy_staging_group", None) is self:
+                del m.comfy_staging_group
+
+
+class StagingPool:
+    def __init__(self, max_bytes, pin=True):
+        self.max_bytes = max_bytes
+        self.pin = pin
+        self.lock = threading.Lock()
+        self.allocated = 0
+
+    def allocate(self, size):
+        with self.lock:
+            if self.allocated + size > self.max_bytes:
+                raise MemoryError("staging pool full")
+            self.allocated += size
+        try:
+            return torch.empty((size,), dtype=torch.uint8, pin_memory=self.pin)
+        except Exception:
+            with self.lock:
+                self.allocated -= size
+            raise
+
+    def free(self, size):
+        with self.lock:
+            self.allocated -= size
+
+    def stage(self, model, loading, order=None):
+        """
+        Packs the offloaded weights of model into pinned slabs. loading is the ModelPatcher._load_list() of the model,
+        the offloaded modules with all their parameters in host memory are staged in execution order
+        (comfy.weight_streaming.ExecutionOrder) or module order.
+        Returns False if they don't fit in the pool, the caller should then pin the weights on its own.
+        """
+        modules = comfy.weight_streaming.offloaded_modules(loading, order)
+
+        group = getattr(model, "staging_group", None)
+        keys = set("{}.{}".format(n, name) for n, m, params in modules for name in params)
+        if group is not None:
+            if group.keys == keys and group.order is order and group.intact():
+                return True
+            self.release(model)
+        if len(modules) == 0:
+            return True
+
+        try:
+            group = StagingGroup(self, modules, order)
+        except (MemoryError, RuntimeError) as e:
+            logging.info("Not using the staging pool for {}: {}".format(model.__class__.__name__, e))
+            return False
+        weakref.finalize(group, self.free, group.nbytes)
+        model.staging_group = group
+        logging.debug("staging pool: packed {} modules, {:.1f} MB".format(len(group.modules), group.nbytes / (1024 * 1024)))
+        return True
+
+    def release(self, model):
+        group = getattr(model, "staging_group", None)
+        if group is None:
+            return
+        group.detach_modules()
+        model.staging_group = None
+
+
+STAGING_POOL = None
+
+
+def enable_pool(max_bytes, pin=True):
+    global STAGING_POOL
+    STAGING_POOL = StagingPool(max_bytes, pin=pin)
+    logging.info("Using a {:.0f} MB {}staging pool for offloaded weights".format(max_bytes / (1024 * 1024), "pinned " if pin else ""))
+    return STAGING_POOL
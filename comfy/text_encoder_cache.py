@@ -0,0 +1,204 @@
+"""
+Bounded cache of text encoder outputs, consulted by CLIP.encode_from_tokens.
+
+Entries are keyed by a digest of the text encoder weights, the clip options (layer, unprojected pooled output),
+the weight patches (LoRA...) of the CLIP and the tokens with their weights. When the weights were loaded from files
+the key only depends on file identities and tensor contents, so entries can also be persisted to a directory and
+reused after a restart.
+"""
+import hashlib
+import inspect
+import logging
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import torch
+
+
+class Uncacheable(Exception):
+    pass
+
+
+TENSOR_DIGESTS = {} # id -> (weakref, digest)
+TENSOR_DIGESTS_LOCK = threading.Lock()
+
+def tensor_digest(t):
+    with TENSOR_DIGESTS_LOCK:
+        cached = TENSOR_DIGESTS.get(id(t), None)
+        if cached is not None and cached[0]() is t:
+            return cached[1]
+    data = t.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8).numpy()
+    digest = hashlib.sha1(data.tobytes()).hexdigest()
+    digest = "{}{}:{}".format(str(t.dtype).replace("torch.", ""), tuple(t.shape), digest)
+    key = id(t)
+    with TENSOR_DIGESTS_LOCK:
+        TENSOR_DIGESTS[key] = (weakref.ref(t, lambda _: TENSOR_DIGESTS.pop(key, None)), digest)
+    return digest
+
+
+def update_digest(h, obj):
+    if isinstance(obj, torch.Tensor):
+        h.update(b"T")
+        h.update(tensor_digest(obj).encode("utf-8"))
+    elif isinstance(obj, dict):
+        h.update(b"{")
+        for k in sorted(obj.keys(), key=str):
+            h.update(repr(k).encode("utf-8"))
+            update_digest(h, obj[k])
+        h.update(b"}")
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"[")
+        for x in obj:
+            update_digest(h, x)
+        h.update(b"]")
+    elif obj is None or isinstance(obj, (bool, int, float, str)):
+        h.update(repr(obj).encode("utf-8"))
+        h.update(b",")
+    elif callable(obj) and hasattr(obj, "__qualname__"):
+        # only named functions are identified by their name: what closures, lambdas and bound methods compute
+        # depends on values that aren't part of it (the scale_weight of the layer of a convert_weight...)
+        if inspect.ismethod(obj) or getattr(obj, "__closure__", None) is not None or "<lambda>" in obj.__qualname__:
+            raise Uncacheable("{} {}".format(type(obj).__name__, obj.__qualname__))
+        h.update("f{}.{}".format(getattr(obj, "__module__", ""), obj.__qualname__).encode("utf-8"))
+        update_digest(h, [getattr(obj, "__defaults__", None), getattr(obj, "__kwdefaults__", None)])
+    elif hasattr(obj, "weights"): # WeightAdapterBase
+        h.update(obj.__class__.__name__.encode("utf-8"))
+        update_digest(h, obj.weights)
+    else:
+        raise Uncacheable(type(obj).__name__)
+
+
+def weights_identity(model):
+    """(digest, persistent) of the weights of the text encoder module model."""
+    paths = getattr(model, "model_source_paths", None)
+    if paths is None and getattr(model, "model_source_path", None) is not None:
+        paths = [model.model_source_path]
+    if paths is not None:
+        h = hashlib.sha1(model.__class__.__name__.encode("utf-8"))
+        for p in paths:
+            st = os.stat(p)
+            h.update("{}:{}:{}".format(os.path.realpath(p), st.st_size, st.st_mtime_ns).encode("utf-8"))
+        return h.hexdigest(), True
+    return str(model.model_weights_uuid), False
+
+
+class TextEncoderCache:
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.ram_bytes = 0
+        self.patch_digests = OrderedDict() # patches_uuid -> digest of the patches
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def cache_key(self, clip, tokens, return_pooled):
+        """Returns (key, persistent) or None if the encode can't be cached (hooks, unknown token types...)."""
+        patcher = clip.patcher
+        if patcher.forced_hooks is not None or len(patcher.hook_patches) > 0 or len(patcher.object_patches) > 0:
+            return None
+        try:
+            weights, persistent = weights_identity(patcher.model)
+            with self.lock:
+                patches = self.patch_digests.get(patcher.patches_uuid, None)
+            if patches is None:
+                h = hashlib.sha1()
+                update_digest(h, patcher.patches)
+                patches = h.hexdigest()
+                with self.lock:
+                    self.patch_digests[patcher.patches_uuid] = patches
+                    while len(self.patch_digests) > 64:
+                        self.patch_digests.popitem(last=False)
+            h = hashlib.sha1()
+            update_digest(h, [weights, patches, clip.layer_idx, return_pooled == "unprojected", str(patcher.load_device), [str(d) for d in clip.cond_stage_model.dtypes]])
+            update_digest(h, tokens)
+        except (Uncacheable, OSError, AttributeError) as e:
+            logging.debug("Text encoder output not cacheable: {}".format(e))
+            return None
+        return h.hexdigest(), persistent
+
+    def disk_path(self, key):
+        return os.path.join(self.directory, "{}.pt".format(key))
+
+    def get(self, key, persistent):
+        with self.lock:
+            out = self.entries.get(key, None)
+            if out is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return out[0]
+
+        if persistent and self.directory is not None and os.path.exists(self.disk_path(key)):
+            try:
+                out = torch.load(self.disk_path(key), weights_only=True)
+                os.utime(self.disk_path(key))
+                self.put(key, out, persistent, save=False)
+                with self.lock:
+                    self.hits += 1
+                return out
+            except Exception as e:
+                logging.warning("Could not read cached text encoder output {}: {}".format(self.disk_path(key), e))
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, out, persistent, save=True):
+        size = sum(v.nbytes for v in out.values() if isinstance(v, torch.Tensor))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (out, size)
+            self.ram_bytes += size
+            while self.ram_bytes > self.max_bytes:
+                _, (_, s) = self.entries.popitem(last=False)
+                self.ram_bytes -= s
+
+        if save and persistent and self.directory is not None:
+            try:
+                tmp = "{}.{}.tmp".format(self.disk_path(key), os.getpid())
+                torch.save(out, tmp)
+                os.replace(tmp, self.disk_path(key))
+                self.trim_disk()
+            except Exception as e:
+                logging.warning("Could not save text encoder output to {}: {}".format(self.directory, e))
+
+    def trim_disk(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pt"):
+                st = os.stat(os.path.join(self.directory, name))
+                files.append((st.st_mtime, st.st_size, name))
+        used = sum(f[1] for f in files)
+        for _, size, name in sorted(files):
+            if used <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                used -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.patch_digests.clear()
+            self.ram_bytes = 0
+
+
+TEXT_ENCODER_CACHE = None
+
+
+def enable_cache(max_bytes, directory=None, max_disk_bytes=0):
+    global TEXT_ENCODER_CACHE
+    TEXT_ENCODER_CACHE = TextEncoderCache(max_bytes, directory=directory, max_disk_bytes=max_disk_bytes)
+    logging.info("Using text encoder output cache ({:.0f} MB RAM, {:.0f} MB disk)".format(max_bytes / (1024 * 1024), max_disk_bytes / (1024 * 1024) if directory is not None else 0))
+    return TEXT_ENCODER_CACHE
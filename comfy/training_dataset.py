@@ -0,0 +1,246 @@
+"""
+Streaming datasets for training.
+
+Images are decoded and resized by a pool of worker threads, VAE encoded in small batches and their latents stored in
+an on-disk DatasetCache together with the text conditioning of their captions. Entries are keyed by the content of
+the image file (or the caption) and the identity of the VAE (or text encoder) so later runs skip the encoding. During
+training TrainingDataset.batches() loads the batches from the cache in a background thread into a bounded queue, so
+only a few batches are in memory at any time.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import queue
+import threading
+
+import torch
+
+import comfy.text_encoder_cache
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
+FILE_DIGESTS = {} # (path, size, mtime) -> digest
+FILE_DIGESTS_LOCK = threading.Lock()
+
+
+def file_digest(path):
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    with FILE_DIGESTS_LOCK:
+        digest = FILE_DIGESTS.get(key, None)
+    if digest is None:
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with FILE_DIGESTS_LOCK:
+            FILE_DIGESTS[key] = digest
+    return digest
+
+
+def digest(obj):
+    h = hashlib.sha1()
+    comfy.text_encoder_cache.update_digest(h, obj)
+    return h.hexdigest()
+
+
+def patcher_identity(patcher):
+    """Identifies the weights and weight patches of a ModelPatcher, stable across restarts when the weights were loaded from files."""
+    weights, persistent = comfy.text_encoder_cache.weights_identity(patcher.model)
+    return [weights, digest(patcher.patches)]
+
+
+def list_image_caption_files(folder):
+    """(image paths, caption paths) of a folder, kohya-ss/sd-scripts style "<repeats>_<name>" subfolders are repeated."""
+    image_files = []
+    for item in sorted(os.listdir(folder)):
+        path = os.path.join(folder, item)
+        if item.lower().endswith(IMAGE_EXTENSIONS):
+            image_files.append(path)
+        elif os.path.isdir(path):
+            repeat = 1
+            if item.split("_")[0].isdigit():
+                repeat = int(item.split("_")[0])
+            image_files.extend([os.path.join(path, f) for f in sorted(os.listdir(path)) if f.lower().endswith(IMAGE_EXTENSIONS)] * repeat)
+    return image_files, [os.path.splitext(f)[0] + ".txt" for f in image_files]
+
+
+def read_caption(path):
+    if not os.path.exists(path):
+        return ""
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+def load_images(paths, load_image, workers=4):
+    """Decodes the images with load_image(path) -> [1, H, W, C] tensor in parallel, in order."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(load_image, paths))
+
+
+class DatasetCache:
+    """
+    Tensors (or lists / dicts of them) saved in directory as <key>.pt. When it is over max_bytes, prune() removes the
+    least recently used files of other datasets.
+    """
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, "{}.pt".format(key))
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        return torch.load(self.path(key), weights_only=True)
+
+    def put(self, key, value):
+        tmp = "{}.{}.{}.tmp".format(self.path(key), os.getpid(), threading.get_ident())
+        torch.save(value, tmp)
+        os.replace(tmp, self.path(key))
+
+    def prune(self, keep=()):
+        """Marks the entries of keep as used and removes the least recently used other entries while over max_bytes."""
+        keep = set(self.path(k) for k in keep)
+        for path in keep:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        if self.max_bytes is None:
+            return
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pt"):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        used = sum(f[1] for f in files)
+        for _, size, path in sorted(files):
+            if used <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+                used -= size
+            except OSError:
+                pass
+        if used > self.max_bytes:
+            logging.warning("The training dataset cache {} uses {:.1f} GB, more than its {:.1f} GB limit, for the current dataset.".format(self.directory, used / (1024 ** 3), self.max_bytes / (1024 ** 3)))
+
+
+class TrainingDataset:
+    """Encoded (latent, conditioning) training items stored in a DatasetCache."""
+    def __init__(self, cache, latent_keys, cond_keys, workers=4, prefetch=4):
+        self.cache = cache
+        self.latent_keys = latent_keys
+        self.cond_keys = cond_keys
+        self.workers = workers
+        self.prefetch = prefetch # batches loaded ahead
+
+    def __len__(self):
+        return len(self.latent_keys)
+
+    def load(self, index):
+        """(latent without batch dimension, conditioning list) of an item."""
+        return self.cache.get(self.latent_keys[index]), self.cache.get(self.cond_keys[index])
+
+    def load_batch(self, indices, pool=None):
+        items = list(pool.map(self.load, indices)) if pool is not None else [self.load(i) for i in indices]
+        latents = torch.stack([latent for latent, cond in items])
+        conds = []
+        for latent, cond in items:
+            conds.extend(cond)
+        return latents, conds
+
+    def batches(self, schedule):
+        """Yields (latents, conditioning) for every list of item indices in schedule, loaded ahead in a background thread."""
+        out = queue.Queue(maxsize=max(1, self.prefetch))
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def producer():
+            try:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+                    for indices in schedule:
+                        if not put((self.load_batch(indices, pool), None)):
+                            return
+            except Exception as e:
+                put((None, e))
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            for _ in range(len(schedule)):
+                batch, error = out.get()
+                if error is not None:
+                    raise error
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+def build_dataset(cache, image_files, captions, vae, clip, load_image, resize_method, width, height, workers=4, encode_batch_size=4):
+    """
+    Returns a TrainingDataset of the images and captions, encoding the latents and conditioning missing in cache.
+    load_image(path, resize_method, width, height) decodes one image to a [1, H, W, C] float tensor.
+    """
+    vae_identity = patcher_identity(vae.patcher) + [str(vae.vae_dtype)]
+    clip_identity = patcher_identity(clip.patcher) + [clip.layer_idx]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        file_digests = list(pool.map(file_digest, image_files))
+    latent_keys = [digest(["latent", vae_identity, d, resize_method, width, height]) for d in file_digests]
+    cond_keys = [digest(["cond", clip_identity, c]) for c in captions]
+
+    missing = {}
+    for path, key in zip(image_files, latent_keys):
+        if key not in cache:
+            missing.setdefault(key, path)
+    if len(missing) > 0:
+        logging.info("Encoding {} of {} images, the others are cached.".format(len(missing), len(image_files)))
+        jobs = list(missing.items())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            decoding = collections.deque()
+            submitted = 0
+            while submitted < len(jobs) or len(decoding) > 0:
+                # the workers decode up to two batches ahead of the encoding
+                while submitted < len(jobs) and len(decoding) < 2 * encode_batch_size + workers:
+                    key, path = jobs[submitted]
+                    decoding.append((key, pool.submit(load_image, path, resize_method, width, height)))
+                    submitted += 1
+                chunk = [decoding.popleft() for _ in range(min(encode_batch_size, len(decoding)))]
+                latents = vae.encode(torch.cat([f.result() for key, f in chunk])[:, :, :, :3])
+                for (key, f), latent in zip(chunk, latents):
+                    cache.put(key, latent.to(torch.float32).cpu().clone())
+
+    missing = {}
+    for caption, key in zip(captions, cond_keys):
+        if key not in cache:
+            missing.setdefault(key, caption)
+    if len(missing) > 0:
+        logging.info("Encoding {} captions.".format(len(missing)))
+        for key, caption in missing.items():
+            cache.put(key, clip.encode_from_tokens_scheduled(clip.tokenize(caption)))
+
+    cache.prune(keep=latent_keys + cond_keys)
+    return TrainingDataset(cache, latent_keys, cond_keys, workers=workers)
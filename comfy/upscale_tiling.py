@@ -0,0 +1,160 @@
+"""
+Memory model of image upscale models, used to pick the tile size and the tiles per model call of ImageUpscaleWithModel.
+
+The memory used by one model call on a batch of n square tiles of side t is modeled as n * (fixed + per_pixel * t * t).
+The two coefficients are measured once per architecture, weights shape, dtype and device type by running two small
+probe tiles and are persisted in a json file so later runs pick the largest tile that fits (up to MAX_TILE) on the first
+attempt.
+"""
+import json
+import logging
+import math
+import os
+import threading
+from typing import NamedTuple
+
+import torch
+
+PROBE_TILES = (64, 128)
+MIN_TILE = 128
+# the probes are small, the memory model isn't trusted past the tile size that was used before it
+MAX_TILE = 512
+TILE_MULTIPLE = 32
+MAX_TILE_BATCH = 8
+# estimates are multiplied by this, the probes can't see allocator fragmentation
+MEMORY_SAFETY = 1.25
+# without allocator statistics the peak is estimated from the biggest single module call (inputs + output)
+HOOK_PEAK_FACTOR = 2.0
+
+
+class TileMemoryModel(NamedTuple):
+    fixed: float
+    per_pixel: float
+    method: str
+
+    def tile_bytes(self, tile, batch=1):
+        return batch * (self.fixed + self.per_pixel * tile * tile) * MEMORY_SAFETY
+
+
+def model_key(upscale_model, dtype, device):
+    params = sum(p.numel() for p in upscale_model.model.parameters())
+    return "{}:x{}:{}:{}:{}".format(upscale_model.architecture.id, upscale_model.scale, params, str(dtype).replace("torch.", ""), torch.device(device).type)
+
+
+def tensor_bytes(x):
+    if isinstance(x, torch.Tensor):
+        return x.nelement() * x.element_size()
+    if isinstance(x, (list, tuple)):
+        return sum(tensor_bytes(t) for t in x)
+    return 0
+
+
+def probe_allocator(upscale_model, x, device):
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    upscale_model(x)
+    torch.cuda.synchronize(device)
+    return torch.cuda.max_memory_allocated(device) - base
+
+
+def probe_hooks(upscale_model, x, device):
+    peak = [tensor_bytes(x)]
+
+    def hook(module, args, output):
+        peak[0] = max(peak[0], tensor_bytes(args) + tensor_bytes(output))
+
+    handles = [m.register_forward_hook(hook) for m in upscale_model.model.modules() if len(list(m.children())) == 0]
+    try:
+        upscale_model(x)
+    finally:
+        for h in handles:
+            h.remove()
+    return peak[0] * HOOK_PEAK_FACTOR
+
+
+@torch.inference_mode()
+def measure(upscale_model, device):
+    """Fits the TileMemoryModel of upscale_model (already on device) from two probe tiles."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        probe, method = probe_allocator, "allocator"
+    else:
+        probe, method = probe_hooks, "hooks"
+
+    measured = []
+    for t in PROBE_TILES:
+        x = torch.rand((1, upscale_model.input_channels, t, t), dtype=upscale_model.dtype, device=device)
+        measured.append(probe(upscale_model, x, device))
+
+    p0, p1 = PROBE_TILES[0] ** 2, PROBE_TILES[1] ** 2
+    per_pixel = max((measured[1] - measured[0]) / (p1 - p0), 0.0)
+    fixed = max(measured[0] - per_pixel * p0, 0.0)
+    if per_pixel == 0.0: # memory didn't grow with the tile, assume it all scales with it
+        per_pixel = measured[1] / p1
+    return TileMemoryModel(fixed, per_pixel, method)
+
+
+class TileMemoryStore:
+    """Measured TileMemoryModels, persisted as json at path (in memory only if path is None)."""
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.models = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.models = {k: TileMemoryModel(**v) for k, v in json.load(f).items()}
+            except Exception as e:
+                logging.warning("Could not read upscale tile memory models from {}: {}".format(path, e))
+
+    def get(self, upscale_model, device):
+        key = model_key(upscale_model, upscale_model.dtype, device)
+        with self.lock:
+            memory_model = self.models.get(key, None)
+        if memory_model is not None:
+            return memory_model
+
+        memory_model = measure(upscale_model, device)
+        logging.info("Measured upscale model memory {}: {:.0f} bytes/pixel".format(key, memory_model.per_pixel))
+        with self.lock:
+            self.models[key] = memory_model
+            self.save()
+        return memory_model
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = "{}.tmp".format(self.path)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({k: v._asdict() for k, v in self.models.items()}, f, indent=1)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.warning("Could not save upscale tile memory models to {}: {}".format(self.path, e))
+
+
+def plan_tiles(memory_model, width, height, memory_budget, overlap=32, max_tile=None):
+    """
+    Returns (tile, tile_batch): the largest square tile whose model call fits in memory_budget bytes and
+    how many of those tiles can be processed per model call.
+    """
+    largest = max(width, height)
+    if max_tile is not None:
+        largest = min(largest, max_tile)
+    largest = max(MIN_TILE, math.ceil(largest / TILE_MULTIPLE) * TILE_MULTIPLE)
+
+    tile = MIN_TILE
+    for t in range(largest, MIN_TILE - 1, -TILE_MULTIPLE):
+        if memory_model.tile_bytes(t) <= memory_budget:
+            tile = t
+            break
+
+    if tile >= width and tile >= height:
+        return tile, 1
+
+    rows = 1 if height <= tile else math.ceil((height - overlap) / (tile - overlap))
+    cols = 1 if width <= tile else math.ceil((width - overlap) / (tile - overlap))
+    tile_batch = int(memory_budget // max(memory_model.tile_bytes(tile), 1))
+    return tile, max(1, min(tile_batch, MAX_TILE_BATCH, rows * cols))
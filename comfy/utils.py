@@ -21,11 +21,16 @@ import torch
 import math
 import struct
 import comfy.checkpoint_pickle
+import comfy.model_prefetch
+import comfy.shared_weights
 import safetensors.torch
 import numpy as np
 from PIL import Image
 import logging
 import itertools
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from torch.nn.functional import interpolate
 from einops import rearrange
 from comfy.cli_args import args
@@ -54,9 +59,16 @@ if hasattr(torch.serialization, "add_safe_globals"):  # TODO: this was added in
 else:
     logging.info("Warning, you are using an old pytorch version and some ckpt/pt files might be loaded unsafely. Upgrading to 2.4 or above is recommended.")
 
-def load_torch_file(ckpt, safe_load=False, device=None, return_metadata=False):
+def load_torch_file(ckpt, safe_load=False, device=None, return_metadata=False, use_staged=True):
     if device is None:
         device = torch.device("cpu")
+    if use_staged and device.type == "cpu":
+        staged = comfy.shared_weights.attach(ckpt)
+        if staged is None:
+            staged = comfy.model_prefetch.take_staged(ckpt)
+        if staged is not None:
+            sd, metadata = staged
+            return (sd, metadata) if return_metadata else sd
     metadata = None
     if ckpt.lower().endswith(".safetensors") or ckpt.lower().endswith(".sft"):
         try:
@@ -901,8 +913,88 @@ def get_tiled_scale_steps(width, height, tile_x, tile_y, overlap):
     cols = 1 if width <= tile_x else math.ceil((width - overlap) / (tile_x - overlap))
     return rows * cols
 
+@functools.lru_cache(maxsize=32)
+def tile_plan(shape, tile, overlap, index_formulas, downscale):
+    """(input positions, input lengths, output positions) of every tile of a sample of spatial shape, in processing order."""
+    dims = len(tile)
+
+    def get_pos(dim, val):
+        up = index_formulas[dim]
+        if callable(up):
+            return up(val)
+        if downscale:
+            return val / up
+        return up * val
+
+    positions = [range(0, shape[d] - overlap[d], tile[d] - overlap[d]) if shape[d] > tile[d] else [0] for d in range(dims)]
+    plan = []
+    for it in itertools.product(*positions):
+        pos_in = []
+        lengths = []
+        pos_out = []
+        for d in range(dims):
+            pos = max(0, min(shape[d] - overlap[d], it[d]))
+            pos_in.append(pos)
+            lengths.append(min(tile[d], shape[d] - pos))
+            pos_out.append(round(get_pos(d, pos)))
+        plan.append((tuple(pos_in), tuple(lengths), tuple(pos_out)))
+    return plan
+
+def tile_feather_mask(shape, feathers, dtype, device):
+    """Blend mask of a tile of spatial shape, shared by every channel (broadcasts against (1, 1) + shape)."""
+    mask = torch.ones((1, 1) + shape, dtype=dtype, device=device)
+    for d in range(2, len(shape) + 2):
+        feather = feathers[d - 2]
+        if feather >= mask.shape[d]:
+            continue
+        for t in range(feather):
+            a = (t + 1) / feather
+            mask.narrow(d, t, 1).mul_(a)
+            mask.narrow(d, mask.shape[d] - 1 - t, 1).mul_(a)
+    return mask
+
+def run_tiles(function, tiles, tile_batch=1, workers=1):
+    """
+    Yields function(tile) for every tile in order. Up to tile_batch tiles of the same shape are concatenated in a
+    single call and up to workers calls run concurrently on a thread pool.
+    """
+    def call(group):
+        out = function(torch.cat(group)) if len(group) > 1 else function(group[0])
+        return out.split(1) if len(group) > 1 else [out]
+
+    groups = []
+    for t in tiles:
+        if len(groups) > 0 and len(groups[-1]) < tile_batch and groups[-1][0].shape == t.shape:
+            groups[-1].append(t)
+        else:
+            groups.append([t])
+
+    if workers <= 1:
+        for group in groups:
+            yield from call(group)
+        return
+
+    inference_mode = torch.is_inference_mode_enabled() # not inherited by the pool threads
+    def call_thread(group):
+        with torch.inference_mode(inference_mode):
+            return call(group)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for group in groups:
+            pending.append(executor.submit(call_thread, group))
+            if len(pending) > workers:
+                yield from pending.popleft().result()
+        while len(pending) > 0:
+            yield from pending.popleft().result()
+
 @torch.inference_mode()
-def tiled_scale_multidim(samples, function, tile=(64, 64), overlap=8, upscale_amount=4, out_channels=3, output_device="cpu", downscale=False, index_formulas=None, pbar=None):
+def tiled_scale_multidim(samples, function, tile=(64, 64), overlap=8, upscale_amount=4, out_channels=3, output_device="cpu", downscale=False, index_formulas=None, pbar=None, tile_batch=1, workers=1):
+    """
+    Runs function on overlapping tiles of samples and blends the results with feathered masks.
+    Tiles are always blended in the same order so workers > 1 gives the same output as a single thread, tile_batch > 1
+    only differs by however much the model output depends on the batch size.
+    """
     dims = len(tile)
 
     if not (isinstance(upscale_amount, (tuple, list))):
@@ -931,26 +1023,10 @@ def tiled_scale_multidim(samples, function, tile=(64, 64), overlap=8, upscale_am
         else:
             return val / up
 
-    def get_upscale_pos(dim, val):
-        up = index_formulas[dim]
-        if callable(up):
-            return up(val)
-        else:
-            return up * val
-
-    def get_downscale_pos(dim, val):
-        up = index_formulas[dim]
-        if callable(up):
-            return up(val)
-        else:
-            return val / up
-
     if downscale:
         get_scale = get_downscale
-        get_pos = get_downscale_pos
     else:
         get_scale = get_upscale
-        get_pos = get_upscale_pos
 
     def mult_list_upscale(a):
         out = []
@@ -959,6 +1035,8 @@ def tiled_scale_multidim(samples, function, tile=(64, 64), overlap=8, upscale_am
         return out
 
     output = torch.empty([samples.shape[0], out_channels] + mult_list_upscale(samples.shape[2:]), device=output_device)
+    feathers = tuple(round(get_scale(d, overlap[d])) for d in range(dims))
+    masks = {} # the few tile shapes (inner, edge and corner tiles) share their mask for the length of the call
 
     for b in range(samples.shape[0]):
         s = samples[b:b+1]
@@ -971,31 +1049,23 @@ def tiled_scale_multidim(samples, function, tile=(64, 64), overlap=8, upscale_am
             continue
 
         out = torch.zeros([s.shape[0], out_channels] + mult_list_upscale(s.shape[2:]), device=output_device)
-        out_div = torch.zeros([s.shape[0], out_channels] + mult_list_upscale(s.shape[2:]), device=output_device)
+        out_div = torch.zeros([s.shape[0], 1] + mult_list_upscale(s.shape[2:]), device=output_device)
 
-        positions = [range(0, s.shape[d+2] - overlap[d], tile[d] - overlap[d]) if s.shape[d+2] > tile[d] else [0] for d in range(dims)]
+        plan = tile_plan(tuple(s.shape[2:]), tuple(tile), tuple(overlap), tuple(index_formulas), downscale)
 
-        for it in itertools.product(*positions):
-            s_in = s
-            upscaled = []
+        def tiles():
+            for pos_in, lengths, _ in plan:
+                s_in = s
+                for d in range(dims):
+                    s_in = s_in.narrow(d + 2, pos_in[d], lengths[d])
+                yield s_in
 
-            for d in range(dims):
-                pos = max(0, min(s.shape[d + 2] - overlap[d], it[d]))
-                l = min(tile[d], s.shape[d + 2] - pos)
-                s_in = s_in.narrow(d + 2, pos, l)
-                upscaled.append(round(get_pos(d, pos)))
-
-            ps = function(s_in).to(output_device)
-            mask = torch.ones_like(ps)
-
-            for d in range(2, dims + 2):
-                feather = round(get_scale(d - 2, overlap[d - 2]))
-                if feather >= mask.shape[d]:
-                    continue
-                for t in range(feather):
-                    a = (t + 1) / feather
-                    mask.narrow(d, t, 1).mul_(a)
-                    mask.narrow(d, mask.shape[d] - 1 - t, 1).mul_(a)
+        for (_, _, upscaled), ps in zip(plan, run_tiles(function, tiles(), tile_batch=tile_batch, workers=workers)):
+            ps = ps.to(output_device)
+            mask_key = (tuple(ps.shape[2:]), ps.dtype, ps.device)
+            mask = masks.get(mask_key, None)
+            if mask is None:
+                mask = masks[mask_key] = tile_feather_mask(mask_key[0], feathers, ps.dtype, ps.device)
 
             o = out
             o_d = out_div
@@ -1012,8 +1082,8 @@ def tiled_scale_multidim(samples, function, tile=(64, 64), overlap=8, upscale_am
         output[b:b+1] = out/out_div
     return output
 
-def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None):
-    return tiled_scale_multidim(samples, function, (tile_y, tile_x), overlap=overlap, upscale_amount=upscale_amount, out_channels=out_channels, output_device=output_device, pbar=pbar)
+def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None, tile_batch=1, workers=1):
+    return tiled_scale_multidim(samples, function, (tile_y, tile_x), overlap=overlap, upscale_amount=upscale_amount, out_channels=out_channels, output_device=output_device, pbar=pbar, tile_batch=tile_batch, workers=workers)
 
 PROGRESS_BAR_ENABLED = True
 def set_progress_bar_enabled(enabled):
@@ -147,6 +147,48 @@ class LoRAAdapter(WeightAdapterBase):
         else:
             return None
 
+    @classmethod
+    def stackable(cls, patch):
+        """
+        If patch is a plain LoRA (no mid weight, dora scale, reshape, offset or function) that can be applied
+        together with the other plain LoRAs of the same weight by calculate_stacked_weight.
+        """
+        strength, v, strength_model, offset, function = patch
+        if not isinstance(v, cls) or strength_model != 1.0 or offset is not None or function is not None:
+            return False
+        mid, dora_scale, reshape = v.weights[3:6]
+        return mid is None and dora_scale is None and reshape is None
+
+    @staticmethod
+    def calculate_stacked_weight(patches, weight, key, intermediate_dtype=torch.float32):
+        """
+        Applies a stack of stackable LoRA patches with a single matmul: the up factors scaled by strength * alpha / rank
+        and the down factors are concatenated along the rank, which gives the sum of the LoRA diffs.
+        Returns None if the factors don't match the weight.
+        """
+        ups = []
+        downs = []
+        for strength, v, _, _, _ in patches:
+            if strength == 0.0:
+                continue
+            mat1 = comfy.model_management.cast_to_device(v.weights[0], weight.device, intermediate_dtype).flatten(start_dim=1)
+            mat2 = comfy.model_management.cast_to_device(v.weights[1], weight.device, intermediate_dtype).flatten(start_dim=1)
+            alpha = v.weights[2] / mat2.shape[0] if v.weights[2] is not None else 1.0
+            ups.append(mat1 * (strength * alpha))
+            downs.append(mat2)
+        if len(ups) == 0:
+            return weight
+        if any(u.shape[0] != weight.shape[0] for u in ups) or any(d.shape[1] * weight.shape[0] != weight.numel() for d in downs):
+            return None
+
+        up = torch.cat(ups, dim=1)
+        down = torch.cat(downs, dim=0)
+        if weight.dtype == intermediate_dtype and weight.is_contiguous():
+            weight.view(weight.shape[0], -1).addmm_(up, down)
+        else:
+            weight += torch.mm(up, down).reshape(weight.shape).type(weight.dtype)
+        return weight
+
     def calculate_weight(
         self,
         weight,
@@ -0,0 +1,348 @@
+"""
+Execution order recording and weight prefetching for partially loaded (lowvram) models.
+
+The first forward of a model for a given input shape runs with module hooks that record the order in which the modules
+holding weights are called. The order is kept on the ModelPatcher and used by PrefetchScheduler: when cast_bias_weight
+asks for the weights of an offloaded module, the weights of the next modules in the recorded order are copied to the
+device, cast to the dtype they were last used in and patched (lowvram LoRA patches...) on a separate stream.
+The achieved transfer bandwidth is measured for every pass. Recorded orders can be dumped as chrome://tracing files.
+
+On devices other than cuda nothing is copied but the scheduler still runs, which keeps it testable on CPU.
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import torch
+
+import comfy.offload_quantization
+
+PREFETCH_DEPTH = 0
+TRACE_DIRECTORY = None
+
+
+def shape_key(x):
+    return (tuple(x.shape), str(x.dtype))
+
+
+class ExecutionOrder:
+    def __init__(self, key):
+        self.key = key
+        self.names = [] # modules in the order of their first call
+        self.calls = [] # (name, start, end) of every call
+
+    def index(self):
+        return {n: i for i, n in enumerate(self.names)}
+
+
+class ExecutionOrderRecorder:
+    """Context manager recording the order in which the modules of model that hold weights are called."""
+    def __init__(self, model, key):
+        self.model = model
+        self.order = ExecutionOrder(key)
+        self.module_names = {}
+        for n, m in model.named_modules():
+            if next(m.parameters(recurse=False), None) is not None:
+                self.module_names[m] = n
+        self.seen = set()
+        self.started = {}
+        self.handles = []
+
+    def pre_hook(self, module, args):
+        name = self.module_names.get(module, None)
+        if name is None:
+            return
+        if name not in self.seen:
+            self.seen.add(name)
+            self.order.names.append(name)
+        self.started.setdefault(name, []).append(time.perf_counter())
+
+    def post_hook(self, module, args, output):
+        name = self.module_names.get(module, None)
+        if name is None or len(self.started.get(name, [])) == 0:
+            return
+        self.order.calls.append((name, self.started[name].pop(), time.perf_counter()))
+
+    def __enter__(self):
+        self.handles = [torch.nn.modules.module.register_module_forward_pre_hook(self.pre_hook),
+                        torch.nn.modules.module.register_module_forward_hook(self.post_hook)]
+        return self.order
+
+    def __exit__(self, *exc):
+        for h in self.handles:
+            h.remove()
+        self.handles = []
+        return False
+
+
+def dump_trace(order, path):
+    """Writes the calls recorded in order as a chrome://tracing (perfetto) json file."""
+    start = min((c[1] for c in order.calls), default=0)
+    index = order.index()
+    events = []
+    for name, s, e in sorted(order.calls, key=lambda c: c[1]):
+        events.append({"name": name, "ph": "X", "pid": 0, "tid": 0, "ts": (s - start) * 1e6, "dur": (e - s) * 1e6, "args": {"order": index[name]}})
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "otherData": {"shape": str(order.key), "order": order.names}}, f)
+
+
+class Prefetched:
+    def __init__(self, weight, bias, event, dtypes):
+        self.weight = weight
+        self.bias = bias
+        self.event = event
+        self.dtypes = dtypes # (dtype, bias dtype) the tensors were cast to and patched for, None if they are raw copies
+
+
+class TransferStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def record(self, nbytes, seconds):
+        with self.lock:
+            self.bytes += nbytes
+            self.seconds += seconds
+
+    def bandwidth(self):
+        """Average achieved host to device bandwidth of the prefetch copies in bytes/s, None before any."""
+        if self.seconds <= 0:
+            return None
+        return self.bytes / self.seconds
+
+
+TRANSFER_STATS = TransferStats()
+
+
+class PrefetchScheduler:
+    """Prefetches the weights of the next modules, in execution order, when one of them casts its weights."""
+    def __init__(self, modules, depth, order=None):
+        self.modules = modules # (name, module, {param name: param})
+        self.depth = depth
+        self.order = order
+        self.lock = threading.Lock()
+        self.dtypes = {}
+        self.prefetched = {}
+        self.stream = None
+        self.last_index = -1
+        self.explicit_passes = False
+        self.log = None # list of ("fetch" | "prefetch", index) when set
+        self.pending = [] # (nbytes, start event, end event) of copies not measured yet
+        self.pass_bytes = 0
+        self.pass_seconds = 0.0
+        self.last_bandwidth = None
+        for i, (n, m, params) in enumerate(modules):
+            m.comfy_prefetch_scheduler = self
+            m.comfy_prefetch_index = i
+
+    def names(self):
+        return [n for n, m, params in self.modules]
+
+    def begin_pass(self):
+        with self.lock:
+            self.explicit_passes = True
+            self.last_index = -1
+
+    def end_pass(self):
+        with self.lock:
+            self.finish_pass()
+            self.prefetched.clear()
+
+    def finish_pass(self):
+        while len(self.pending) > 0 and self.pending[0][2].query():
+            nbytes, start, end = self.pending.pop(0)
+            self.pass_bytes += nbytes
+            self.pass_seconds += start.elapsed_time(end) / 1000
+        if self.pass_seconds > 0:
+            self.last_bandwidth = self.pass_bytes / self.pass_seconds
+            TRANSFER_STATS.record(self.pass_bytes, self.pass_seconds)
+            logging.debug("weight prefetch: {:.1f} MB at {:.2f} GB/s".format(self.pass_bytes / (1024 * 1024), self.last_bandwidth / (1024 ** 3)))
+        self.pass_bytes = 0
+        self.pass_seconds = 0.0
+
+    def fetch(self, module, device, dtype, bias_dtype):
+        """Returns the (weight, bias) of module on device cast to dtype/bias_dtype and patched or None, and prefetches the modules after it."""
+        index = module.comfy_prefetch_index
+        with self.lock:
+            if not self.explicit_passes and index <= self.last_index:
+                self.finish_pass()
+                self.prefetched.clear()
+            self.last_index = index
+            self.dtypes[index] = (dtype, bias_dtype)
+            if self.log is not None:
+                self.log.append(("fetch", index))
+            entry = self.prefetched.pop(index, None)
+            for i in range(index + 1, min(index + 1 + self.depth, len(self.modules))):
+                self.prefetch(i, device)
+
+        if entry is None or (entry.dtypes is not None and entry.dtypes != (dtype, bias_dtype)):
+            return None
+        current = torch.cuda.current_stream(device)
+        current.wait_event(entry.event)
+        weight, bias = entry.weight, entry.bias
+        for t in (weight, bias):
+            if t is not None:
+                t.record_stream(current)
+        if entry.dtypes is None:
+            weight, bias = self.prepare(module, weight, bias, dtype, bias_dtype)
+        return weight, bias
+
+    def prepare(self, m, weight, bias, dtype, bias_dtype):
+        # same steps as cast_bias_weight
+        if bias is not None:
+            bias = bias.to(dtype=bias_dtype)
+            for f in m.bias_function:
+                bias = f(bias)
+        if weight is not None:
+            weight = weight.to(dtype=dtype)
+            for f in m.weight_function:
+                weight = f(weight)
+        return weight, bias
+
+    def prefetch(self, index, device):
+        if index in self.prefetched:
+            return
+        if self.log is not None:
+            self.log.append(("prefetch", index))
+        if device is None or device.type != "cuda":
+            self.prefetched[index] = None # nothing to copy
+            return
+        n, m, params = self.modules[index]
+        if self.stream is None:
+            self.stream = torch.cuda.Stream(device=device)
+        start = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+        dtypes = self.dtypes.get(index, None)
+        tensors = {}
+        nbytes = 0
+        with torch.cuda.stream(self.stream):
+            start.record(self.stream)
+            for name, p in params.items():
+                t = torch.empty_like(p, device=device)
+                t.copy_(p, non_blocking=True)
+                tensors[name] = t
+                nbytes += p.nbytes
+            end.record(self.stream)
+            weight, bias = tensors.get("weight", None), tensors.get("bias", None)
+            if dtypes is not None:
+                weight, bias = self.prepare(m, weight, bias, dtypes[0], dtypes[1])
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        self.prefetched[index] = Prefetched(weight, bias, ready, dtypes)
+        self.pending.append((nbytes, start, end))
+
+    def detach(self):
+        with self.lock:
+            self.prefetched.clear()
+            self.pending.clear()
+        for n, m, params in self.modules:
+            if getattr(m, "comfy_prefetch_scheduler", None) is self:
+                del m.comfy_prefetch_scheduler
+                del m.comfy_prefetch_index
+
+
+def ordered(loading, order):
+    """Sorts the entries of a ModelPatcher._load_list() in execution order, modules not in order go last in module order."""
+    if order is None:
+        return list(loading)
+    index = order.index()
+    return sorted(loading, key=lambda x: index.get(x[1], len(index)))
+
+
+def offloaded_params(m, params):
+    if comfy.offload_quantization.quantized_weight(m) is not None: # copied to the device from its quantized copy
+        return None
+    out = {}
+    for name in params:
+        p = getattr(m, name, None)
+        if p is None or p.device.type != "cpu" or type(p.data) is not torch.Tensor:
+            return None
+        out[name] = p
+    return out
+
+
+def offloaded_modules(loading, order=None):
+    """(name, module, {param name: param}) of the modules the ModelPatcher offloaded (lowvram) in execution order."""
+    modules = []
+    for _, n, m, params in ordered(loading, order):
+        if not hasattr(m, "prev_comfy_cast_weights") or len(params) == 0:
+            continue
+        p = offloaded_params(m, params)
+        if p is not None:
+            modules.append((n, m, p))
+    return modules
+
+
+def schedule(model, loading, order=None):
+    """Attaches a PrefetchScheduler to the offloaded modules of model."""
+    unschedule(model)
+    if PREFETCH_DEPTH <= 0:
+        return None
+    modules = offloaded_modules(loading, order)
+    if len(modules) == 0:
+        return None
+    model.prefetch_scheduler = PrefetchScheduler(modules, PREFETCH_DEPTH, order)
+    return model.prefetch_scheduler
+
+
+def unschedule(model):
+    scheduler = getattr(model, "prefetch_scheduler", None)
+    if scheduler is not None:
+        scheduler.detach()
+        model.prefetch_scheduler = None
+
+
+def fetch(module, device, dtype, bias_dtype):
+    scheduler = getattr(module, "comfy_prefetch_scheduler", None)
+    if scheduler is None:
+        return None
+    return scheduler.fetch(module, device, dtype, bias_dtype)
+
+
+@contextlib.contextmanager
+def forward_pass(patcher, x):
+    """
+    Wraps a forward of the model of patcher with input x: on the first forward for the shape of x the execution order
+    is recorded on the patcher and the prefetch scheduler follows it, the pass boundaries are given to the scheduler.
+    """
+    if patcher is None:
+        yield
+        return
+    model = patcher.model
+    key = shape_key(x)
+    order = patcher.execution_orders.pop(key, None)
+    recorder = None
+    if order is not None:
+        patcher.execution_orders[key] = order # most recently used last
+    elif TRACE_DIRECTORY is not None or (PREFETCH_DEPTH > 0 and getattr(model, "model_lowvram", False)):
+        recorder = ExecutionOrderRecorder(model, key)
+
+    scheduler = getattr(model, "prefetch_scheduler", None)
+    if scheduler is not None and order is not None and scheduler.order is not order:
+        scheduler = patcher.schedule_prefetch(order)
+    if scheduler is not None:
+        scheduler.begin_pass()
+    try:
+        if recorder is not None:
+            with recorder:
+                yield
+        else:
+            yield
+    finally:
+        if scheduler is not None:
+            scheduler.end_pass()
+
+    if recorder is not None:
+        order = recorder.order
+        patcher.execution_orders[key] = order
+        logging.debug("Recorded the execution order of {} modules of {} for {}".format(len(order.names), model.__class__.__name__, key))
+        if TRACE_DIRECTORY is not None:
+            os.makedirs(TRACE_DIRECTORY, exist_ok=True)
+            path = os.path.join(TRACE_DIRECTORY, "{}_{}.json".format(model.__class__.__name__, "x".join(map(str, key[0]))))
+            dump_trace(order, path)
+        if scheduler is not None:
+            patcher.schedule_prefetch(order)
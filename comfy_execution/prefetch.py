@@ -0,0 +1,82 @@
+import heapq
+import logging
+import threading
+
+import folder_paths
+import comfy.model_management
+import comfy.model_prefetch
+
+# class_type -> (input holding the file name, models folder)
+PREFETCH_LOADERS = {
+    "CheckpointLoaderSimple": ("ckpt_name", "checkpoints"),
+    "UNETLoader": ("unet_name", "diffusion_models"),
+    "LoraLoader": ("lora_name", "loras"),
+    "LoraLoaderModelOnly": ("lora_name", "loras"),
+    "VAELoader": ("vae_name", "vae"),
+}
+
+
+def prompt_model_files(prompt):
+    """Full paths of the model files the loaders in prompt will read, in prompt order."""
+    files = []
+    for node in prompt.values():
+        loader = PREFETCH_LOADERS.get(node.get("class_type", None), None)
+        if loader is None:
+            continue
+        input_name, folder_name = loader
+        name = node.get("inputs", {}).get(input_name, None)
+        if not isinstance(name, str): # linked or missing input
+            continue
+        path = folder_paths.get_full_path(folder_name, name)
+        if path is not None and path not in files:
+            files.append(path)
+    return files
+
+
+class ModelPrefetcher:
+    """
+    Watches the PromptQueue and stages the model files of the next queued prompts into host RAM
+    while the current prompt executes. Files used by the running prompt are kept but never staged
+    since their models are most likely already loaded or cached.
+    """
+    def __init__(self, prompt_queue, max_bytes, lookahead=2):
+        self.prompt_queue = prompt_queue
+        self.store = comfy.model_prefetch.enable_staging(max_bytes)
+        self.lookahead = lookahead
+        self.pin = comfy.model_management.MAX_PINNED_MEMORY > 0
+        self.changed = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True, name="model_prefetch")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def queue_changed(self):
+        self.changed.set()
+
+    def plan(self):
+        running, queued = self.prompt_queue.get_current_queue_volatile()
+        in_use = []
+        for item in running:
+            in_use += prompt_model_files(item[2])
+
+        wanted = []
+        for item in heapq.nsmallest(self.lookahead, queued):
+            for path in prompt_model_files(item[2]):
+                if path not in in_use and path not in wanted:
+                    wanted.append(path)
+        return in_use, wanted
+
+    def run(self):
+        while True:
+            self.changed.wait()
+            self.changed.clear()
+            try:
+                in_use, wanted = self.plan()
+                self.store.retain(in_use + wanted)
+                for path in wanted:
+                    if self.changed.is_set():
+                        break
+                    self.store.stage(path, pin=self.pin)
+            except Exception as e:
+                logging.warning("Model prefetch failed: {}".format(e))
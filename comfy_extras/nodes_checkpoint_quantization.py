@@ -0,0 +1,55 @@
+import os
+
+import comfy.checkpoint_quantization
+import comfy.samplers
+import folder_paths
+from typing_extensions import override
+from comfy_api.latest import ComfyExtension, io
+
+
+class CheckpointQuantizeSave(io.ComfyNode):
+    @classmethod
+    def define_schema(cls):
+        return io.Schema(
+            node_id="CheckpointQuantizeSave",
+            display_name="Quantize and Save Checkpoint",
+            category="advanced/model_merging",
+            inputs=[
+                io.Model.Input("model"),
+                io.Conditioning.Input("positive", tooltip="Conditioning the calibration samples with."),
+                io.Conditioning.Input("negative"),
+                io.Latent.Input("latent_image", tooltip="Latents the calibration starts from, their size should match the intended use."),
+                io.Int.Input("steps", default=4, min=1, max=100, tooltip="Number of sigmas the model is calibrated at."),
+                io.Float.Input("cfg", default=1.0, min=0.0, max=100.0, step=0.1, round=0.01),
+                io.Combo.Input("sampler_name", options=comfy.samplers.SAMPLER_NAMES, default="euler"),
+                io.Combo.Input("scheduler", options=comfy.samplers.SCHEDULER_NAMES, default="simple"),
+                io.Int.Input("seed", default=0, min=0, max=0xffffffffffffffff, control_after_generate=True),
+                io.Float.Input("max_error", default=comfy.checkpoint_quantization.MAX_ERROR, min=0.0, max=1.0, step=0.005,
+                               tooltip="Layers with a larger mean relative output error during calibration are kept in their original precision."),
+                io.String.Input("filename_prefix", default="checkpoints/ComfyUI_fp8"),
+                io.Clip.Input("clip", optional=True),
+                io.Vae.Input("vae", optional=True),
+            ],
+            is_experimental=True,
+            is_output_node=True,
+        )
+
+    @classmethod
+    def execute(cls, model, positive, negative, latent_image, steps, cfg, sampler_name, scheduler, seed, max_error, filename_prefix, clip=None, vae=None) -> io.NodeOutput:
+        stats = comfy.checkpoint_quantization.calibrate(model, positive, negative, latent_image["samples"], steps=steps, cfg=cfg, sampler_name=sampler_name, scheduler=scheduler, seed=seed)
+        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, folder_paths.get_output_directory())
+        output_checkpoint = os.path.join(full_output_folder, f"{filename}_{counter:05}_.safetensors")
+        comfy.checkpoint_quantization.save_quantized_checkpoint(output_checkpoint, model, clip=clip, vae=vae, stats=stats, max_error=max_error)
+        return io.NodeOutput()
+
+
+class CheckpointQuantizationExtension(ComfyExtension):
+    @override
+    async def get_node_list(self) -> list[type[io.ComfyNode]]:
+        return [
+            CheckpointQuantizeSave,
+        ]
+
+
+async def comfy_entrypoint() -> CheckpointQuantizationExtension:
+    return CheckpointQuantizationExtension()
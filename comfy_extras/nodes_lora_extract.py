@@ -1,16 +1,22 @@
 import torch
 import comfy.model_management
+import comfy.safetensors_writer
 import comfy.utils
 import folder_paths
 import os
 import logging
+import threading
+import concurrent.futures
 from enum import Enum
 from typing_extensions import override
 from comfy_api.latest import ComfyExtension, io
 
 CLAMP_QUANTILE = 0.99
+SVD_METHODS = ("randomized", "full")
+OVERSAMPLE = 8 # extra random directions of the randomized svd
+NITER = 4 # power iterations of the randomized svd
 
-def extract_lora(diff, rank):
+def extract_lora(diff, rank, svd_method="full"):
     conv2d = (len(diff.shape) == 4)
     kernel_size = None if not conv2d else diff.size()[2:4]
     conv2d_3x3 = conv2d and kernel_size != (1, 1)
@@ -23,8 +29,13 @@ def extract_lora(diff, rank):
         else:
             diff = diff.squeeze()
 
-
-    U, S, Vh = torch.linalg.svd(diff.float())
+    diff = diff.float()
+    q = min(rank + OVERSAMPLE, diff.shape[0], diff.shape[1])
+    if svd_method == "randomized" and q < min(diff.shape):
+        U, S, V = torch.svd_lowrank(diff, q=q, niter=NITER)
+        Vh = V.T
+    else:
+        U, S, Vh = torch.linalg.svd(diff, full_matrices=False)
     U = U[:, :rank]
     S = S[:rank]
     U = U @ torch.diag(S)
@@ -41,6 +52,43 @@ def extract_lora(diff, rank):
         Vh = Vh.reshape(rank, in_dim, kernel_size[0], kernel_size[1])
     return (U, Vh)
 
+def reconstruction_error(diff, up, down):
+    """Relative Frobenius norm error of the up @ down approximation of diff."""
+    diff = diff.float().flatten(start_dim=1)
+    norm = diff.norm()
+    if norm == 0:
+        return 0.0
+    return ((diff - up.float().flatten(start_dim=1) @ down.float().flatten(start_dim=1)) / norm).norm().item()
+
+def svd_memory(shape, rank, svd_method):
+    """Rough estimate of the bytes needed to extract a lora from a weight diff of shape."""
+    out_dim = shape[0]
+    in_dim = 1
+    for s in shape[1:]:
+        in_dim *= s
+    k = min(out_dim, in_dim) if svd_method == "full" else min(rank + OVERSAMPLE, out_dim, in_dim)
+    return 4 * (3 * out_dim * in_dim + (out_dim + in_dim + k) * k)
+
+class MemoryBudget:
+    """Bytes shared by the extraction workers, a job larger than the whole budget runs alone."""
+    def __init__(self, total):
+        self.total = max(1, int(total))
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, n):
+        n = min(n, self.total)
+        with self.condition:
+            while self.used + n > self.total:
+                self.condition.wait()
+            self.used += n
+        return n
+
+    def release(self, n):
+        with self.condition:
+            self.used -= n
+            self.condition.notify_all()
+
 class LORAType(Enum):
     STANDARD = 0
     FULL_DIFF = 1
@@ -48,29 +96,79 @@ class LORAType(Enum):
 LORA_TYPES = {"standard": LORAType.STANDARD,
               "full_diff": LORAType.FULL_DIFF}
 
-def calc_lora_model(model_diff, rank, prefix_model, prefix_lora, output_sd, lora_type, bias_diff=False):
-    comfy.model_management.load_models_gpu([model_diff], force_patch_weights=True)
-    sd = model_diff.model_state_dict(filter_prefix=prefix_model)
-
-    for k in sd:
+def lora_keys(sd, rank, prefix_model, prefix_lora, lora_type, bias_diff=False):
+    """{state dict key: [(output key, shape)]} of the tensors extracted from the weight diffs in sd."""
+    out = {}
+    for k, w in sd.items():
         if k.endswith(".weight"):
-            weight_diff = sd[k]
-            if lora_type == LORAType.STANDARD:
-                if weight_diff.ndim < 2:
-                    if bias_diff:
-                        output_sd["{}{}.diff".format(prefix_lora, k[len(prefix_model):-7])] = weight_diff.contiguous().half().cpu()
+            name = "{}{}".format(prefix_lora, k[len(prefix_model):-7])
+            if lora_type == LORAType.STANDARD and w.ndim >= 2:
+                if w.ndim not in (2, 4):
+                    logging.warning("Could not generate lora weights for key {}, unsupported shape {}".format(k, tuple(w.shape)))
                     continue
-                try:
-                    out = extract_lora(weight_diff, rank)
-                    output_sd["{}{}.lora_up.weight".format(prefix_lora, k[len(prefix_model):-7])] = out[0].contiguous().half().cpu()
-                    output_sd["{}{}.lora_down.weight".format(prefix_lora, k[len(prefix_model):-7])] = out[1].contiguous().half().cpu()
-                except:
-                    logging.warning("Could not generate lora weights for key {}, is the weight difference a zero?".format(k))
-            elif lora_type == LORAType.FULL_DIFF:
-                output_sd["{}{}.diff".format(prefix_lora, k[len(prefix_model):-7])] = weight_diff.contiguous().half().cpu()
-
+                r = min(rank, w.shape[0], w.shape[1])
+                up = (w.shape[0], r) + ((1, 1) if w.ndim == 4 else ())
+                out[k] = [("{}.lora_up.weight".format(name), up), ("{}.lora_down.weight".format(name), (r,) + tuple(w.shape[1:]))]
+            elif lora_type == LORAType.FULL_DIFF or bias_diff:
+                out[k] = [("{}.diff".format(name), tuple(w.shape))]
         elif bias_diff and k.endswith(".bias"):
-            output_sd["{}{}.diff_b".format(prefix_lora, k[len(prefix_model):-5])] = sd[k].contiguous().half().cpu()
+            out[k] = [("{}{}.diff_b".format(prefix_lora, k[len(prefix_model):-5]), tuple(w.shape))]
+    return out
+
+def log_errors(errors):
+    if len(errors) == 0:
+        return
+    worst = sorted(errors.items(), key=lambda e: e[1], reverse=True)[:5]
+    logging.info("Extracted {} lora layers, relative reconstruction error mean {:.4f} max {:.4f}, worst: {}".format(
+        len(errors), sum(errors.values()) / len(errors), worst[0][1], ", ".join("{} {:.4f}".format(k, e) for k, e in worst)))
+
+def calc_lora_model(model_diff, rank, prefix_model, prefix_lora, output_sd, lora_type, bias_diff=False, svd_method="full", workers=1, memory_budget=None, errors=None):
+    """
+    Extracts the lora of the weight diffs of model_diff into output_sd, which can be a dict or a SafetensorsWriter
+    with the entries of lora_keys(). The layers are decomposed by a pool of workers, memory_budget (bytes, default
+    half the free memory of the device) limits the svds running at the same time. The relative reconstruction error
+    of every lora layer is stored in errors.
+    """
+    comfy.model_management.load_models_gpu([model_diff], force_patch_weights=True)
+    sd = model_diff.model_state_dict(filter_prefix=prefix_model)
+    keys = lora_keys(sd, rank, prefix_model, prefix_lora, lora_type, bias_diff=bias_diff)
+    if errors is None:
+        errors = {}
+    if memory_budget is None:
+        memory_budget = comfy.model_management.get_free_memory(model_diff.load_device) // 2
+    budget = MemoryBudget(memory_budget)
+
+    def extract(k):
+        diff = sd[k]
+        n = budget.acquire(svd_memory(diff.shape, rank, svd_method))
+        try:
+            up, down = extract_lora(diff, rank, svd_method)
+            error = reconstruction_error(diff, up, down)
+        finally:
+            budget.release(n)
+        return up.half().cpu(), down.half().cpu(), error
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {}
+        for k, outputs in keys.items():
+            if len(outputs) == 2:
+                futures[pool.submit(extract, k)] = k
+            else:
+                output_sd[outputs[0][0]] = sd[k].contiguous().half().cpu()
+
+        for future in concurrent.futures.as_completed(futures):
+            k = futures[future]
+            try:
+                up, down, error = future.result()
+            except Exception:
+                # left zeroed by a SafetensorsWriter which is a lora that does nothing
+                logging.warning("Could not generate lora weights for key {}, is the weight difference a zero?".format(k))
+                continue
+            (up_key, _), (down_key, _) = keys[k]
+            output_sd[up_key] = up.contiguous()
+            output_sd[down_key] = down.contiguous()
+            errors[up_key[:-len(".lora_up.weight")]] = error
+            logging.debug("lora {} relative reconstruction error {:.4f}".format(k, error))
     return output_sd
 
 class LoraSave(io.ComfyNode):
@@ -85,6 +183,8 @@ class LoraSave(io.ComfyNode):
                 io.Int.Input("rank", default=8, min=1, max=4096, step=1),
                 io.Combo.Input("lora_type", options=tuple(LORA_TYPES.keys())),
                 io.Boolean.Input("bias_diff", default=True),
+                io.Combo.Input("svd_method", options=SVD_METHODS, default="randomized", tooltip="randomized computes only the top singular vectors, much faster than the full svd for low ranks.", optional=True),
+                io.Int.Input("workers", default=4, min=1, max=64, tooltip="Number of layers decomposed at the same time.", optional=True),
                 io.Model.Input(
                     "model_diff",
                     tooltip="The ModelSubtract output to be converted to a lora.",
@@ -101,23 +201,34 @@ class LoraSave(io.ComfyNode):
         )
 
     @classmethod
-    def execute(cls, filename_prefix, rank, lora_type, bias_diff, model_diff=None, text_encoder_diff=None) -> io.NodeOutput:
+    def execute(cls, filename_prefix, rank, lora_type, bias_diff, svd_method="randomized", workers=4, model_diff=None, text_encoder_diff=None) -> io.NodeOutput:
         if model_diff is None and text_encoder_diff is None:
             return io.NodeOutput()
 
         lora_type = LORA_TYPES.get(lora_type)
         full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, folder_paths.get_output_directory())
 
-        output_sd = {}
+        sources = []
         if model_diff is not None:
-            output_sd = calc_lora_model(model_diff, rank, "diffusion_model.", "diffusion_model.", output_sd, lora_type, bias_diff=bias_diff)
+            sources.append((model_diff, "diffusion_model.", "diffusion_model."))
         if text_encoder_diff is not None:
-            output_sd = calc_lora_model(text_encoder_diff.patcher, rank, "", "text_encoders.", output_sd, lora_type, bias_diff=bias_diff)
+            sources.append((text_encoder_diff.patcher, "", "text_encoders."))
+
+        # the header is written first so that the tensors can be streamed to the file as they are extracted
+        entries = {}
+        for patcher, prefix_model, prefix_lora in sources:
+            for outputs in lora_keys(patcher.model_state_dict(filter_prefix=prefix_model), rank, prefix_model, prefix_lora, lora_type, bias_diff=bias_diff).values():
+                for key, shape in outputs:
+                    entries[key] = (shape, torch.float16)
 
         output_checkpoint = f"{filename}_{counter:05}_.safetensors"
         output_checkpoint = os.path.join(full_output_folder, output_checkpoint)
 
-        comfy.utils.save_torch_file(output_sd, output_checkpoint, metadata=None)
+        errors = {}
+        with comfy.safetensors_writer.SafetensorsWriter(output_checkpoint, entries) as writer:
+            for patcher, prefix_model, prefix_lora in sources:
+                calc_lora_model(patcher, rank, prefix_model, prefix_lora, writer, lora_type, bias_diff=bias_diff, svd_method=svd_method, workers=workers, errors=errors)
+        log_errors(errors)
         return io.NodeOutput()
 
 
@@ -273,8 +273,7 @@ class CLIPSave:
                 for x in extra_pnginfo:
                     metadata[x] = json.dumps(extra_pnginfo[x])
 
-        comfy.model_management.load_models_gpu([clip.load_model()], force_patch_weights=True)
-        clip_sd = clip.get_sd()
+        clip_sd, lazy = comfy.sd.lazy_patched_state_dict([clip.patcher], clip.get_sd)
 
         for prefix in ["clip_l.", "clip_g.", "clip_h.", "t5xxl.", "pile_t5xl.", "mt5xl.", "umt5xxl.", "t5base.", "gemma2_2b.", "llama.", "hydit_clip.", ""]:
             k = list(filter(lambda a: a.startswith(prefix), clip_sd.keys()))
@@ -297,9 +296,10 @@ class CLIPSave:
             output_checkpoint = f"{filename}_{counter:05}_.safetensors"
             output_checkpoint = os.path.join(full_output_folder, output_checkpoint)
 
+            current_lazy = comfy.utils.state_dict_prefix_replace({x: lazy[x] for x in current_clip_sd if x in lazy}, replace_prefix)
             current_clip_sd = comfy.utils.state_dict_prefix_replace(current_clip_sd, replace_prefix)
 
-            comfy.utils.save_torch_file(current_clip_sd, output_checkpoint, metadata=metadata)
+            comfy.sd.save_state_dict(current_clip_sd, output_checkpoint, metadata=metadata, lazy=current_lazy)
         return {}
 
 class VAESave:
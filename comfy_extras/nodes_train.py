@@ -11,10 +11,12 @@ from PIL.PngImagePlugin import PngInfo
 import torch.utils.checkpoint
 import tqdm
 
+import comfy.sampler_helpers
 import comfy.samplers
 import comfy.sd
 import comfy.utils
 import comfy.model_management
+import comfy.training_dataset
 import comfy_extras.nodes_custom_sampler
 import folder_paths
 import node_helpers
@@ -56,7 +58,8 @@ def process_cond_list(d, prefix=""):
 
 
 class TrainSampler(comfy.samplers.Sampler):
-    def __init__(self, loss_fn, optimizer, loss_callback=None, batch_size=1, grad_acc=1, total_steps=1, seed=0, training_dtype=torch.bfloat16):
+    def __init__(self, loss_fn, optimizer, loss_callback=None, batch_size=1, grad_acc=1, total_steps=1, seed=0, training_dtype=torch.bfloat16, dataset=None):
+        self.dataset = dataset # comfy.training_dataset.TrainingDataset streamed instead of latent_image and the positive conds
         self.loss_fn = loss_fn
         self.optimizer = optimizer
         self.loss_callback = loss_callback
@@ -70,49 +73,65 @@ class TrainSampler(comfy.samplers.Sampler):
         model_wrap.conds = process_cond_list(model_wrap.conds)
         cond = model_wrap.conds["positive"]
         dataset_size = sigmas.size(0)
+        batches = None
+        if self.dataset is not None:
+            schedule = [torch.randperm(dataset_size)[:self.batch_size].tolist() for _ in range(self.total_steps)]
+            batches = self.dataset.batches(schedule)
         torch.cuda.empty_cache()
-        for i in (pbar:=tqdm.trange(self.total_steps, desc="Training LoRA", smoothing=0.01, disable=not comfy.utils.PROGRESS_BAR_ENABLED)):
-            noisegen = comfy_extras.nodes_custom_sampler.Noise_RandomNoise(self.seed + i * 1000)
-            indicies = torch.randperm(dataset_size)[:self.batch_size].tolist()
-
-            batch_latent = torch.stack([latent_image[i] for i in indicies])
-            batch_noise = noisegen.generate_noise({"samples": batch_latent}).to(batch_latent.device)
-            batch_sigmas = [
-                model_wrap.inner_model.model_sampling.percent_to_sigma(
-                    torch.rand((1,)).item()
-                ) for _ in range(min(self.batch_size, dataset_size))
-            ]
-            batch_sigmas = torch.tensor(batch_sigmas).to(batch_latent.device)
-
-            xt = model_wrap.inner_model.model_sampling.noise_scaling(
-                batch_sigmas,
-                batch_noise,
-                batch_latent,
-                False
-            )
-            x0 = model_wrap.inner_model.model_sampling.noise_scaling(
-                torch.zeros_like(batch_sigmas),
-                torch.zeros_like(batch_noise),
-                batch_latent,
-                False
-            )
+        try:
+            for i in (pbar:=tqdm.trange(self.total_steps, desc="Training LoRA", smoothing=0.01, disable=not comfy.utils.PROGRESS_BAR_ENABLED)):
+                noisegen = comfy_extras.nodes_custom_sampler.Noise_RandomNoise(self.seed + i * 1000)
+                if batches is not None:
+                    indicies = schedule[i]
+                    batch_latent, batch_cond = next(batches)
+                    batch_latent = model_wrap.inner_model.process_latent_in(batch_latent.to(latent_image))
+                else:
+                    indicies = torch.randperm(dataset_size)[:self.batch_size].tolist()
+                    batch_latent = torch.stack([latent_image[i] for i in indicies])
+                batch_noise = noisegen.generate_noise({"samples": batch_latent}).to(batch_latent.device)
+                batch_sigmas = [
+                    model_wrap.inner_model.model_sampling.percent_to_sigma(
+                        torch.rand((1,)).item()
+                    ) for _ in range(min(self.batch_size, dataset_size))
+                ]
+                batch_sigmas = torch.tensor(batch_sigmas).to(batch_latent.device)
+
+                xt = model_wrap.inner_model.model_sampling.noise_scaling(
+                    batch_sigmas,
+                    batch_noise,
+                    batch_latent,
+                    False
+                )
+                x0 = model_wrap.inner_model.model_sampling.noise_scaling(
+                    torch.zeros_like(batch_sigmas),
+                    torch.zeros_like(batch_noise),
+                    batch_latent,
+                    False
+                )
 
-            model_wrap.conds["positive"] = [
-                cond[i] for i in indicies
-            ]
-            batch_extra_args = make_batch_extra_option_dict(extra_args, indicies, full_size=dataset_size)
-
-            with torch.autocast(xt.device.type, dtype=self.training_dtype):
-                x0_pred = model_wrap(xt, batch_sigmas, **batch_extra_args)
-                loss = self.loss_fn(x0_pred, x0)
-            loss.backward()
-            if self.loss_callback:
-                self.loss_callback(loss.item())
-            pbar.set_postfix({"loss": f"{loss.item():.4f}"})
-
-            if (i+1) % self.grad_acc == 0:
-                self.optimizer.step()
-                self.optimizer.zero_grad()
+                if batches is not None:
+                    conds = {"positive": comfy.sampler_helpers.convert_cond(batch_cond)}
+                    model_wrap.conds["positive"] = comfy.samplers.process_conds(model_wrap.inner_model, batch_noise, conds, batch_latent.device, batch_latent, seed=self.seed)["positive"]
+                else:
+                    model_wrap.conds["positive"] = [
+                        cond[i] for i in indicies
+                    ]
+                batch_extra_args = make_batch_extra_option_dict(extra_args, indicies, full_size=dataset_size)
+
+                with torch.autocast(xt.device.type, dtype=self.training_dtype):
+                    x0_pred = model_wrap(xt, batch_sigmas, **batch_extra_args)
+                    loss = self.loss_fn(x0_pred, x0)
+                loss.backward()
+                if self.loss_callback:
+                    self.loss_callback(loss.item())
+                pbar.set_postfix({"loss": f"{loss.item():.4f}"})
+
+                if (i+1) % self.grad_acc == 0:
+                    self.optimizer.step()
+                    self.optimizer.zero_grad()
+        finally:
+            if batches is not None:
+                batches.close()
         torch.cuda.empty_cache()
         return torch.zeros_like(latent_image)
 
@@ -134,13 +153,44 @@ class BiasDiff(torch.nn.Module):
         return self.passive_memory_usage()
 
 
-def load_and_process_images(image_files, input_dir, resize_method="None", w=None, h=None):
+def load_and_process_image(image_path, resize_method="None", w=None, h=None):
+    img = node_helpers.pillow(Image.open, image_path)
+
+    if img.mode == "I":
+        img = img.point(lambda i: i * (1 / 255))
+    img = img.convert("RGB")
+
+    # Resize image to first image
+    if img.size[0] != w or img.size[1] != h:
+        if resize_method == "Stretch":
+            img = img.resize((w, h), Image.Resampling.LANCZOS)
+        elif resize_method == "Crop":
+            img = img.crop((0, 0, w, h))
+        elif resize_method == "Pad":
+            img = img.resize((w, h), Image.Resampling.LANCZOS)
+        elif resize_method == "None":
+            raise ValueError(
+                "Your input image size does not match the first image in the dataset. Either select a valid resize method or use the same size for all images."
+            )
+
+    img_array = np.array(img).astype(np.float32) / 255.0
+    return torch.from_numpy(img_array)[None,]
+
+
+def first_image_size(image_files, input_dir, w=None, h=None):
+    if w is None and h is None:
+        w, h = node_helpers.pillow(Image.open, os.path.join(input_dir, image_files[0])).size
+    return w, h
+
+
+def load_and_process_images(image_files, input_dir, resize_method="None", w=None, h=None, workers=4):
     """Utility function to load and process a list of images.
 
     Args:
         image_files: List of image filenames
         input_dir: Base directory containing the images
         resize_method: How to handle images of different sizes ("None", "Stretch", "Crop", "Pad")
+        workers: Number of threads decoding the images
 
     Returns:
         torch.Tensor: Batch of processed images
@@ -148,36 +198,9 @@ def load_and_process_images(image_files, input_dir, resize_method="None", w=None
     if not image_files:
         raise ValueError("No valid images found in input")
 
-    output_images = []
-
-    for file in image_files:
-        image_path = os.path.join(input_dir, file)
-        img = node_helpers.pillow(Image.open, image_path)
-
-        if img.mode == "I":
-            img = img.point(lambda i: i * (1 / 255))
-        img = img.convert("RGB")
-
-        if w is None and h is None:
-            w, h = img.size[0], img.size[1]
-
-        # Resize image to first image
-        if img.size[0] != w or img.size[1] != h:
-            if resize_method == "Stretch":
-                img = img.resize((w, h), Image.Resampling.LANCZOS)
-            elif resize_method == "Crop":
-                img = img.crop((0, 0, w, h))
-            elif resize_method == "Pad":
-                img = img.resize((w, h), Image.Resampling.LANCZOS)
-            elif resize_method == "None":
-                raise ValueError(
-                    "Your input image size does not match the first image in the dataset. Either select a valid resize method or use the same size for all images."
-                )
-
-        img_array = np.array(img).astype(np.float32) / 255.0
-        img_tensor = torch.from_numpy(img_array)[None,]
-        output_images.append(img_tensor)
-
+    w, h = first_image_size(image_files, input_dir, w, h)
+    paths = [os.path.join(input_dir, file) for file in image_files]
+    output_images = comfy.training_dataset.load_images(paths, lambda path: load_and_process_image(path, resize_method, w, h), workers=workers)
     return torch.cat(output_images, dim=0)
 
 
@@ -313,35 +336,8 @@ class LoadImageTextSetFromFolderNode:
         logging.info(f"Loading images from folder: {folder}")
 
         sub_input_dir = os.path.join(folder_paths.get_input_directory(), folder)
-        valid_extensions = [".png", ".jpg", ".jpeg", ".webp"]
-
-        image_files = []
-        for item in os.listdir(sub_input_dir):
-            path = os.path.join(sub_input_dir, item)
-            if any(item.lower().endswith(ext) for ext in valid_extensions):
-                image_files.append(path)
-            elif os.path.isdir(path):
-                # Support kohya-ss/sd-scripts folder structure
-                repeat = 1
-                if item.split("_")[0].isdigit():
-                    repeat = int(item.split("_")[0])
-                image_files.extend([
-                    os.path.join(path, f) for f in os.listdir(path) if any(f.lower().endswith(ext) for ext in valid_extensions)
-                ] * repeat)
-
-        caption_file_path = [
-            f.replace(os.path.splitext(f)[1], ".txt")
-            for f in image_files
-        ]
-        captions = []
-        for caption_file in caption_file_path:
-            caption_path = os.path.join(sub_input_dir, caption_file)
-            if os.path.exists(caption_path):
-                with open(caption_path, "r", encoding="utf-8") as f:
-                    caption = f.read().strip()
-                    captions.append(caption)
-            else:
-                captions.append("")
+        image_files, caption_files = comfy.training_dataset.list_image_caption_files(sub_input_dir)
+        captions = [comfy.training_dataset.read_caption(f) for f in caption_files]
 
         width = width if width != -1 else None
         height = height if height != -1 else None
@@ -361,6 +357,75 @@ class LoadImageTextSetFromFolderNode:
         return (output_tensor, conditions)
 
 
+class LoadTrainingDatasetFromFolderNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "folder": (folder_paths.get_input_subfolders(), {"tooltip": "The folder to load images and captions from."}),
+                "vae": (IO.VAE, {"tooltip": "The VAE model used for encoding the images."}),
+                "clip": (IO.CLIP, {"tooltip": "The CLIP model used for encoding the captions."}),
+            },
+            "optional": {
+                "resize_method": (
+                    ["None", "Stretch", "Crop", "Pad"],
+                    {"default": "None"},
+                ),
+                "width": (
+                    IO.INT,
+                    {
+                        "default": -1,
+                        "min": -1,
+                        "max": 10000,
+                        "step": 1,
+                        "tooltip": "The width to resize the images to. -1 means use the original width.",
+                    },
+                ),
+                "height": (
+                    IO.INT,
+                    {
+                        "default": -1,
+                        "min": -1,
+                        "max": 10000,
+                        "step": 1,
+                        "tooltip": "The height to resize the images to. -1 means use the original height.",
+                    },
+                ),
+                "workers": (
+                    IO.INT,
+                    {
+                        "default": 4,
+                        "min": 1,
+                        "max": 64,
+                        "tooltip": "The number of threads decoding the images and loading the cached training data.",
+                    },
+                ),
+            },
+        }
+
+    RETURN_TYPES = ("TRAINING_DATASET",)
+    FUNCTION = "load_dataset"
+    CATEGORY = "loaders"
+    EXPERIMENTAL = True
+    DESCRIPTION = "Encodes the images and captions of a folder into a dataset cache on disk that the Train LoRA node streams from. Encoded images and captions are reused by later runs."
+
+    def load_dataset(self, folder, vae, clip, resize_method="None", width=-1, height=-1, workers=4):
+        if clip is None:
+            raise RuntimeError("ERROR: clip input is invalid: None\n\nIf the clip is from a checkpoint loader node your checkpoint does not contain a valid clip or text encoder model.")
+
+        sub_input_dir = os.path.join(folder_paths.get_input_directory(), folder)
+        image_files, caption_files = comfy.training_dataset.list_image_caption_files(sub_input_dir)
+        if not image_files:
+            raise ValueError("No valid images found in input")
+        captions = [comfy.training_dataset.read_caption(f) for f in caption_files]
+
+        width, height = first_image_size(image_files, sub_input_dir, width if width != -1 else None, height if height != -1 else None)
+        cache = comfy.training_dataset.DatasetCache(os.path.join(folder_paths.get_user_directory(), "training_cache"), max_bytes=int(args.training_cache_size * 1024 * 1024 * 1024))
+        dataset = comfy.training_dataset.build_dataset(cache, image_files, captions, vae, clip, load_and_process_image, resize_method, width, height, workers=workers)
+        logging.info(f"Loaded a dataset of {len(dataset)} images from {sub_input_dir}.")
+        return (dataset,)
+
+
 def draw_loss_graph(loss_map, steps):
     width, height = 500, 300
     img = Image.new("RGB", (width, height), "white")
@@ -418,16 +483,6 @@ class TrainLoraNode:
         return {
             "required": {
                 "model": (IO.MODEL, {"tooltip": "The model to train the LoRA on."}),
-                "latents": (
-                    "LATENT",
-                    {
-                        "tooltip": "The Latents to use for training, serve as dataset/input of the model."
-                    },
-                ),
-                "positive": (
-                    IO.CONDITIONING,
-                    {"tooltip": "The positive conditioning to use for training."},
-                ),
                 "batch_size": (
                     IO.INT,
                     {
@@ -526,6 +581,22 @@ class TrainLoraNode:
                     },
                 ),
             },
+            "optional": {
+                "latents": (
+                    "LATENT",
+                    {
+                        "tooltip": "The Latents to use for training, serve as dataset/input of the model."
+                    },
+                ),
+                "positive": (
+                    IO.CONDITIONING,
+                    {"tooltip": "The positive conditioning to use for training."},
+                ),
+                "dataset": (
+                    "TRAINING_DATASET",
+                    {"tooltip": "A dataset streamed from disk during training, replaces the latents and positive conditioning."},
+                ),
+            },
         }
 
     RETURN_TYPES = (IO.MODEL, IO.LORA_MODEL, IO.LOSS_MAP, IO.INT)
@@ -537,8 +608,6 @@ class TrainLoraNode:
     def train(
         self,
         model,
-        latents,
-        positive,
         batch_size,
         steps,
         grad_accumulation_steps,
@@ -552,21 +621,33 @@ class TrainLoraNode:
         algorithm,
         gradient_checkpointing,
         existing_lora,
+        latents=None,
+        positive=None,
+        dataset=None,
     ):
         mp = model.clone()
         dtype = node_helpers.string_to_torch_dtype(training_dtype)
         lora_dtype = node_helpers.string_to_torch_dtype(lora_dtype)
         mp.set_model_compute_dtype(dtype)
 
-        latents = latents["samples"].to(dtype)
-        num_images = latents.shape[0]
-        logging.info(f"Total Images: {num_images}, Total Captions: {len(positive)}")
-        if len(positive) == 1 and num_images > 1:
-            positive = positive * num_images
-        elif len(positive) != num_images:
-            raise ValueError(
-                f"Number of positive conditions ({len(positive)}) does not match number of images ({num_images})."
-            )
+        if dataset is not None:
+            # the guider is set up with the first item, the sampler streams the batches
+            latent, positive = dataset.load(0)
+            latents = latent.unsqueeze(0).to(dtype)
+            num_images = len(dataset)
+            logging.info(f"Total Images: {num_images}, streamed from the dataset cache")
+        elif latents is None or positive is None:
+            raise ValueError("Either a dataset or the latents and positive conditioning are required for training.")
+        else:
+            latents = latents["samples"].to(dtype)
+            num_images = latents.shape[0]
+            logging.info(f"Total Images: {num_images}, Total Captions: {len(positive)}")
+            if len(positive) == 1 and num_images > 1:
+                positive = positive * num_images
+            elif len(positive) != num_images:
+                raise ValueError(
+                    f"Number of positive conditions ({len(positive)}) does not match number of images ({num_images})."
+                )
 
         with torch.inference_mode(False):
             lora_sd = {}
@@ -674,7 +755,8 @@ class TrainLoraNode:
                 grad_acc=grad_accumulation_steps,
                 total_steps=steps*grad_accumulation_steps,
                 seed=seed,
-                training_dtype=dtype
+                training_dtype=dtype,
+                dataset=dataset,
             )
             guider = comfy_extras.nodes_custom_sampler.Guider_Basic(mp)
             guider.set_conds(positive)  # Set conditioning from input
@@ -882,6 +964,7 @@ NODE_CLASS_MAPPINGS = {
     "LoraModelLoader": LoraModelLoader,
     "LoadImageSetFromFolderNode": LoadImageSetFromFolderNode,
     "LoadImageTextSetFromFolderNode": LoadImageTextSetFromFolderNode,
+    "LoadTrainingDatasetFromFolderNode": LoadTrainingDatasetFromFolderNode,
     "LossGraphNode": LossGraphNode,
 }
 
@@ -891,5 +974,6 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "LoraModelLoader": "Load LoRA Model",
     "LoadImageSetFromFolderNode": "Load Image Dataset from Folder",
     "LoadImageTextSetFromFolderNode": "Load Image and Text Dataset from Folder",
+    "LoadTrainingDatasetFromFolderNode": "Load Cached Training Dataset from Folder",
     "LossGraphNode": "Plot Loss Graph",
 }
@@ -1,8 +1,11 @@
 import logging
+import os
 from spandrel import ModelLoader, ImageModelDescriptor
 from comfy import model_management
+from comfy.cli_args import args
 import torch
 import comfy.utils
+import comfy.upscale_tiling
 import folder_paths
 from typing_extensions import override
 from comfy_api.latest import ComfyExtension, io
@@ -46,6 +49,15 @@ class UpscaleModelLoader(io.ComfyNode):
     load_model = execute  # TODO: remove
 
 
+TILE_MEMORY_STORE = None
+
+def get_tile_memory_store():
+    global TILE_MEMORY_STORE
+    if TILE_MEMORY_STORE is None:
+        TILE_MEMORY_STORE = comfy.upscale_tiling.TileMemoryStore(os.path.join(folder_paths.get_user_directory(), "upscale_tile_memory.json"))
+    return TILE_MEMORY_STORE
+
+
 class ImageUpscaleWithModel(io.ComfyNode):
     @classmethod
     def define_schema(cls):
@@ -74,17 +86,33 @@ class ImageUpscaleWithModel(io.ComfyNode):
         upscale_model.to(device)
         in_img = image.movedim(-1,-3).to(device)
 
-        tile = 512
         overlap = 32
+        workers = model_management.tile_workers(device)
+        try:
+            memory_model = get_tile_memory_store().get(upscale_model, device)
+            memory_budget = model_management.get_free_memory(device) * 0.9
+            if model_management.is_device_cpu(device):
+                # the output of tiled_scale (and the blending buffers of one image) is allocated in the same RAM
+                output_pixels = in_img.shape[2] * in_img.shape[3] * upscale_model.scale ** 2
+                memory_budget -= output_pixels * (in_img.shape[0] * 3 + 4) * 4
+            tile, tile_batch = comfy.upscale_tiling.plan_tiles(memory_model, in_img.shape[3], in_img.shape[2], max(memory_budget, 0) / workers, overlap=overlap, max_tile=comfy.upscale_tiling.MAX_TILE)
+            if not args.upscale_tile_batch: # batched tiles aren't batch invariant
+                tile_batch = 1
+        except model_management.OOM_EXCEPTION:
+            tile, tile_batch = 512, 1
+        logging.debug("Upscaling with tile {} and {} tiles per batch".format(tile, tile_batch))
 
         oom = True
         while oom:
             try:
                 steps = in_img.shape[0] * comfy.utils.get_tiled_scale_steps(in_img.shape[3], in_img.shape[2], tile_x=tile, tile_y=tile, overlap=overlap)
                 pbar = comfy.utils.ProgressBar(steps)
-                s = comfy.utils.tiled_scale(in_img, lambda a: upscale_model(a), tile_x=tile, tile_y=tile, overlap=overlap, upscale_amount=upscale_model.scale, pbar=pbar)
+                s = comfy.utils.tiled_scale(in_img, lambda a: upscale_model(a), tile_x=tile, tile_y=tile, overlap=overlap, upscale_amount=upscale_model.scale, pbar=pbar, tile_batch=tile_batch, workers=workers)
                 oom = False
             except model_management.OOM_EXCEPTION as e:
+                if tile_batch > 1:
+                    tile_batch = 1
+                    continue
                 tile //= 2
                 if tile < 128:
                     raise e
@@ -1098,11 +1098,17 @@ class PromptQueue:
         self.currently_running = {}
         self.history = {}
         self.flags = {}
+        self.prefetcher = None
+
+    def queue_changed(self):
+        self.server.queue_updated()
+        if self.prefetcher is not None:
+            self.prefetcher.queue_changed()
 
     def put(self, item):
         with self.mutex:
             heapq.heappush(self.queue, item)
-            self.server.queue_updated()
+            self.queue_changed()
             self.not_empty.notify()
 
     def get(self, timeout=None):
@@ -1115,7 +1121,7 @@ class PromptQueue:
             i = self.task_counter
             self.currently_running[i] = copy.deepcopy(item)
             self.task_counter += 1
-            self.server.queue_updated()
+            self.queue_changed()
             return (item, i)
 
     class ExecutionStatus(NamedTuple):
@@ -1167,7 +1173,7 @@ class PromptQueue:
     def wipe_queue(self):
         with self.mutex:
             self.queue = []
-            self.server.queue_updated()
+            self.queue_changed()
 
     def delete_queue_item(self, function):
         with self.mutex:
@@ -1178,7 +1184,7 @@ class PromptQueue:
                     else:
                         self.queue.pop(x)
                         heapq.heapify(self.queue)
-                    self.server.queue_updated()
+                    self.queue_changed()
                     return True
         return False
 
@@ -1,3 +1,6 @@
+import contextvars
+import threading
+import time
 import torch
 from PIL import Image
 from comfy.cli_args import args, LatentPreviewMethod
@@ -23,13 +26,26 @@ class LatentPreviewer:
     def decode_latent_to_preview(self, x0):
         pass
 
+    def load(self):
+        pass
+
+    def unload(self):
+        pass
+
     def decode_latent_to_preview_image(self, preview_format, x0):
         preview_image = self.decode_latent_to_preview(x0)
         return ("JPEG", preview_image, MAX_PREVIEW_RESOLUTION)
 
 class TAESDPreviewerImpl(LatentPreviewer):
-    def __init__(self, taesd):
+    def __init__(self, taesd, device):
         self.taesd = taesd
+        self.device = device
+
+    def load(self):
+        self.taesd.to(self.device)
+
+    def unload(self):
+        self.taesd.to(comfy.model_management.vae_offload_device())
 
     def decode_latent_to_preview(self, x0):
         x_sample = self.taesd.decode(x0[:1])[0].movedim(0, 2)
@@ -59,27 +75,30 @@ class Latent2RGBPreviewer(LatentPreviewer):
         return preview_to_image(latent_image)
 
 
-def get_previewer(device, latent_format):
+def find_taesd_decoder(latent_format):
+    """Full path of the TAESD decoder of latent_format in models/vae_approx, None if there is none."""
+    if latent_format.taesd_decoder_name is None:
+        return None
+    taesd_decoder_path = next(
+        (fn for fn in folder_paths.get_filename_list("vae_approx")
+            if fn.startswith(latent_format.taesd_decoder_name)),
+        ""
+    )
+    return folder_paths.get_full_path("vae_approx", taesd_decoder_path)
+
+def create_previewer(device, latent_format, method):
     previewer = None
-    method = args.preview_method
     if method != LatentPreviewMethod.NoPreviews:
         # TODO previewer methods
-        taesd_decoder_path = None
-        if latent_format.taesd_decoder_name is not None:
-            taesd_decoder_path = next(
-                (fn for fn in folder_paths.get_filename_list("vae_approx")
-                    if fn.startswith(latent_format.taesd_decoder_name)),
-                ""
-            )
-            taesd_decoder_path = folder_paths.get_full_path("vae_approx", taesd_decoder_path)
+        taesd_decoder_path = find_taesd_decoder(latent_format)
 
         if method == LatentPreviewMethod.Auto:
             method = LatentPreviewMethod.Latent2RGB
 
         if method == LatentPreviewMethod.TAESD:
             if taesd_decoder_path:
-                taesd = TAESD(None, taesd_decoder_path, latent_channels=latent_format.latent_channels).to(device)
-                previewer = TAESDPreviewerImpl(taesd)
+                taesd = TAESD(None, taesd_decoder_path, latent_channels=latent_format.latent_channels)
+                previewer = TAESDPreviewerImpl(taesd, device)
             else:
                 logging.warning("Warning: TAESD previews enabled, but could not find models/vae_approx/{}".format(latent_format.taesd_decoder_name))
 
@@ -88,21 +107,140 @@ def get_previewer(device, latent_format):
                 previewer = Latent2RGBPreviewer(latent_format.latent_rgb_factors, latent_format.latent_rgb_factors_bias)
     return previewer
 
+# previewers are kept for the process lifetime, keyed by (device, latent format, method, TAESD decoder file), their
+# models are only on the device while sampling (see finish_previews). The decoder file is part of the key so a TAESD
+# decoder added after a fallback previewer was made is picked up.
+PREVIEWERS = {}
+PREVIEWERS_LOCK = threading.Lock()
+
+def get_previewer(device, latent_format):
+    method = args.preview_method
+    taesd_decoder_path = find_taesd_decoder(latent_format) if method == LatentPreviewMethod.TAESD else None
+    key = (str(device), type(latent_format), latent_format.taesd_decoder_name, method, taesd_decoder_path)
+    with PREVIEWERS_LOCK:
+        if key not in PREVIEWERS:
+            PREVIEWERS[key] = create_previewer(device, latent_format, method)
+        return PREVIEWERS[key]
+
+
+PREVIEW_SUBSCRIBER_CHECK = None
+def set_preview_subscriber_check(function):
+    """function() returns False when nobody would receive a preview, which skips decoding it."""
+    global PREVIEW_SUBSCRIBER_CHECK
+    PREVIEW_SUBSCRIBER_CHECK = function
+
+def has_preview_subscribers():
+    if PREVIEW_SUBSCRIBER_CHECK is None:
+        return True
+    try:
+        return PREVIEW_SUBSCRIBER_CHECK()
+    except Exception:
+        return True
+
+
+class PreviewWorker:
+    """
+    Decodes previews on a background thread so the sampler loop never waits for them.
+    Only the most recent pending preview is kept: if decoding is slower than sampling, intermediate steps are skipped.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = None
+        self.busy = False
+        self.thread = None
+
+    def submit(self, job):
+        with self.cond:
+            self.pending = job
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True, name="latent_preview")
+                self.thread.start()
+            self.cond.notify_all()
+
+    def wait(self):
+        """Block until every submitted preview has been decoded and sent."""
+        with self.cond:
+            while self.pending is not None or self.busy:
+                self.cond.wait()
+
+    def discard(self):
+        """Drop the pending preview and block until the one being decoded has been sent."""
+        with self.cond:
+            self.pending = None
+            while self.busy:
+                self.cond.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                job = self.pending
+                self.pending = None
+                self.busy = True
+            try:
+                job()
+            except Exception as e:
+                logging.debug("Latent preview failed: {}".format(e))
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+PREVIEW_WORKER = PreviewWorker()
+
+
+def finish_previews():
+    """
+    Called when sampling ends, also on interrupts and errors: drops the previews still pending, which would otherwise
+    be sent for a node that finished, and moves the preview models off the device.
+    """
+    PREVIEW_WORKER.discard()
+    with PREVIEWERS_LOCK:
+        for previewer in PREVIEWERS.values():
+            if previewer is not None:
+                previewer.unload()
+
+
 def prepare_callback(model, steps, x0_output_dict=None):
     preview_format = "JPEG"
     if preview_format not in ["JPEG", "PNG"]:
         preview_format = "JPEG"
 
     previewer = get_previewer(model.load_device, model.model.latent_format)
+    if previewer is not None:
+        previewer.load()
+    min_interval = 1.0 / args.preview_max_fps if args.preview_max_fps > 0 else 0.0
+    step_interval = max(args.preview_interval, 1)
+    context = contextvars.copy_context() # the progress hook reads the executing node from it
+    last_preview = [0.0]
 
     pbar = comfy.utils.ProgressBar(steps)
+
+    def decode(x0):
+        with torch.inference_mode():
+            return previewer.decode_latent_to_preview_image(preview_format, x0)
+
     def callback(step, x0, x, total_steps):
         if x0_output_dict is not None:
             x0_output_dict["x0"] = x0
 
-        preview_bytes = None
-        if previewer:
-            preview_bytes = previewer.decode_latent_to_preview_image(preview_format, x0)
-        pbar.update_absolute(step + 1, total_steps, preview_bytes)
-    return callback
+        preview = previewer is not None and has_preview_subscribers()
+        last_step = step + 1 >= total_steps
+        if preview and not last_step:
+            now = time.perf_counter()
+            if step % step_interval != 0 or now - last_preview[0] < min_interval:
+                preview = False
+            else:
+                last_preview[0] = now
 
+        if last_step: # the final preview is decoded in place so it is sent before the sampler returns
+            PREVIEW_WORKER.discard()
+            pbar.update_absolute(step + 1, total_steps, decode(x0) if preview else None)
+        elif not preview:
+            pbar.update_absolute(step + 1, total_steps)
+        else:
+            pbar.update_absolute(step + 1, total_steps)
+            x0 = x0[:1].detach().clone()
+            PREVIEW_WORKER.submit(lambda: context.run(pbar.update_absolute, pbar.current, pbar.total, decode(x0)))
+    return callback
@@ -150,10 +150,15 @@ import execution
 import server
 from protocol import BinaryEventTypes
 import nodes
+import latent_preview
 import comfy.model_management
+import comfy.model_eviction
+import comfy.patched_weight_cache
+import comfy.text_encoder_cache
 import comfyui_version
 import app.logger
 import hook_breaker_ac10a0
+import comfy_execution.prefetch
 
 def cuda_malloc_warning():
     device = comfy.model_management.get_torch_device()
@@ -232,6 +237,12 @@ def prompt_worker(q, server_instance):
 
         if free_memory:
             e.reset()
+            if q.prefetcher is not None:
+                q.prefetcher.store.clear()
+            if comfy.patched_weight_cache.PATCHED_WEIGHT_CACHE is not None:
+                comfy.patched_weight_cache.PATCHED_WEIGHT_CACHE.clear()
+            if comfy.text_encoder_cache.TEXT_ENCODER_CACHE is not None:
+                comfy.text_encoder_cache.TEXT_ENCODER_CACHE.clear()
             need_gc = True
             last_gc_collect = 0
 
@@ -284,6 +295,12 @@ def hijack_progress(server_instance):
 
     comfy.utils.set_progress_bar_global_hook(hook)
 
+    def preview_subscribers():
+        if server_instance.client_id is None:
+            return len(server_instance.sockets) > 0
+        return server_instance.client_id in server_instance.sockets
+    latent_preview.set_preview_subscriber_check(preview_subscribers)
+
 
 def cleanup_temp():
     temp_dir = folder_paths.get_temp_directory()
@@ -336,6 +353,10 @@ def start_comfyui(asyncio_loop=None):
     prompt_server.add_routes()
     hijack_progress(prompt_server)
 
+    comfy.model_eviction.set_reuse_predictor(comfy.model_eviction.ReusePredictor(prompt_server.prompt_queue, comfy_execution.prefetch.prompt_model_files))
+    if args.prefetch_models > 0:
+        prompt_server.prompt_queue.prefetcher = comfy_execution.prefetch.ModelPrefetcher(prompt_server.prompt_queue, int(args.prefetch_models * 1024 * 1024 * 1024)).start()
+
     threading.Thread(target=prompt_worker, daemon=True, args=(prompt_server.prompt_queue, prompt_server,)).start()
 
     if args.quick_test_for_ci:
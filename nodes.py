@@ -25,6 +25,7 @@ import comfy.diffusers_load
 import comfy.samplers
 import comfy.sample
 import comfy.sd
+import comfy.lora_index
 import comfy.utils
 import comfy.controlnet
 from comfy.comfy_types import IO, ComfyNodeABC, InputTypeDict, FileLocator
@@ -671,6 +672,13 @@ class LoraLoader:
             else:
                 self.loaded_lora = None
 
+        lora_file = comfy.lora_index.INDEX.get(lora_path)
+        if lora_file is not None and lora_file.convert is None: # only read the tensors of the layers the models have
+            if lora is None:
+                lora = {}
+                self.loaded_lora = (lora_path, lora)
+            return comfy.sd.load_lora_file_for_models(model, clip, lora_file, strength_model, strength_clip, loaded=lora)
+
         if lora is None:
             lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
             self.loaded_lora = (lora_path, lora)
@@ -773,6 +781,7 @@ class VAELoader:
 
     #TODO: scale factor?
     def load_vae(self, vae_name):
+        vae_path = None
         if vae_name == "pixel_space":
             sd = {}
             sd["pixel_space_vae"] = torch.tensor(1.0)
@@ -783,6 +792,8 @@ class VAELoader:
             sd = comfy.utils.load_torch_file(vae_path)
         vae = comfy.sd.VAE(sd=sd)
         vae.throw_exception_if_invalid()
+        if vae_path is not None:
+            comfy.sd.set_model_source_path(vae_path, vae)
         return (vae,)
 
 class ControlNetLoader:
@@ -1489,9 +1500,12 @@ def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive,
 
     callback = latent_preview.prepare_callback(model, steps)
     disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
-    samples = comfy.sample.sample(model, noise, steps, cfg, sampler_name, scheduler, positive, negative, latent_image,
-                                  denoise=denoise, disable_noise=disable_noise, start_step=start_step, last_step=last_step,
-                                  force_full_denoise=force_full_denoise, noise_mask=noise_mask, callback=callback, disable_pbar=disable_pbar, seed=seed)
+    try:
+        samples = comfy.sample.sample(model, noise, steps, cfg, sampler_name, scheduler, positive, negative, latent_image,
+                                      denoise=denoise, disable_noise=disable_noise, start_step=start_step, last_step=last_step,
+                                      force_full_denoise=force_full_denoise, noise_mask=noise_mask, callback=callback, disable_pbar=disable_pbar, seed=seed)
+    finally:
+        latent_preview.finish_previews()
     out = latent.copy()
     out["samples"] = samples
     return (out, )
@@ -2336,6 +2350,7 @@ async def init_builtin_extra_nodes():
         "nodes_audio_encoder.py",
         "nodes_rope.py",
         "nodes_nop.py",
+        "nodes_checkpoint_quantization.py",
     ]
 
     import_failed = []
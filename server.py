@@ -26,6 +26,7 @@ import logging
 import mimetypes
 from comfy.cli_args import args
 import comfy.utils
+import comfy.lora_index
 import comfy.model_management
 from comfy_api import feature_flags
 import node_helpers
@@ -314,6 +315,9 @@ class PromptServer():
             if not folder in folder_paths.folder_names_and_paths:
                 return web.Response(status=404)
             files = folder_paths.get_filename_list(folder)
+            base_model = request.rel_url.query.get("base_model", None)
+            if folder == "loras" and base_model is not None: # loras whose base model is base_model or can't be detected
+                files = [f for f in files if comfy.lora_index.INDEX.compatible(folder_paths.get_full_path(folder, f), base_model)]
             return web.json_response(files)
 
         @routes.get("/extensions")
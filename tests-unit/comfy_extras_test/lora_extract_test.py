@@ -0,0 +1,97 @@
+import safetensors.torch
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_patcher
+import comfy.safetensors_writer
+from comfy_extras import nodes_lora_extract
+
+
+def low_rank_diff(out_dim, in_dim, rank, noise=0.01):
+    torch.manual_seed(0)
+    return torch.randn(out_dim, rank) @ torch.randn(rank, in_dim) / rank ** 0.5 + torch.randn(out_dim, in_dim) * noise
+
+
+def test_randomized_svd_matches_full():
+    diff = low_rank_diff(256, 512, 16)
+    errors = {}
+    for svd_method in nodes_lora_extract.SVD_METHODS:
+        up, down = nodes_lora_extract.extract_lora(diff, 16, svd_method)
+        assert up.shape == (256, 16) and down.shape == (16, 512)
+        errors[svd_method] = nodes_lora_extract.reconstruction_error(diff, up, down)
+    assert errors["full"] < 0.2 # mostly from the clamping of the outliers
+    assert abs(errors["randomized"] - errors["full"]) < 0.01
+
+    conv = low_rank_diff(64, 32 * 9, 8).reshape(64, 32, 3, 3)
+    up, down = nodes_lora_extract.extract_lora(conv, 8, "randomized")
+    assert up.shape == (64, 8, 1, 1) and down.shape == (8, 32, 3, 3)
+    assert nodes_lora_extract.reconstruction_error(conv, up, down) < 0.4
+
+
+def test_memory_budget():
+    budget = nodes_lora_extract.MemoryBudget(100)
+    assert budget.acquire(1000) == 100 # larger than the budget, runs alone
+    budget.release(100)
+    assert budget.acquire(60) == 60
+    assert budget.used == 60
+    budget.release(60)
+    assert budget.used == 0
+
+
+def test_writer_round_trip(tmp_path):
+    tensors = {"a": torch.randn(3, 5), "b": torch.arange(7, dtype=torch.int32), "c": torch.randn(2, 2).to(torch.bfloat16), "unwritten": torch.zeros(4)}
+    path = str(tmp_path / "out.safetensors")
+    with comfy.safetensors_writer.SafetensorsWriter(path, {k: (v.shape, v.dtype) for k, v in tensors.items()}, metadata={"m": "1"}) as writer:
+        writer["c"] = tensors["c"]
+        writer["a"] = tensors["a"].T.T
+        writer.write("b", tensors["b"])
+        assert writer.missing() == ["unwritten"]
+    loaded = safetensors.torch.load_file(path)
+    assert all(torch.equal(loaded[k], v) for k, v in tensors.items())
+    with safetensors.safe_open(path, framework="pt") as f:
+        assert f.metadata() == {"m": "1"}
+
+    try:
+        with comfy.safetensors_writer.SafetensorsWriter(str(tmp_path / "failed.safetensors"), {"a": ((3, 5), torch.float32)}) as writer:
+            writer["a"] = torch.zeros(5, 3)
+    except ValueError:
+        pass
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["out.safetensors"]
+
+
+class Model(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.diffusion_model = torch.nn.Sequential(torch.nn.Linear(64, 96), torch.nn.Conv2d(8, 16, 3), torch.nn.Conv2d(16, 16, 1), torch.nn.LayerNorm(16))
+
+
+def test_calc_lora_model(tmp_path):
+    model = Model()
+    torch.manual_seed(0)
+    for name, p in model.named_parameters():
+        p.data = low_rank_diff(p.shape[0], p[0].numel(), 4).reshape(p.shape) if p.ndim > 1 else torch.randn(p.shape)
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    lora_type = nodes_lora_extract.LORAType.STANDARD
+
+    keys = nodes_lora_extract.lora_keys(patcher.model_state_dict("diffusion_model."), 4, "diffusion_model.", "diffusion_model.", lora_type, bias_diff=True)
+    entries = {key: (shape, torch.float16) for outputs in keys.values() for key, shape in outputs}
+    assert entries["diffusion_model.1.lora_down.weight"][0] == (4, 8, 3, 3)
+    assert entries["diffusion_model.3.diff"][0] == (16,)
+
+    path = str(tmp_path / "lora.safetensors")
+    errors = {}
+    with comfy.safetensors_writer.SafetensorsWriter(path, entries) as writer:
+        nodes_lora_extract.calc_lora_model(patcher, 4, "diffusion_model.", "diffusion_model.", writer, lora_type, bias_diff=True, svd_method="randomized", workers=3, memory_budget=1, errors=errors)
+        assert writer.missing() == []
+    assert sorted(errors) == ["diffusion_model.0", "diffusion_model.1", "diffusion_model.2"]
+    assert all(e < 0.5 for e in errors.values())
+
+    expected = nodes_lora_extract.calc_lora_model(patcher, 4, "diffusion_model.", "diffusion_model.", {}, lora_type, bias_diff=True)
+    loaded = safetensors.torch.load_file(path)
+    assert sorted(loaded) == sorted(expected)
+    assert torch.equal(loaded["diffusion_model.0.diff_b"], expected["diffusion_model.0.diff_b"])
+    w = model.diffusion_model[0].weight
+    assert ((loaded["diffusion_model.0.lora_up.weight"].float() @ loaded["diffusion_model.0.lora_down.weight"].float() - w).norm() / w.norm()) < errors["diffusion_model.0"] + 0.01
@@ -0,0 +1,58 @@
+import math
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+from comfy.ldm.modules import attention
+from comfy.ldm.modules.attention import plan_sub_quad_chunks, sub_quad_working_set
+
+
+def make_qkv(batch=2, heads=4, tokens=1000, dim_head=32, k_tokens=None):
+    torch.manual_seed(0)
+    q = torch.randn(batch, tokens, heads * dim_head)
+    k = torch.randn(batch, k_tokens or tokens, heads * dim_head)
+    v = torch.randn(batch, k_tokens or tokens, heads * dim_head)
+    return q, k, v
+
+
+@pytest.mark.parametrize("budget", [2 ** 20, 2 ** 26, 2 ** 30])
+def test_plan_respects_budget(budget):
+    q_chunk, kv_chunk = plan_sub_quad_chunks(32, 16384, 16384, 64, 4, budget)
+    assert q_chunk % 64 == 0
+    assert kv_chunk <= 16384
+    if budget >= 2 ** 26:
+        assert sub_quad_working_set(32, q_chunk, kv_chunk, 16384, 64, 4) <= budget
+
+
+def test_plan_prefers_no_kv_chunking_when_it_fits():
+    q_chunk, kv_chunk = plan_sub_quad_chunks(8, 4096, 77, 64, 4, 2 ** 30)
+    assert kv_chunk == 77
+    assert q_chunk == 4096
+
+
+def test_plan_small_sequences():
+    q_chunk, kv_chunk = plan_sub_quad_chunks(8, 10, 10, 64, 4, 2 ** 20)
+    assert (q_chunk, kv_chunk) == (10, 10)
+
+
+@pytest.mark.parametrize("budget_gb", [0, 1.0, 0.0005])
+@pytest.mark.parametrize("k_tokens", [None, 77])
+def test_chunked_attention_matches_basic(monkeypatch, budget_gb, k_tokens):
+    monkeypatch.setattr(args, "cpu_attention_memory", budget_gb)
+    q, k, v = make_qkv(k_tokens=k_tokens)
+    expected = attention.attention_basic(q, k, v, 4)
+    for func in (attention.attention_sub_quad, attention.attention_split):
+        out = func(q, k, v, 4)
+        assert out.shape == expected.shape
+        assert torch.allclose(out, expected, atol=1e-5), func.__name__
+
+
+def test_split_does_not_error_on_small_budget(monkeypatch):
+    monkeypatch.setattr(args, "cpu_attention_memory", 1 / 1024 ** 2)
+    q, k, v = make_qkv(batch=1, heads=2, tokens=4096, dim_head=8)
+    out = attention.attention_split(q, k, v, 2)
+    assert not math.isnan(out.sum().item())
@@ -0,0 +1,116 @@
+import json
+
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.checkpoint_quantization
+import comfy.model_detection
+import comfy.model_patcher
+import comfy.ops
+import comfy.sd
+import comfy.supported_models_base
+from comfy.quant_ops import QuantizedTensor
+
+
+class Model(torch.nn.Module):
+    def __init__(self, operations):
+        super().__init__()
+        self.proj_in = operations.Linear(64, 128, dtype=torch.bfloat16)
+        self.proj_out = operations.Linear(128, 64, dtype=torch.bfloat16)
+        self.norm = operations.LayerNorm(64, dtype=torch.bfloat16)
+        for m in self.children():
+            m.weight_function = []
+            m.bias_function = []
+
+    def forward(self, x):
+        return self.norm(self.proj_out(torch.nn.functional.gelu(self.proj_in(x))))
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = Model(comfy.ops.manual_cast)
+    for p in model.parameters():
+        torch.nn.init.normal_(p, std=0.1)
+    return model
+
+
+def calibrated(model, x):
+    layers = comfy.checkpoint_quantization.linear_layers(model)
+    with comfy.checkpoint_quantization.Calibrator(layers) as stats:
+        model(x)
+    return layers, stats
+
+
+def test_calibration():
+    model = make_model()
+    x = torch.randn(4, 16, 64, dtype=torch.bfloat16)
+    layers, stats = calibrated(model, x)
+    assert sorted(layers) == ["proj_in", "proj_out"]
+    assert torch.equal(stats["proj_in"].amax, x.float().abs().amax())
+    assert all(0 < s.mean_error() < 0.1 for s in stats.values())
+    assert comfy.checkpoint_quantization.select_layers(layers, stats) == ["proj_in", "proj_out"]
+
+    model(x * 2) # hooks removed
+    assert all(s.calls == 1 for s in stats.values())
+
+    with torch.no_grad():
+        model.proj_out.weight[0, 0] = 1e6 # an outlier makes every other weight of the layer underflow
+    layers, stats = calibrated(model, x)
+    assert stats["proj_out"].mean_error() > 0.5
+    assert comfy.checkpoint_quantization.select_layers(layers, stats) == ["proj_in"]
+
+
+def test_quantized_state_dict_loads_with_mixed_precision_ops(monkeypatch):
+    model = make_model()
+    x = torch.randn(2, 8, 64, dtype=torch.bfloat16)
+    expected = model(x).float()
+    layers, stats = calibrated(model, x)
+
+    model_config = comfy.supported_models_base.BASE({})
+    sd = model_config.process_unet_state_dict_for_saving(model.state_dict())
+    quant_metadata = comfy.checkpoint_quantization.quantize_state_dict(sd, model_config, ["proj_in", "proj_out"], stats)
+    assert sd["model.diffusion_model.proj_in.weight"].dtype == torch.float8_e4m3fn
+    assert sd["model.diffusion_model.proj_in.input_scale"].shape == ()
+    assert sd["model.diffusion_model.norm.weight"].dtype == torch.bfloat16
+
+    metadata = {"_quantization_metadata": json.dumps(quant_metadata)}
+    layer_quant_config = comfy.model_detection.detect_layer_quantization(metadata)
+    monkeypatch.setattr(comfy.ops.MixedPrecisionOps, "_layer_quant_config", layer_quant_config)
+    monkeypatch.setattr(comfy.ops.MixedPrecisionOps, "_compute_dtype", torch.bfloat16)
+    loaded = Model(comfy.ops.MixedPrecisionOps)
+    loaded.load_state_dict({k[len("model.diffusion_model."):]: v for k, v in sd.items()}, strict=False)
+    assert isinstance(loaded.proj_in.weight, QuantizedTensor)
+    assert loaded.proj_in.input_scale is not None
+    out = loaded(x).float()
+    assert ((out - expected).norm() / expected.norm()).item() < 0.1
+
+
+def test_without_calibration():
+    model = make_model()
+    layers = comfy.checkpoint_quantization.linear_layers(model)
+    assert comfy.checkpoint_quantization.select_layers(layers) == ["proj_in", "proj_out"]
+    model_config = comfy.supported_models_base.BASE({})
+    sd = model_config.process_unet_state_dict_for_saving(model.state_dict())
+    comfy.checkpoint_quantization.quantize_state_dict(sd, model_config, ["proj_in"])
+    assert "model.diffusion_model.proj_in.weight_scale" in sd
+    assert "model.diffusion_model.proj_in.input_scale" not in sd
+
+
+def test_patched_weights_are_quantized_one_at_a_time():
+    model = make_model()
+    base = model.proj_in.weight.clone()
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    patcher.add_patches({"proj_in.weight": (torch.ones(128, 64, dtype=torch.bfloat16),), "proj_out.weight": (torch.ones(64, 128, dtype=torch.bfloat16),)}, 0.5)
+    model_config = comfy.supported_models_base.BASE({})
+    sd, lazy = comfy.sd.lazy_patched_state_dict([patcher], lambda: model_config.process_unet_state_dict_for_saving(model.state_dict()))
+    assert sorted(lazy) == ["model.diffusion_model.proj_in.weight", "model.diffusion_model.proj_out.weight"]
+
+    comfy.checkpoint_quantization.quantize_state_dict(sd, model_config, ["proj_in"], lazy=lazy)
+    assert sorted(lazy) == ["model.diffusion_model.proj_out.weight"] # left for save_state_dict
+    scale = sd["model.diffusion_model.proj_in.weight_scale"]
+    dequantized = sd["model.diffusion_model.proj_in.weight"].to(torch.float32) * scale
+    assert torch.allclose(dequantized, patcher.patched_weight("proj_in.weight").float(), rtol=0.07, atol=1e-3)
+    assert torch.equal(model.proj_in.weight, base) # the model itself is never patched
@@ -0,0 +1,120 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.hook_keyframe_cache
+import comfy.hooks
+import comfy.lora
+import comfy.model_patcher
+from comfy.weight_adapter import LoRAAdapter
+
+
+def lora(out_dim, in_dim, rank, dora_scale=None):
+    return LoRAAdapter(set(), (torch.randn(out_dim, rank), torch.randn(rank, in_dim), None, None, dora_scale, None))
+
+
+def keyframes(*strengths_and_start_t):
+    group = comfy.hooks.HookKeyframeGroup()
+    for strength, start_t in strengths_and_start_t:
+        keyframe = comfy.hooks.HookKeyframe(strength)
+        keyframe.start_t = start_t
+        group.keyframes.append(keyframe)
+    group._set_first_as_current()
+    return group
+
+
+def test_keyframe_changes_swap_or_scale_cached_weights(monkeypatch):
+    torch.manual_seed(0)
+    cache = comfy.hook_keyframe_cache.HookKeyframeCache(1024 * 1024)
+    monkeypatch.setattr(comfy.hook_keyframe_cache, "CACHE", cache)
+    calculated = []
+    calculate_weight = comfy.lora.calculate_weight
+    monkeypatch.setattr(comfy.lora, "calculate_weight", lambda *a, **kw: calculated.append(a[2]) or calculate_weight(*a, **kw))
+
+    model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.Linear(16, 4))
+    p = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    base = {k: v.clone() for k, v in model.state_dict().items()}
+    scheduled = comfy.hooks.WeightHook()
+    scheduled.hook_keyframe = keyframes((1.0, 999.0), (0.5, 0.5), (1.0, 0.2))
+    p.add_hook_patches(scheduled, {"0.weight": lora(16, 8, 4)}, 0.5)
+    dora = comfy.hooks.WeightHook()
+    p.add_hook_patches(dora, {"0.weight": lora(16, 8, 4, dora_scale=torch.rand(16, 1) + 0.5), "1.weight": lora(4, 16, 2)}, 0.3)
+    groups = [comfy.hooks.HookGroup(), comfy.hooks.HookGroup()]
+    groups[0].add(scheduled)
+    groups[1].add(scheduled)
+    groups[1].add(dora)
+
+    model_options = {"transformer_options": {"sample_sigmas": torch.tensor([1.0, 0.7, 0.4, 0.1, 0.0])}}
+    for t in [1.0, 0.7, 0.4, 0.1]:
+        for group in groups:
+            p.prepare_hook_patches_current_keyframe(torch.tensor([t]), group, model_options)
+            p.apply_hooks(group)
+            combined = p.get_combined_hook_patches(group)
+            for k, v in model.state_dict().items():
+                expected = calculate_weight(combined[k], base[k].clone(), k) if k in combined else base[k]
+                assert torch.allclose(v, expected, atol=1e-5)
+
+    # the delta of the scheduled hook on 0.weight is computed once, the two weights of the second group
+    # (0.weight has a DoRA) are merged again for each of the two strengths of the scheduled hook and going back to
+    # the first strength swaps the weights of both groups in
+    assert sorted(calculated) == ["0.weight"] * 3 + ["1.weight"] * 2
+    assert cache.counts == {"scaled": 2, "recomputes": 4, "swaps": 3 + 3}
+
+    p.clean_hooks()
+    assert all(torch.equal(v, base[k]) for k, v in model.state_dict().items())
+    assert len(cache.entries) == 0 and cache.used_bytes == 0
+
+
+def keyframe_weights(cache, **weights):
+    out = comfy.hook_keyframe_cache.KeyframeWeights(cache)
+    for key, weight in weights.items():
+        out.add(key, weight, torch.device("cpu"))
+    return out
+
+
+def test_cache_is_bounded():
+    cache = comfy.hook_keyframe_cache.HookKeyframeCache(3 * 64)
+    for i in range(4):
+        cache.put_weights("owner", i, keyframe_weights(cache, w=torch.zeros(16)))
+    assert cache.get_weights("owner", 0) is None
+    assert cache.get_weights("owner", 3) is not None
+    assert cache.used_bytes == 3 * 64 and cache.counts["evictions"] == 1
+
+
+def test_keyframe_weights_stop_collecting_when_over_budget():
+    cache = comfy.hook_keyframe_cache.HookKeyframeCache(3 * 64)
+    weights = comfy.hook_keyframe_cache.KeyframeWeights(cache)
+    assert weights.add("a", torch.zeros(32), torch.device("cpu"))
+    assert not weights.full and weights.size == 128
+    assert not weights.add("b", torch.zeros(32), torch.device("cpu"))
+    assert weights.full and not weights.add("c", torch.zeros(1), torch.device("cpu"))
+    cache.put_weights("owner", 0, weights)
+    assert cache.get_weights("owner", 0) is None and cache.used_bytes == 0
+
+
+def test_unscheduled_or_uncacheable_groups_use_the_hook_patch_cache(monkeypatch):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.Linear(16, 4))
+    p = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    static = comfy.hooks.WeightHook()
+    p.add_hook_patches(static, {"0.weight": lora(16, 8, 4)}, 0.5)
+    group = comfy.hooks.HookGroup()
+    group.add(static)
+    cache = comfy.hook_keyframe_cache.HookKeyframeCache(1024 * 1024)
+    monkeypatch.setattr(comfy.hook_keyframe_cache, "CACHE", cache)
+    p.apply_hooks(group)
+    assert len(cache.entries) == 0 and "0.weight" in p.cached_hook_patches[group]
+
+    scheduled = comfy.hooks.WeightHook()
+    scheduled.hook_keyframe = keyframes((1.0, 999.0), (0.5, 0.5))
+    p.add_hook_patches(scheduled, {"0.weight": lora(16, 8, 4), "1.weight": lora(4, 16, 2)}, 0.5)
+    group = comfy.hooks.HookGroup()
+    group.add(scheduled)
+    # room for the first weight (and the deltas) only: the state isn't cached, its weights are kept by the patcher
+    cache = comfy.hook_keyframe_cache.HookKeyframeCache(16 * 8 * 4 + 64)
+    monkeypatch.setattr(comfy.hook_keyframe_cache, "CACHE", cache)
+    p.apply_hooks(group)
+    assert not any(k[1] == "weights" for k in cache.entries)
+    assert sorted(p.cached_hook_patches[group]) == ["0.weight", "1.weight"]
@@ -0,0 +1,144 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.lazy_merge
+import comfy.lora
+import comfy.model_patcher
+import comfy.ops
+from comfy_extras.nodes_model_merging import ModelMergeBlocks, ModelMergeSimple
+
+
+class Model(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.diffusion_model = torch.nn.Sequential(comfy.ops.manual_cast.Linear(16, 32), comfy.ops.manual_cast.Linear(32, 8))
+        for m in self.diffusion_model:
+            m.weight_function = []
+            m.bias_function = []
+
+    def forward(self, x):
+        return self.diffusion_model(x)
+
+
+def make_patcher(seed):
+    torch.manual_seed(seed)
+    model = Model()
+    for p in model.parameters():
+        torch.nn.init.normal_(p)
+    return comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = comfy.lazy_merge.EvaluatedLayerCache(1024 * 1024)
+    monkeypatch.setattr(comfy.lazy_merge, "CACHE", cache)
+    return cache
+
+
+def expected(merged, base, x):
+    sd = {k: comfy.lora.calculate_weight(merged.patches[k], v.to(torch.float32, copy=True), k) if k in merged.patches else v for k, v in base.items()}
+    for i in range(2):
+        x = torch.nn.functional.linear(x, sd["diffusion_model.{}.weight".format(i)], sd["diffusion_model.{}.bias".format(i)])
+    return x
+
+
+def test_expression_of_nested_merges():
+    p1, p2, p3 = make_patcher(0), make_patcher(1), make_patcher(2)
+    m = ModelMergeSimple().merge(p2, p3, 0.25)[0]
+    m = ModelMergeSimple().merge(p1, m, 0.5)[0]
+    key = "diffusion_model.0.weight"
+    weight = p1.model.state_dict()[key]
+    expression = comfy.lazy_merge.expression(m.patches[key], weight)
+    assert expression.base == 0.5
+    assert [c for c, t, f in expression.terms] == [0.5 * 0.25, 0.5 * 0.75] # the ratio is the weight of model1
+    assert torch.allclose(expression.evaluate(weight), comfy.lora.calculate_weight(m.patches[key], weight.clone(), key), atol=1e-6)
+
+    m.add_patches({(key, None, torch.tanh): (torch.ones(32, 16),)}, 1.0)
+    assert comfy.lazy_merge.expression(m.patches[key], weight) is None
+
+
+def test_lazy_merge(cache):
+    p1, p2 = make_patcher(0), make_patcher(1)
+    base = {k: v.clone() for k, v in p1.model.state_dict().items()}
+    x = torch.randn(4, 16)
+
+    merged = ModelMergeBlocks().merge(p1, p2, **{"0.": 0.3, "1.": 0.6})[0]
+    merged.patch_model(torch.device("cpu"), lowvram_model_memory=0)
+    assert all(torch.equal(v, base[k]) for k, v in p1.model.state_dict().items()) # nothing merged at load time
+    assert merged.model.lowvram_patch_counter == 4
+    out = merged.model(x)
+    assert torch.allclose(out, expected(merged, base, x), atol=1e-5)
+    assert cache.misses == 4 and cache.hits == 0
+    merged.model(x)
+    assert cache.hits == 4
+    merged.unpatch_model(torch.device("cpu"))
+    assert all(len(m.weight_function) == 0 and len(m.bias_function) == 0 for m in merged.model.diffusion_model)
+    assert merged.model.lowvram_patch_counter == 0
+
+    # only the layer whose ratio changed is evaluated again
+    merged = ModelMergeBlocks().merge(p1, p2, **{"0.": 0.3, "1.": 0.9})[0]
+    merged.patch_model(torch.device("cpu"), lowvram_model_memory=0)
+    out = merged.model(x)
+    assert torch.allclose(out, expected(merged, base, x), atol=1e-5)
+    assert cache.misses == 6 and cache.hits == 6
+    merged.unpatch_model(torch.device("cpu"))
+
+
+def test_lowvram_and_fallback(cache):
+    p1, p2 = make_patcher(0), make_patcher(1)
+    base = {k: v.clone() for k, v in p1.model.state_dict().items()}
+    x = torch.randn(4, 16)
+    merged = ModelMergeSimple().merge(p1, p2, 0.5)[0]
+    merged.add_patches({("diffusion_model.1.weight", None, torch.tanh): (torch.ones(8, 32),)}, 0.1)
+    merged.patch_model(torch.device("cpu"), lowvram_model_memory=1)
+    assert merged.model.model_lowvram
+    functions = [type(f) for m in merged.model.diffusion_model for f in m.weight_function]
+    assert functions == [comfy.lazy_merge.LazyMergePatch, comfy.model_patcher.LowVramPatch]
+    assert torch.allclose(merged.model(x), expected(merged, base, x), atol=1e-4)
+    merged.unpatch_model(torch.device("cpu"))
+
+    merged.patch_model(torch.device("cpu"), lowvram_model_memory=0) # the lora weight is patched at load time
+    assert isinstance(merged.model.diffusion_model[0].weight_function[0], comfy.lazy_merge.LazyMergePatch)
+    assert len(merged.model.diffusion_model[1].weight_function) == 0
+    assert torch.allclose(merged.model(x), expected(merged, base, x), atol=1e-4)
+    merged.unpatch_model(torch.device("cpu"))
+
+
+def test_cache_budget():
+    cache = comfy.lazy_merge.EvaluatedLayerCache(100)
+    cache.put("a", torch.zeros(10), None)
+    cache.put("b", torch.zeros(10), None)
+    assert cache.get("a") is not None # b is now the least recently used
+    cache.put("c", torch.zeros(10), None)
+    assert cache.get("b") is None and cache.get("a") is not None and cache.get("c") is not None
+    cache.put("d", torch.zeros(100), None)
+    assert cache.get("d") is None
+    assert cache.bytes == 80
+
+
+def test_cache_gives_memory_back():
+    cache = comfy.lazy_merge.EvaluatedLayerCache(1000)
+    cpu = torch.device("cpu")
+    for i in range(4):
+        cache.put(("model", i), torch.zeros(10), None)
+    cache.put(("other", 0), torch.zeros(10), None)
+    assert cache.memory_used(cpu) == 200
+    assert cache.free(60, cpu) == 80 # the two least recently used entries
+    assert cache.get(("model", 1)) is None and cache.get(("model", 2)) is not None
+    cache.discard("model")
+    assert list(cache.entries) == [("other", 0)] and cache.bytes == 40
+
+    free = {"meta": 100}
+    cache = comfy.lazy_merge.EvaluatedLayerCache(1000)
+    cache.free_memory_function = lambda device: free[device.type]
+    cache.put("a", torch.zeros(20, device="meta"), None)
+    free["meta"] = 20
+    cache.put("b", torch.zeros(10, device="meta"), None) # evicts a to stay out of the memory inference needs
+    assert list(cache.entries) == ["b"]
+    free["meta"] = 0
+    cache.put("c", torch.zeros(20, device="meta"), None)
+    assert list(cache.entries) == []
@@ -0,0 +1,92 @@
+import os
+
+import safetensors.torch
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.lora
+import comfy.lora_index
+import comfy.model_prefetch
+
+
+def save(path, sd, metadata=None):
+    safetensors.torch.save_file(sd, str(path), metadata=metadata)
+    return str(path)
+
+
+def sd1_lora():
+    torch.manual_seed(0)
+    sd = {}
+    for name, in_dim in [("lora_unet_input_blocks_1_1_transformer_blocks_0_attn2_to_k", 768), ("lora_unet_input_blocks_1_1_proj_in", 320), ("lora_te_text_model_encoder_layers_0_mlp_fc1", 768)]:
+        sd["{}.lora_down.weight".format(name)] = torch.randn(8, in_dim)
+        sd["{}.lora_up.weight".format(name)] = torch.randn(320, 8)
+        sd["{}.alpha".format(name)] = torch.tensor(4.0)
+    return sd
+
+
+def test_index(tmp_path):
+    index = comfy.lora_index.LoraIndex()
+    path = save(tmp_path / "sd1.safetensors", sd1_lora())
+    lora_file = index.get(path)
+    assert lora_file.base_model == "SD1"
+    assert lora_file.rank == 8
+    assert lora_file.size == os.path.getsize(path)
+    assert lora_file.shapes["lora_unet_input_blocks_1_1_proj_in.lora_down.weight"] == (8, 320)
+    assert index.get(path) is lora_file
+    assert index.compatible(path, "sd1") and not index.compatible(path, "SDXL")
+
+    save(path, {"lora_te2_text_model_encoder_layers_0_mlp_fc1.lora_down.weight": torch.zeros(4, 1280)})
+    os.utime(path, ns=(0, 0))
+    assert index.get(path).base_model == "SDXL" # the file changed
+
+    flux = save(tmp_path / "flux.safetensors", {"diffusion_model.double_blocks.0.img_attn.qkv.lora_A.weight": torch.zeros(4, 16)})
+    assert index.get(flux).base_model == "Flux"
+    unknown = save(tmp_path / "unknown.safetensors", {"a.lora_A.weight": torch.zeros(4, 16)}, metadata={"ss_base_model_version": "sdxl_base_v1-0"})
+    assert index.get(unknown).base_model == "SDXL"
+    unknown = save(tmp_path / "unknown2.safetensors", {"a.lora_A.weight": torch.zeros(4, 16)})
+    assert index.get(unknown).base_model is None and index.compatible(unknown, "SD1")
+    assert index.get(str(tmp_path / "missing.safetensors")) is None
+    assert index.get(str(tmp_path / "old.pt")) is None
+
+
+def test_match_reads_only_the_used_tensors(tmp_path):
+    sd = sd1_lora()
+    sd["lora_unet_missing_layer.lora_down.weight"] = torch.randn(8, 16)
+    sd["lora_unet_missing_layer.lora_up.weight"] = torch.randn(16, 8)
+    sd["diffusers.layer_lora.down.weight"] = torch.randn(8, 16)
+    sd["diffusers.layer_lora.up.weight"] = torch.randn(16, 8)
+    lora_file = comfy.lora_index.LoraIndex().get(save(tmp_path / "lora.safetensors", sd))
+    key_map = {"lora_unet_input_blocks_1_1_transformer_blocks_0_attn2_to_k": "diffusion_model.input_blocks.1.1.transformer_blocks.0.attn2.to_k.weight",
+               "lora_unet_input_blocks_1_1_proj_in": "diffusion_model.input_blocks.1.1.proj_in.weight",
+               "diffusers.layer": "diffusion_model.layer.weight",
+               "lora_unet_other": "diffusion_model.other.weight"}
+
+    to_load, names = lora_file.match(key_map)
+    assert to_load == {k: v for k, v in key_map.items() if k != "lora_unet_other"}
+    assert len(names) == 8 # up, down and alpha of the two unet layers, up and down of the diffusers one
+    loaded = lora_file.load(names)
+    assert all(torch.equal(loaded[n], sd[n]) for n in names)
+
+    full = comfy.lora.load_lora(sd, key_map, log_missing=False)
+    partial = comfy.lora.load_lora(loaded, to_load)
+    assert full.keys() == partial.keys()
+    for k in full:
+        assert all(torch.equal(a, b) if torch.is_tensor(a) else a == b for a, b in zip(full[k].weights, partial[k].weights))
+
+
+def test_load_takes_the_staged_file(tmp_path, monkeypatch):
+    sd = sd1_lora()
+    path = save(tmp_path / "lora.safetensors", sd)
+    lora_file = comfy.lora_index.LoraIndex().get(path)
+    monkeypatch.setattr(comfy.model_prefetch, "STAGING_RAM_HEADROOM", 0)
+    monkeypatch.setattr(comfy.model_prefetch, "STAGING_STORE", comfy.model_prefetch.ModelStagingStore(1024 * 1024))
+    assert comfy.model_prefetch.STAGING_STORE.stage(path)
+
+    names = ["lora_unet_input_blocks_1_1_proj_in.lora_down.weight", "lora_unet_input_blocks_1_1_proj_in.alpha"]
+    loaded = lora_file.load(names)
+    assert sorted(loaded) == sorted(names) and all(torch.equal(loaded[n], sd[n]) for n in names)
+    assert comfy.model_prefetch.STAGING_STORE.hits == 1
+    assert not comfy.model_prefetch.STAGING_STORE.is_staged(path)
@@ -0,0 +1,43 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.lora
+import comfy.supported_models
+
+FLUX = {"image_model": "flux", "in_channels": 16, "patch_size": 2, "out_channels": 16, "vec_in_dim": 32, "context_in_dim": 64,
+        "hidden_size": 64, "mlp_ratio": 4.0, "num_heads": 2, "depth": 2, "depth_single_blocks": 2, "axes_dim": [8, 12, 12],
+        "theta": 10000, "qkv_bias": True, "guidance_embed": True}
+
+
+def test_key_maps_are_cached(monkeypatch):
+    model = comfy.supported_models.Flux(FLUX).get_model({}, device=torch.device("meta"))
+    expected = comfy.lora.build_lora_keys_unet(model, {})
+    assert expected["lora_unet_double_blocks_0_img_attn_qkv"] == "diffusion_model.double_blocks.0.img_attn.qkv.weight"
+
+    key_map = comfy.lora.model_lora_keys_unet(model, {"other": "key"})
+    assert key_map == dict(expected, other="key")
+    key_map["lora_unet_double_blocks_0_img_attn_qkv"] = "changed"
+
+    def build(model, key_map):
+        raise AssertionError("rebuilt")
+    monkeypatch.setattr(comfy.lora, "build_lora_keys_unet", build)
+    assert comfy.lora.model_lora_keys_unet(model, {}) == expected
+
+    other = comfy.supported_models.Flux(dict(FLUX, depth=3)).get_model({}, device=torch.device("meta"))
+    monkeypatch.undo()
+    assert "lora_unet_double_blocks_2_img_attn_qkv" in comfy.lora.model_lora_keys_unet(other, {})
+
+
+def test_match_lora_keys():
+    key_map = {"lora_unet_a": "a.weight", "lora_unet_a_b": "a.b.weight", "text_encoder.layer": "t.weight", "unused": "u.weight"}
+    names = ["lora_unet_a.lora_up.weight", "lora_unet_a.alpha", "lora_unet_a_b.lora_down.weight", "text_encoder.layer_lora.up.weight", "lora_unet_c.lora_up.weight"]
+    to_load, matched = comfy.lora.match_lora_keys(names, key_map)
+    assert to_load == {"lora_unet_a": "a.weight", "lora_unet_a_b": "a.b.weight", "text_encoder.layer": "t.weight"}
+    assert matched == names[:4]
+
+    lora = {"lora_unet_a.lora_up.weight": torch.ones(4, 2), "lora_unet_a.lora_down.weight": torch.ones(2, 4), "lora_unet_c.diff": torch.ones(4)}
+    patches = comfy.lora.load_lora(lora, key_map, log_missing=False)
+    assert list(patches) == ["a.weight"]
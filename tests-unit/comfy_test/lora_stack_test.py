@@ -0,0 +1,69 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.lora
+from comfy.weight_adapter import LoHaAdapter, LoRAAdapter
+
+
+def lora(out_dim, in_dim, rank, alpha=None, dora_scale=None, kernel=None):
+    up = torch.randn(out_dim, rank) if kernel is None else torch.randn(out_dim, rank, 1, 1)
+    down = torch.randn(rank, in_dim) if kernel is None else torch.randn(rank, in_dim, kernel, kernel)
+    return LoRAAdapter(set(), (up, down, alpha, None, dora_scale, None))
+
+
+def one_by_one(patches, weight, key):
+    """Reference: every patch applied on its own, which never stacks them."""
+    for p in patches:
+        weight = comfy.lora.calculate_weight([p], weight, key)
+    return weight
+
+
+def test_stacked_loras_match_one_by_one():
+    torch.manual_seed(0)
+    weight = torch.randn(32, 16)
+    patches = [(s, lora(32, 16, r, alpha), 1.0, None, None) for s, r, alpha in [(1.0, 4, None), (0.5, 8, 4.0), (0.0, 2, None), (-0.7, 16, 8.0)]]
+    assert all(LoRAAdapter.stackable(p) for p in patches)
+    out = comfy.lora.calculate_weight(patches, weight.clone(), "w")
+    assert torch.allclose(out, one_by_one(patches, weight.clone(), "w"), atol=1e-4)
+
+    conv = torch.randn(8, 4, 3, 3)
+    patches = [(0.3, lora(8, 4, 2, kernel=3), 1.0, None, None), (0.6, lora(8, 4, 4, 2.0, kernel=3), 1.0, None, None)]
+    out = comfy.lora.calculate_weight(patches, conv.clone(), "w")
+    assert torch.allclose(out, one_by_one(patches, conv.clone(), "w"), atol=1e-4)
+
+    half = weight.half()
+    patches = [(0.1, lora(32, 16, 4), 1.0, None, None), (0.1, lora(32, 16, 4), 1.0, None, None)]
+    out = comfy.lora.calculate_weight(patches, half.clone(), "w")
+    assert out.dtype == torch.float16
+    assert torch.allclose(out.float(), one_by_one(patches, half.clone(), "w").float(), atol=1e-2)
+
+
+def test_other_patches_are_applied_in_order():
+    torch.manual_seed(0)
+    weight = torch.randn(32, 16)
+    loha = LoHaAdapter(set(), (torch.randn(32, 2), torch.randn(2, 16), None, torch.randn(32, 2), torch.randn(2, 16), None, None, None))
+    dora = lora(32, 16, 4, dora_scale=torch.rand(32, 1) + 0.5)
+    patches = [(1.0, lora(32, 16, 4), 1.0, None, None),
+               (0.5, lora(32, 16, 4), 1.0, None, None),
+               (0.5, loha, 1.0, None, None),
+               (1.0, lora(32, 16, 4), 0.5, None, None), # strength_model scales the weight before the lora
+               (1.0, (torch.randn(32, 16),), 1.0, None, None),
+               (1.0, lora(32, 16, 4), 1.0, None, None),
+               (0.8, dora, 1.0, None, None),
+               (0.2, lora(32, 16, 4), 1.0, None, None),
+               (0.2, lora(32, 16, 4), 1.0, None, None)]
+    assert [LoRAAdapter.stackable(p) for p in patches] == [True, True, False, False, False, True, False, True, True]
+    out = comfy.lora.calculate_weight(patches, weight.clone(), "w")
+    assert torch.allclose(out, one_by_one(patches, weight.clone(), "w"), atol=1e-3)
+
+
+def test_mismatched_loras_fall_back():
+    torch.manual_seed(0)
+    weight = torch.randn(32, 16)
+    patches = [(1.0, lora(32, 16, 4), 1.0, None, None), (1.0, lora(32, 8, 4), 1.0, None, None)]
+    assert LoRAAdapter.calculate_stacked_weight(patches, weight.clone(), "w") is None
+    out = comfy.lora.calculate_weight(patches, weight.clone(), "w")
+    assert torch.allclose(out, one_by_one(patches[:1], weight.clone(), "w"), atol=1e-4) # the mismatched one is skipped as before
@@ -0,0 +1,57 @@
+from comfy import model_eviction
+from comfy.model_eviction import EvictionCandidate
+
+GB = 1024 ** 3
+
+
+def candidate(key, size, patches=0, source="ram", recency=0, reuse_distance=None, loaded=None):
+    return EvictionCandidate(key, size if loaded is None else loaded, size, patches, source, recency, reuse_distance=reuse_distance)
+
+
+def test_cost_policy_keeps_patched_unet_for_small_vae():
+    unet = candidate("unet", 5 * GB, patches=700, recency=1, reuse_distance=1)
+    clip = candidate("clip", int(1.6 * GB), recency=0)
+    order = model_eviction.cost_policy([unet, clip], int(0.5 * GB))
+    assert [c.key for c in order] == ["clip", "unet"]
+
+
+def test_cost_policy_prefers_pinned_and_unneeded_models():
+    a = candidate("a", 2 * GB, source="ram", recency=0)
+    b = candidate("b", 2 * GB, source="pinned", recency=0)
+    assert model_eviction.cost_policy([a, b], GB)[0].key == "b"
+
+    needed = candidate("needed", 2 * GB, reuse_distance=0)
+    unneeded = candidate("unneeded", 2 * GB, recency=3)
+    assert model_eviction.cost_policy([needed, unneeded], GB)[0].key == "unneeded"
+
+
+def test_legacy_policy_matches_free_memory_order():
+    partial = candidate("partial", 4 * GB, loaded=3 * GB, recency=2)
+    small = candidate("small", GB, recency=1)
+    big = candidate("big", 3 * GB, recency=0)
+    assert [c.key for c in model_eviction.legacy_policy([big, small, partial], GB)] == ["partial", "small", "big"]
+
+
+def test_simulate_counts_reloads():
+    unet = {"id": "unet", "size": 4 * GB, "patches": 100}
+    vae = {"id": "vae", "size": GB}
+    trace = [{"models": [unet]}, {"models": [vae], "memory_required": GB}, {"models": [unet]}]
+    stats = model_eviction.simulate(trace, "cost", 5 * GB)
+    assert stats["loads"] == 3
+    assert stats["misses"] == 3
+    assert stats["bytes_loaded"] == 6 * GB
+    assert stats["partial_evictions"] == 1
+
+    stats = model_eviction.simulate(trace, "cost", 6 * GB)
+    assert stats["misses"] == 2
+    assert stats["evictions"] == 0
+
+
+def test_trace_roundtrip(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    recorder = model_eviction.TraceRecorder(path)
+    recorder.record_load("cuda:0", [{"id": "a", "size": 10}], 5)
+    recorder.record_load("cuda:0", [{"id": "b", "size": 20}], 0)
+    trace = model_eviction.load_trace(path)
+    assert [e["models"][0]["id"] for e in trace] == ["a", "b"]
+    assert model_eviction.simulate(trace, "default", 100)["misses"] == 2
@@ -0,0 +1,81 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_patcher
+import comfy.offload_quantization
+import comfy.ops
+from comfy.quant_ops import QuantizedTensor
+
+
+@pytest.fixture(params=["int8", "fp8"])
+def layout(request, monkeypatch):
+    monkeypatch.setattr(comfy.offload_quantization, "LAYOUT", request.param)
+    return request.param
+
+
+def make_patcher(dtype=torch.bfloat16):
+    torch.manual_seed(0)
+    ops = comfy.ops.manual_cast
+    model = torch.nn.Sequential(ops.Linear(64, 128, dtype=dtype), ops.Conv2d(128, 64, 1, dtype=dtype), ops.LayerNorm(64, dtype=dtype))
+    for p in model.parameters():
+        torch.nn.init.normal_(p, std=0.1)
+    for m in model:
+        m.weight_function, m.bias_function = [], [] # not the class lists, other tests append to them
+    return comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+
+
+def forward(model, x):
+    x = model[0](x)
+    x = model[1](x.reshape(2, 128, 1, 1)).reshape(2, 64)
+    return model[2](x)
+
+
+@pytest.mark.parametrize("layout_name", ["RowwiseInt8Layout", "RowwiseFP8Layout"])
+def test_rowwise_layouts(layout_name):
+    w = torch.randn(32, 16, 3, 3) * torch.linspace(0.01, 10, 32).reshape(32, 1, 1, 1)
+    qt = QuantizedTensor.from_float(w, layout_name)
+    assert qt._layout_params["scale"].shape == (32, 1, 1, 1)
+    error = (qt.dequantize() - w).abs().amax(dim=(1, 2, 3)) / w.abs().amax(dim=(1, 2, 3))
+    assert error.max() < 0.07 # relative to each channel, not to the largest one
+
+
+def test_offloaded_weights_are_quantized(layout):
+    patcher = make_patcher()
+    original = {k: v.clone() for k, v in patcher.model.state_dict().items()}
+    x = torch.randn(2, 64, dtype=torch.bfloat16)
+    expected = forward(patcher.model, x)
+
+    patcher.patch_model(torch.device("cpu"), lowvram_model_memory=1)
+    q0 = comfy.offload_quantization.quantized_weight(patcher.model[0])
+    assert q0 is not None and comfy.offload_quantization.quantized_weight(patcher.model[1]) is not None
+    assert comfy.offload_quantization.quantized_weight(patcher.model[2]) is None # 1d weights are left alone
+    assert q0._qdata.nbytes * 2 == original["0.weight"].nbytes
+    # the model keeps its weights, only what is copied to the compute device is quantized
+    assert all(type(v) is torch.Tensor and torch.equal(v, original[k]) for k, v in patcher.model.state_dict().items())
+
+    out = forward(patcher.model, x)
+    assert not torch.equal(out, expected)
+    assert torch.allclose(out, expected, atol=0.15, rtol=0.1)
+
+    patcher.unpatch_model(torch.device("cpu"))
+    assert comfy.offload_quantization.quantized_weight(patcher.model[0]) is None
+    assert all(torch.equal(v, original[k]) for k, v in patcher.model.state_dict().items())
+    assert torch.equal(forward(patcher.model, x), expected)
+
+
+def test_full_load_drops_the_copies(layout):
+    patcher = make_patcher()
+    patcher.patch_model(torch.device("cpu"), lowvram_model_memory=1)
+    patcher.partially_load(torch.device("cpu"), extra_memory=1024 * 1024 * 1024)
+    assert not patcher.model.model_lowvram
+    assert not any(comfy.offload_quantization.quantized_weight(m) is not None for m in patcher.model.modules())
+
+
+def test_disabled_by_default():
+    patcher = make_patcher()
+    patcher.patch_model(torch.device("cpu"), lowvram_model_memory=1)
+    assert not any(comfy.offload_quantization.quantized_weight(m) is not None for m in patcher.model.modules())
@@ -0,0 +1,94 @@
+import weakref
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_patcher
+import comfy.patched_weight_cache
+from comfy.patched_weight_cache import PatchedWeightCache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = PatchedWeightCache(1024 * 1024)
+    monkeypatch.setattr(comfy.patched_weight_cache, "PATCHED_WEIGHT_CACHE", cache)
+    return cache
+
+
+def make_patcher():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(16, 16), torch.nn.Linear(16, 4))
+    return comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+
+
+def patched_weights(patcher):
+    patcher.patch_model()
+    out = {k: v.detach().clone() for k, v in patcher.model.state_dict().items()}
+    patcher.unpatch_model()
+    return out
+
+
+def test_repatch_uses_cache(cache):
+    patcher = make_patcher()
+    base = {k: v.detach().clone() for k, v in patcher.model.state_dict().items()}
+    diff = {"0.weight": (torch.randn(16, 16),), "1.weight": (torch.randn(4, 16),)}
+    lora = patcher.clone()
+    lora.add_patches(diff, 0.5)
+
+    first = patched_weights(lora)
+    assert cache.misses == 2 and cache.hits == 0
+    assert torch.equal(lora.model.state_dict()["0.weight"], base["0.weight"])
+
+    second = patched_weights(lora)
+    assert cache.hits == 2
+    for k in first:
+        assert torch.equal(first[k], second[k])
+    assert torch.allclose(first["0.weight"], base["0.weight"] + 0.5 * diff["0.weight"][0])
+
+    other = patcher.clone()
+    other.add_patches(diff, 0.25)
+    patched_weights(other)
+    assert cache.misses == 4
+
+
+def test_cache_key_tracks_base_weights(cache):
+    a = make_patcher()
+    b = make_patcher()
+    diff = {"0.weight": (torch.randn(16, 16),)}
+    a.add_patches(diff, 1.0)
+    b.add_patches(diff, 1.0)
+    patched_weights(a)
+    patched_weights(b)
+    assert cache.hits == 0
+    assert a.clone().model.model_weights_uuid == a.model.model_weights_uuid
+
+
+def test_lru_and_spill(tmp_path):
+    cache = PatchedWeightCache(3 * 1024, directory=str(tmp_path), max_disk_bytes=2 * 1024)
+    weights = [torch.full((256,), float(i)) for i in range(6)] # 1KB each
+    for i, w in enumerate(weights):
+        cache.put(i, w, [])
+    assert cache.ram_bytes <= 3 * 1024
+    assert cache.disk_bytes <= 2 * 1024
+    assert cache.get(0) is None
+    assert torch.equal(cache.get(1), weights[1]) # spilled to disk
+    assert torch.equal(cache.get(5), weights[5])
+    cache.clear()
+    assert cache.ram_bytes == 0 and cache.disk_bytes == 0
+    assert len(list(tmp_path.rglob("*.pt"))) == 0
+
+
+def test_entries_dont_keep_patches_alive():
+    cache = PatchedWeightCache(1024 * 1024)
+    diff = torch.randn(256)
+    cache.put("key", torch.zeros(256), [(1.0, (diff,), 1.0, None, None)])
+    ref = weakref.ref(diff)
+    assert cache.get("key") is not None
+    del diff
+    assert ref() is None
+    assert cache.get("key") is None
+    assert cache.ram_bytes == 0
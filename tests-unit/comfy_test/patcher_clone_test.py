@@ -0,0 +1,55 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.hooks
+import comfy.model_patcher
+
+
+def make_patcher():
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.Linear(4, 4))
+    return comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+
+
+def test_clone_shares_patches_until_modified():
+    p = make_patcher()
+    p.add_patches({"0.weight": torch.ones(4, 4)}, 0.5)
+    n = p.clone()
+    assert n.patches["0.weight"] is p.patches["0.weight"]
+
+    n.add_patches({"0.weight": torch.ones(4, 4), "1.weight": torch.ones(4, 4)}, 0.2)
+    assert len(n.patches["0.weight"]) == 2 and "1.weight" in n.patches
+    assert len(p.patches["0.weight"]) == 1 and "1.weight" not in p.patches
+
+    hook = comfy.hooks.WeightHook()
+    n.add_hook_patches(hook, {"0.weight": torch.ones(4, 4)})
+    c = n.clone()
+    c.add_hook_patches(hook, {"0.weight": torch.ones(4, 4), "1.weight": torch.ones(4, 4)})
+    assert len(n.hook_patches[hook.hook_ref]) == 1 and len(n.hook_patches[hook.hook_ref]["0.weight"]) == 1
+    assert len(c.hook_patches[hook.hook_ref]["0.weight"]) == 2
+
+    private = comfy.model_patcher.create_hook_patches_clone(c.hook_patches)
+    private[hook.hook_ref]["0.weight"].append(None)
+    assert len(c.hook_patches[hook.hook_ref]["0.weight"]) == 2
+
+
+def test_clone_model_options():
+    p = make_patcher()
+    patch = object()
+    p.set_model_attn1_patch(patch)
+    p.set_model_attn2_replace(patch, "input", 1)
+    p.set_model_rope_options(1.0, 0.0, 1.0, 0.0, 1.0, 0.0)
+    n = p.clone()
+    assert n.model_options == p.model_options
+    assert n.model_options["transformer_options"]["patches"]["attn1_patch"][0] is patch # values aren't copied
+
+    n.set_model_attn1_patch(patch)
+    n.set_model_attn2_replace(None, "input", 2)
+    n.set_model_rope_options(2.0, 0.0, 1.0, 0.0, 1.0, 0.0)
+    n.model_options["transformer_options"]["patches"]["attn1_patch"][0] = None
+    to = p.model_options["transformer_options"]
+    assert to["patches"]["attn1_patch"] == [patch]
+    assert list(to["patches_replace"]["attn2"]) == [("input", 1)]
+    assert to["rope_options"]["scale_x"] == 1.0
@@ -0,0 +1,115 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.lora
+import comfy.model_patcher
+import comfy.ops
+import comfy.runtime_lora
+from comfy.weight_adapter import LoRAAdapter
+
+
+class Model(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.diffusion_model = torch.nn.Sequential(comfy.ops.manual_cast.Linear(16, 32), comfy.ops.manual_cast.Linear(32, 8))
+        for m in self.diffusion_model:
+            m.weight_function = []
+            m.bias_function = []
+
+    def forward(self, x):
+        return self.diffusion_model(x)
+
+
+def make_patcher():
+    torch.manual_seed(0)
+    model = Model()
+    for p in model.parameters():
+        torch.nn.init.normal_(p)
+    return comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+
+
+def lora(out_dim, in_dim, rank, alpha=None, dora_scale=None):
+    return LoRAAdapter(set(), (torch.randn(out_dim, rank), torch.randn(rank, in_dim), alpha, None, dora_scale, None))
+
+
+def expected(patcher, base, x):
+    sd = {k: comfy.lora.calculate_weight(patcher.patches[k], v.to(torch.float32, copy=True), k) if k in patcher.patches else v for k, v in base.items()}
+    for i in range(2):
+        x = torch.nn.functional.linear(x, sd["diffusion_model.{}.weight".format(i)], sd["diffusion_model.{}.bias".format(i)])
+    return x
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(comfy.runtime_lora, "ENABLED", True)
+
+
+def test_runtime_lora(enabled):
+    p = make_patcher()
+    base = {k: v.clone() for k, v in p.model.state_dict().items()}
+    x = torch.randn(4, 16)
+
+    m = p.clone()
+    m.add_patches({"diffusion_model.0.weight": lora(32, 16, 4, 2.0)}, 0.5)
+    m.add_patches({"diffusion_model.0.weight": lora(32, 16, 8)}, 0.2)
+    m.add_patches({"diffusion_model.1.weight": lora(8, 32, 4, dora_scale=torch.rand(8, 1) + 0.5)}, 0.3) # merged at load time
+    m.patch_model(torch.device("cpu"), lowvram_model_memory=0)
+    assert torch.equal(p.model.diffusion_model[0].weight, base["diffusion_model.0.weight"])
+    assert not torch.equal(p.model.diffusion_model[1].weight, base["diffusion_model.1.weight"])
+    assert isinstance(p.model.diffusion_model[0].weight_function[0], comfy.runtime_lora.RuntimeLoraPatch)
+    assert len(p.model.diffusion_model[1].weight_function) == 0
+    assert torch.allclose(m.model(x), expected(m, base, x), atol=1e-4)
+    m.unpatch_model(torch.device("cpu"))
+    assert all(len(layer.weight_function) == 0 for layer in p.model.diffusion_model)
+    assert all(torch.equal(v, base[k]) for k, v in p.model.state_dict().items())
+
+    m.patch_model(torch.device("cpu"), lowvram_model_memory=1) # lowvram
+    assert p.model.model_lowvram
+    assert [type(layer.weight_function[0]) for layer in p.model.diffusion_model] == [comfy.runtime_lora.RuntimeLoraPatch, comfy.model_patcher.LowVramPatch]
+    assert torch.allclose(m.model(x), expected(m, base, x), atol=1e-4)
+    m.unpatch_model(torch.device("cpu"))
+
+
+def test_switching_loras_doesnt_patch_weights(enabled, monkeypatch):
+    p = make_patcher()
+    base = {k: v.clone() for k, v in p.model.state_dict().items()}
+    x = torch.randn(4, 16)
+    calculated = []
+    calculate_weight = comfy.lora.calculate_weight
+    monkeypatch.setattr(comfy.lora, "calculate_weight", lambda *a, **kw: calculated.append(a[2]) or calculate_weight(*a, **kw))
+
+    a = p.clone()
+    a.add_patches({"diffusion_model.0.weight": lora(32, 16, 4), "diffusion_model.1.weight": lora(8, 32, 4)}, 0.5)
+    b = p.clone()
+    b.add_patches({"diffusion_model.0.weight": lora(32, 16, 4)}, 0.7)
+    for patcher in (a, b, a):
+        patcher.partially_load(torch.device("cpu"), 1e32)
+        out = patcher.model(x)
+        patcher.detach(unpatch_all=False)
+        assert len(calculated) == 0
+        assert torch.allclose(out, expected(patcher, base, x), atol=1e-4)
+        calculated.clear()
+        assert all(torch.equal(v, base[k]) for k, v in p.model.state_dict().items())
+    a.unpatch_model(torch.device("cpu"))
+
+
+def test_conv():
+    torch.manual_seed(0)
+    conv = comfy.ops.manual_cast.Conv2d(4, 8, 3, stride=2, padding=1, dilation=1)
+    torch.nn.init.normal_(conv.weight)
+    torch.nn.init.normal_(conv.bias)
+    conv.bias_function = []
+    patches = [(0.5, LoRAAdapter(set(), (torch.randn(8, 2, 1, 1), torch.randn(2, 4, 3, 3), 4.0, None, None, None)), 1.0, None, None),
+               (0.1, LoRAAdapter(set(), (torch.randn(8, 3, 1, 1), torch.randn(3, 4, 3, 3), None, None, None, None)), 1.0, None, None)]
+    assert comfy.runtime_lora.supported(conv)
+    assert not comfy.runtime_lora.supported(comfy.ops.manual_cast.Conv2d(4, 8, 3, groups=2))
+    assert not comfy.runtime_lora.supported(comfy.ops.fp8_ops.Linear(4, 8)) # applies the weight its own way
+
+    x = torch.randn(2, 4, 9, 9)
+    merged = comfy.lora.calculate_weight(patches, conv.weight.detach().clone(), "w")
+    conv.weight_function = [comfy.runtime_lora.patch("w", patches, conv.weight)]
+    assert torch.allclose(conv(x), torch.nn.functional.conv2d(x, merged, conv.bias, stride=2, padding=1), atol=1e-4)
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+import safetensors.torch
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+from comfy import sd1_clip
+from comfy.sd1_clip import SDTokenizer
+
+PROMPTS = [
+    "a photo of a cat",
+    "(masterpiece:1.2), best quality, a (red:0.8) fox in the ((snow))",
+    "embedding:style a castle, embedding:missing, \\(literal parentheses\\)",
+    "a very long prompt " + "with many repeated words " * 30,
+    "",
+    "a photo of a cat",
+]
+
+
+@pytest.fixture
+def embedding_dir(tmp_path):
+    directory = tmp_path / "embeddings"
+    directory.mkdir()
+    safetensors.torch.save_file({"emb_params": torch.randn(2, 768)}, str(directory / "style.safetensors"))
+    return str(directory)
+
+
+def tokenize_all(tokenizer, prompts):
+    return [tokenizer.tokenize_with_weights(p, return_word_ids=True) for p in prompts]
+
+
+def same_tokens(a, b):
+    assert len(a) == len(b)
+    for batch_a, batch_b in zip(a, b):
+        assert len(batch_a) == len(batch_b)
+        for x, y in zip(batch_a, batch_b):
+            if isinstance(x[0], torch.Tensor):
+                assert torch.equal(x[0], y[0]) and x[1:] == y[1:]
+            else:
+                assert x == y
+
+
+def test_memoised_matches_uncached(embedding_dir):
+    tokenizer = SDTokenizer(embedding_directory=embedding_dir)
+    tokenizer.memoize = False
+    expected = tokenize_all(tokenizer, PROMPTS)
+    tokenizer.memoize = True
+    for _ in range(2): # cold then warm caches
+        for a, b in zip(expected, tokenize_all(tokenizer, PROMPTS)):
+            same_tokens(a, b)
+    for a, b in zip(expected, tokenizer.tokenize_with_weights_batch(PROMPTS, return_word_ids=True)):
+        same_tokens(a, b)
+    assert "a photo of a cat" in tokenizer.word_cache
+
+
+def test_batch_tokenizes_missing_words_once(monkeypatch):
+    tokenizer = SDTokenizer()
+    calls = []
+    hf_tokenizer = tokenizer.tokenizer
+    monkeypatch.setattr(tokenizer, "tokenizer", lambda text: calls.append(text) or hf_tokenizer(text))
+    tokenizer.tokenize_with_weights_batch(["(a:1.1) b", "c (d)", "b"])
+    tokenizer.tokenize_with_weights_batch(["c", "(a:1.1) b"])
+    # every distinct text segment is tokenized exactly once
+    assert sorted(calls) == [" b", "a", "b", "c", "c ", "d"]
+
+
+def test_embedding_resolution_is_invalidated(embedding_dir):
+    sd1_clip.load_embed_file.cache_clear()
+    assert sd1_clip.load_embed("other", embedding_dir, 768) is None
+    first = sd1_clip.load_embed("style", embedding_dir, 768)
+    assert sd1_clip.load_embed("style", embedding_dir, 768) is first
+    assert sd1_clip.load_embed_file.cache_info().misses == 1
+
+    safetensors.torch.save_file({"emb_params": torch.randn(1, 768)}, os.path.join(embedding_dir, "other.safetensors"))
+    os.utime(embedding_dir, ns=(0, 0)) # make sure the directory mtime changes
+    assert sd1_clip.load_embed("other", embedding_dir, 768).shape == (1, 768)
@@ -0,0 +1,77 @@
+import gc
+import os
+
+import pytest
+import safetensors.torch
+import torch
+
+import comfy.shared_weights
+from comfy.shared_weights import SharedWeightPool
+
+
+@pytest.fixture
+def model_file(tmp_path):
+    path = str(tmp_path / "model.safetensors")
+    torch.manual_seed(0)
+    safetensors.torch.save_file({"weight": torch.randn(8, 4), "bias": torch.randn(8).half()}, path, metadata={"format": "pt"})
+    return path
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    pool = SharedWeightPool(str(tmp_path / "pool"), 1024 * 1024)
+    monkeypatch.setattr(comfy.shared_weights, "SHARED_POOL", pool)
+    return pool
+
+
+def test_attach_matches_file(model_file, pool):
+    sd, metadata = comfy.shared_weights.attach(model_file)
+    expected = safetensors.torch.load_file(model_file)
+    assert metadata == {"format": "pt"}
+    for k in expected:
+        assert sd[k].dtype == expected[k].dtype
+        assert torch.equal(sd[k], expected[k])
+        assert comfy.shared_weights.is_shared(sd[k])
+    assert not comfy.shared_weights.is_shared(expected["weight"])
+
+    key = pool.file_key(model_file)
+    assert pool.refcount(key) == 1
+    sd2, _ = pool.attach(model_file)
+    assert sd2["weight"].data_ptr() == sd["weight"].data_ptr()
+
+
+def test_writes_stay_private(model_file, pool):
+    sd, _ = pool.attach(model_file)
+    sd["weight"].fill_(1.0)
+    blob = pool.blob_path(pool.file_key(model_file))
+    assert torch.equal(safetensors.torch.load_file(blob)["weight"], safetensors.torch.load_file(model_file)["weight"])
+
+
+def test_load_state_dict_keeps_shared_weights(model_file, pool):
+    linear = torch.nn.Linear(4, 8)
+    linear.bias.data = linear.bias.data.half()
+    sd, _ = pool.attach(model_file)
+    m, u = comfy.shared_weights.load_state_dict(linear, dict(sd))
+    assert m == [] and u == []
+    assert linear.weight.data_ptr() == sd["weight"].data_ptr()
+    assert linear.bias.data_ptr() == sd["bias"].data_ptr()
+
+    linear.weight.data = linear.weight.data.clone() # what moving to another device and back does
+    comfy.shared_weights.reattach(linear, "cpu")
+    assert linear.weight.data_ptr() == sd["weight"].data_ptr()
+
+
+def test_release_and_evict(model_file, pool, tmp_path):
+    sd, _ = pool.attach(model_file)
+    key = pool.file_key(model_file)
+    assert not pool.evict(pool.max_bytes)
+    del sd
+    gc.collect()
+    assert pool.refcount(key) == 0
+    assert pool.evict(pool.max_bytes)
+    assert not os.path.exists(pool.blob_path(key))
+
+
+def test_too_big_for_pool(model_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(comfy.shared_weights, "SHARED_POOL", SharedWeightPool(str(tmp_path / "small"), 16))
+    assert comfy.shared_weights.attach(model_file) is None
@@ -0,0 +1,84 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_patcher
+import comfy.ops
+import comfy.staging_pool
+from comfy.staging_pool import StagingPool
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = StagingPool(16 * MB, pin=False)
+    monkeypatch.setattr(comfy.staging_pool, "STAGING_POOL", pool)
+    return pool
+
+
+def make_patcher():
+    torch.manual_seed(0)
+    ops = comfy.ops.disable_weight_init
+    model = torch.nn.Sequential(ops.Linear(32, 64), ops.Linear(64, 64), ops.Linear(64, 16, bias=False), ops.Linear(16, 8))
+    for p in model.parameters():
+        torch.nn.init.normal_(p)
+    return comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+
+
+def reference(model, x):
+    for m in model:
+        x = torch.nn.functional.linear(x, m.weight, m.bias)
+    return x
+
+
+def test_offloaded_weights_are_packed_in_order(pool):
+    patcher = make_patcher()
+    x = torch.randn(2, 32)
+    expected = reference(patcher.model, x)
+
+    patcher.patch_model(torch.device("cpu"), lowvram_model_memory=1)
+    group = patcher.model.staging_group
+    assert [n for n, m, params in group.modules] == ["0", "1", "2", "3"]
+    slab = group.slabs[0]
+    ptrs = [p.data_ptr() for p in patcher.model.parameters()]
+    assert ptrs == sorted(ptrs)
+    assert all(p.untyped_storage().data_ptr() == slab.data_ptr() for p in patcher.model.parameters())
+    assert pool.allocated == group.nbytes
+    assert torch.equal(patcher.model(x), expected)
+
+    # same split: the group is kept
+    patcher.unpatch_model(torch.device("cpu"))
+    patcher.patch_model(torch.device("cpu"), lowvram_model_memory=1)
+    assert patcher.model.staging_group is group
+    assert torch.equal(patcher.model(x), expected)
+    patcher.unpatch_model(torch.device("cpu"))
+
+    # fully loaded: nothing left to stage
+    patcher.patch_model(torch.device("cpu"))
+    assert patcher.model.staging_group is None
+    assert not hasattr(patcher.model[0], "comfy_staging_group")
+    assert torch.equal(patcher.model(x), expected)
+
+
+def test_partial_split_and_full_pool():
+    patcher = make_patcher()
+    pool = StagingPool(16 * MB, pin=False)
+    assert pool.stage(patcher.model, patcher._load_list())
+    assert getattr(patcher.model, "staging_group", None) is None # nothing offloaded yet
+
+    patcher.model[0].prev_comfy_cast_weights = False # offloaded by the ModelPatcher
+    patcher.model[2].prev_comfy_cast_weights = False
+    assert pool.stage(patcher.model, patcher._load_list())
+    assert patcher.model.staging_group.keys == {"0.weight", "0.bias", "2.weight"}
+
+    full = StagingPool(1024, pin=False)
+    other = make_patcher()
+    other.model[1].prev_comfy_cast_weights = False
+    before = other.model[1].weight.data_ptr()
+    assert not full.stage(other.model, other._load_list())
+    assert other.model[1].weight.data_ptr() == before
+    assert full.allocated == 0
@@ -0,0 +1,110 @@
+import json
+
+import safetensors
+import safetensors.torch
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_management
+import comfy.model_patcher
+import comfy.safetensors_writer
+import comfy.sd
+
+
+class Model(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.proj = torch.nn.Linear(32, 64, dtype=torch.bfloat16)
+        self.out = torch.nn.Linear(64, 16)
+
+
+def make_patcher():
+    torch.manual_seed(0)
+    model = Model()
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    patcher.add_patches({"proj.weight": (torch.randn(64, 32),), "out.bias": (torch.randn(16),)}, 0.5)
+    return patcher
+
+
+def reference(patcher):
+    sd = {}
+    for k, v in patcher.model.state_dict().items():
+        sd[k] = patcher.patched_weight(k).clone() if k in patcher.patches else v.clone()
+    return sd
+
+
+def test_lazy_patched_save(tmp_path):
+    patcher = make_patcher()
+    expected = reference(patcher)
+    base = {k: v.clone() for k, v in patcher.model.state_dict().items()}
+    assert not torch.equal(expected["proj.weight"], base["proj.weight"])
+
+    sd, lazy = comfy.sd.lazy_patched_state_dict([patcher], patcher.model.state_dict)
+    assert sorted(lazy) == ["out.bias", "proj.weight"]
+    path = str(tmp_path / "model.safetensors")
+    comfy.sd.save_state_dict(sd, path, metadata={"a": "b"}, lazy=lazy)
+    loaded = safetensors.torch.load_file(path)
+    assert sorted(loaded) == sorted(expected)
+    assert all(torch.equal(loaded[k], v) for k, v in expected.items())
+    with safetensors.safe_open(path, framework="pt") as f:
+        assert f.metadata() == {"a": "b"}
+    # the model itself was never patched
+    assert all(torch.equal(patcher.model.state_dict()[k], v) for k, v in base.items())
+    assert len(patcher.backup) == 0
+
+
+def test_loaded_model_is_saved_as_is(tmp_path):
+    patcher = make_patcher()
+    expected = reference(patcher)
+    comfy.model_management.load_models_gpu([patcher], force_patch_weights=True)
+    sd, lazy = comfy.sd.lazy_patched_state_dict([patcher], patcher.model.state_dict)
+    assert lazy == {}
+    path = str(tmp_path / "model.safetensors")
+    comfy.sd.save_state_dict(sd, path)
+    loaded = safetensors.torch.load_file(path)
+    assert all(torch.equal(loaded[k], v.cpu()) for k, v in expected.items())
+
+    clone = patcher.clone()
+    clone.add_patches({"out.weight": (torch.ones(16, 64),)}, 1.0)
+    sd, lazy = comfy.sd.lazy_patched_state_dict([clone], clone.model.state_dict)
+    assert sorted(lazy) == ["out.bias", "out.weight", "proj.weight"] # the model was unpatched
+    assert clone.model.current_weight_patches_uuid is None
+    comfy.sd.save_state_dict(sd, path, lazy=lazy)
+    loaded = safetensors.torch.load_file(path)
+    assert torch.equal(loaded["out.weight"], expected["out.weight"].cpu() + 1)
+
+
+def test_transformed_weights_are_patched_first(tmp_path):
+    patcher = make_patcher()
+    expected = reference(patcher)
+
+    def get_sd():
+        sd = patcher.model.state_dict()
+        sd["proj.weight"] = sd["proj.weight"] * 2 # a copy, can't be patched while saving
+        return sd
+
+    sd, lazy = comfy.sd.lazy_patched_state_dict([patcher], get_sd)
+    assert lazy == {}
+    assert torch.equal(sd["proj.weight"].cpu(), expected["proj.weight"] * 2)
+
+
+def test_quantization_metadata(tmp_path):
+    path = str(tmp_path / "model.safetensors")
+    quant = {"format_version": "1.0", "layers": {"proj": {"format": "float8_e4m3fn"}}}
+    comfy.sd.save_state_dict({"model.diffusion_model.proj.weight": torch.ones(2, 2), "model.diffusion_model._quantization_metadata": quant}, path)
+    with safetensors.safe_open(path, framework="pt") as f:
+        assert json.loads(f.metadata()["_quantization_metadata"]) == quant
+        assert list(f.keys()) == ["model.diffusion_model.proj.weight"]
+
+
+def test_writer_fsync(tmp_path):
+    path = str(tmp_path / "out.safetensors")
+    tensors = {"{}".format(i): torch.randn(256) for i in range(8)}
+    with comfy.safetensors_writer.SafetensorsWriter(path, {k: (v.shape, v.dtype) for k, v in tensors.items()}, fsync_bytes=1024) as writer:
+        for k, v in tensors.items():
+            writer[k] = v
+    loaded = safetensors.torch.load_file(path)
+    assert all(torch.equal(loaded[k], v) for k, v in tensors.items())
@@ -0,0 +1,144 @@
+import hashlib
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_patcher
+import comfy.sd
+import comfy.text_encoder_cache
+from comfy.text_encoder_cache import TextEncoderCache
+
+
+class FakeTextEncoder(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embedding = torch.nn.Embedding(100, 8)
+        self.dtypes = {torch.float32}
+        self.calls = 0
+        self.options = {}
+
+    def reset_clip_options(self):
+        self.options = {}
+
+    def set_clip_options(self, options):
+        self.options.update(options)
+
+    def encode_token_weights(self, tokens):
+        self.calls += 1
+        ids = torch.tensor([[t[0] for t in batch] for batch in tokens["l"]])
+        weights = torch.tensor([[t[1] for t in batch] for batch in tokens["l"]])
+        cond = self.embedding(ids) * weights.unsqueeze(-1) + self.options.get("layer", 0)
+        return cond, cond.mean(dim=1), {"attention_mask": torch.ones_like(ids)}
+
+
+def make_clip(source_path=None):
+    clip = comfy.sd.CLIP(no_init=True)
+    clip.cond_stage_model = FakeTextEncoder()
+    if source_path is not None:
+        clip.cond_stage_model.model_source_paths = [source_path]
+    clip.patcher = comfy.model_patcher.ModelPatcher(clip.cond_stage_model, torch.device("cpu"), torch.device("cpu"))
+    clip.layer_idx = None
+    clip.tokenizer = None
+    clip.tokenizer_options = {}
+    clip.use_clip_schedule = False
+    clip.apply_hooks_to_conds = None
+    return clip
+
+
+def tokens(*ids, weight=1.0):
+    return {"l": [[(i, weight) for i in ids]]}
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = TextEncoderCache(1024 * 1024)
+    monkeypatch.setattr(comfy.text_encoder_cache, "TEXT_ENCODER_CACHE", cache)
+    return cache
+
+
+def test_repeated_encode_is_cached(cache):
+    clip = make_clip()
+    first = clip.encode_from_tokens(tokens(1, 2, 3), return_pooled=True, return_dict=True)
+    second = clip.encode_from_tokens(tokens(1, 2, 3), return_pooled=True, return_dict=True)
+    assert clip.cond_stage_model.calls == 1
+    assert torch.equal(first["cond"], second["cond"])
+    assert "attention_mask" in second
+    second.pop("cond") # callers may modify the returned dict
+    assert "cond" in clip.encode_from_tokens(tokens(1, 2, 3), return_dict=True)
+
+    clip.encode_from_tokens(tokens(1, 2, 3, weight=1.1))
+    clip.encode_from_tokens(tokens(1, 2, 4))
+    layered = clip.clone()
+    layered.clip_layer(-2)
+    layered.encode_from_tokens(tokens(1, 2, 3))
+    assert clip.cond_stage_model.calls == 4
+
+
+def test_patches_change_the_key(cache):
+    clip = make_clip()
+    clip.encode_from_tokens(tokens(5, 6))
+    patched = clip.clone()
+    patched.add_patches({"embedding.weight": (torch.ones(100, 8),)}, 0.5)
+    out = patched.encode_from_tokens(tokens(5, 6))
+    assert clip.cond_stage_model.calls == 2
+    # the same patch contents in another clone are a hit
+    again = clip.clone()
+    again.add_patches({"embedding.weight": (torch.ones(100, 8),)}, 0.5)
+    assert torch.equal(again.encode_from_tokens(tokens(5, 6)), out)
+    assert clip.cond_stage_model.calls == 2
+
+
+def scale(weight, **kwargs):
+    return weight * 2
+
+
+class Layer:
+    def __init__(self, scale_weight):
+        self.scale_weight = scale_weight
+
+    def convert_weight(self, weight, **kwargs):
+        return weight * self.scale_weight
+
+
+def test_only_named_functions_are_hashed_by_name():
+    def digest(obj):
+        h = hashlib.sha1()
+        comfy.text_encoder_cache.update_digest(h, obj)
+        return h.hexdigest()
+
+    assert digest(scale) == digest(scale)
+    def scaled_by(s):
+        return lambda weight, **kwargs: weight * s
+    for fn in [Layer(2.0).convert_weight, scaled_by(2.0), lambda weight: weight]:
+        with pytest.raises(comfy.text_encoder_cache.Uncacheable):
+            digest(fn)
+
+
+def test_persisted_across_restarts(tmp_path, monkeypatch):
+    source = tmp_path / "te.safetensors"
+    source.write_bytes(b"weights")
+    directory = str(tmp_path / "cache")
+
+    monkeypatch.setattr(comfy.text_encoder_cache, "TEXT_ENCODER_CACHE", TextEncoderCache(1024 * 1024, directory, 1024 * 1024))
+    clip = make_clip(str(source))
+    expected = clip.encode_from_tokens(tokens(7, 8, 9), return_pooled=True)
+
+    # new process: new cache and new model object with the same weights file
+    monkeypatch.setattr(comfy.text_encoder_cache, "TEXT_ENCODER_CACHE", TextEncoderCache(1024 * 1024, directory, 1024 * 1024))
+    clip2 = make_clip(str(source))
+    cond, pooled = clip2.encode_from_tokens(tokens(7, 8, 9), return_pooled=True)
+    assert clip2.cond_stage_model.calls == 0
+    assert torch.equal(cond, expected[0]) and torch.equal(pooled, expected[1])
+
+
+def test_memory_bound():
+    cache = TextEncoderCache(3000)
+    for i in range(10):
+        cache.put(str(i), {"cond": torch.zeros(256)}, False)
+    assert cache.ram_bytes <= 3000
+    assert cache.get("9", False) is not None
+    assert cache.get("0", False) is None
@@ -0,0 +1,91 @@
+import itertools
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.utils
+
+
+def reference_tiled_scale(samples, function, tile, overlap, upscale_amount, out_channels):
+    # the original one tile at a time implementation, for a constant upscale_amount
+    dims = len(tile)
+    output = torch.empty([samples.shape[0], out_channels] + [round(upscale_amount * x) for x in samples.shape[2:]])
+    for b in range(samples.shape[0]):
+        s = samples[b:b+1]
+        out = torch.zeros([1, out_channels] + [round(upscale_amount * x) for x in s.shape[2:]])
+        out_div = torch.zeros_like(out)
+        positions = [range(0, s.shape[d+2] - overlap, tile[d] - overlap) if s.shape[d+2] > tile[d] else [0] for d in range(dims)]
+        for it in itertools.product(*positions):
+            s_in = s
+            upscaled = []
+            for d in range(dims):
+                pos = max(0, min(s.shape[d + 2] - overlap, it[d]))
+                length = min(tile[d], s.shape[d + 2] - pos)
+                s_in = s_in.narrow(d + 2, pos, length)
+                upscaled.append(round(upscale_amount * pos))
+            ps = function(s_in)
+            mask = torch.ones_like(ps)
+            for d in range(2, dims + 2):
+                feather = round(upscale_amount * overlap)
+                if feather >= mask.shape[d]:
+                    continue
+                for t in range(feather):
+                    a = (t + 1) / feather
+                    mask.narrow(d, t, 1).mul_(a)
+                    mask.narrow(d, mask.shape[d] - 1 - t, 1).mul_(a)
+            o = out
+            o_d = out_div
+            for d in range(dims):
+                o = o.narrow(d + 2, upscaled[d], mask.shape[d + 2])
+                o_d = o_d.narrow(d + 2, upscaled[d], mask.shape[d + 2])
+            o.add_(ps * mask)
+            o_d.add_(mask)
+        output[b:b+1] = out / out_div
+    return output
+
+
+@pytest.fixture
+def upscaler():
+    torch.manual_seed(0)
+    conv = torch.nn.Conv2d(4, 3, 3, padding=1)
+    return lambda a: torch.nn.functional.interpolate(conv(a), scale_factor=4)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_matches_reference(upscaler, workers):
+    samples = torch.randn(2, 4, 45, 38)
+    with torch.inference_mode():
+        expected = reference_tiled_scale(samples, upscaler, (16, 12), 4, 4, 3)
+    out = comfy.utils.tiled_scale(samples, upscaler, tile_x=12, tile_y=16, overlap=4, upscale_amount=4, workers=workers)
+    assert torch.equal(out, expected)
+
+
+def test_tile_batch(upscaler):
+    samples = torch.randn(1, 4, 40, 40)
+    expected = comfy.utils.tiled_scale(samples, upscaler, tile_x=16, tile_y=16, overlap=4, upscale_amount=4)
+    calls = []
+    def counted(a):
+        calls.append(a.shape[0])
+        return upscaler(a)
+    out = comfy.utils.tiled_scale(samples, counted, tile_x=16, tile_y=16, overlap=4, upscale_amount=4, tile_batch=4, workers=2)
+    assert torch.allclose(out, expected, atol=1e-5)
+    assert max(calls) > 1
+    assert sum(calls) == comfy.utils.get_tiled_scale_steps(40, 40, 16, 16, 4)
+
+
+def test_plan_and_masks_are_reused(upscaler, monkeypatch):
+    comfy.utils.tile_plan.cache_clear()
+    masks = []
+    tile_feather_mask = comfy.utils.tile_feather_mask
+    monkeypatch.setattr(comfy.utils, "tile_feather_mask", lambda *a: masks.append(a[0]) or tile_feather_mask(*a))
+    samples = torch.randn(3, 4, 45, 45)
+    comfy.utils.tiled_scale(samples, upscaler, tile_x=16, tile_y=16, overlap=4, upscale_amount=4)
+    assert comfy.utils.tile_plan.cache_info().misses == 1
+    assert len(masks) == 4 # inner, right, bottom and corner tiles, for the whole batch
+    comfy.utils.tiled_scale(samples, upscaler, tile_x=16, tile_y=16, overlap=4, upscale_amount=4)
+    assert comfy.utils.tile_plan.cache_info().misses == 1
+    assert len(masks) == 8 # the masks aren't kept after the call
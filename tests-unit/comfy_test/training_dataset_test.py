@@ -0,0 +1,127 @@
+import os
+import threading
+import types
+import uuid
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+import comfy.training_dataset
+
+
+class FakeVAE:
+    def __init__(self):
+        self.patcher = types.SimpleNamespace(model=types.SimpleNamespace(model_weights_uuid=uuid.uuid4()), patches={})
+        self.vae_dtype = torch.float32
+        self.encoded = 0
+
+    def encode(self, pixels):
+        self.encoded += pixels.shape[0]
+        return pixels.movedim(-1, 1)[:, :, ::8, ::8] * 2
+
+
+class FakeCLIP:
+    def __init__(self):
+        self.patcher = types.SimpleNamespace(model=types.SimpleNamespace(model_weights_uuid=uuid.uuid4()), patches={})
+        self.layer_idx = None
+        self.encoded = []
+
+    def tokenize(self, text):
+        return text
+
+    def encode_from_tokens_scheduled(self, tokens):
+        self.encoded.append(tokens)
+        return [[torch.full((1, 2, 4), float(len(tokens))), {"pooled_output": torch.zeros(1, 4)}]]
+
+
+def load_image(path, resize_method, w, h):
+    img = Image.open(path).convert("RGB").resize((w, h))
+    return torch.from_numpy(np.array(img).astype(np.float32) / 255.0)[None,]
+
+
+@pytest.fixture
+def folder(tmp_path):
+    for i in range(5):
+        Image.fromarray(np.full((16, 16, 3), i * 40, dtype=np.uint8)).save(tmp_path / "{}.png".format(i))
+        if i % 2 == 0:
+            (tmp_path / "{}.txt".format(i)).write_text("caption {}".format(i))
+    os.makedirs(tmp_path / "3_repeated")
+    Image.fromarray(np.full((16, 16, 3), 250, dtype=np.uint8)).save(tmp_path / "3_repeated" / "r.png")
+    return tmp_path
+
+
+def test_list_image_caption_files(folder):
+    images, captions = comfy.training_dataset.list_image_caption_files(str(folder))
+    assert [os.path.basename(f) for f in images] == ["0.png", "1.png", "2.png", "3.png", "r.png", "r.png", "r.png", "4.png"]
+    assert [comfy.training_dataset.read_caption(f) for f in captions[:3]] == ["caption 0", "", "caption 2"]
+
+
+def test_dataset_is_cached(folder, tmp_path_factory):
+    images, captions = comfy.training_dataset.list_image_caption_files(str(folder))
+    captions = [comfy.training_dataset.read_caption(f) for f in captions]
+    cache = comfy.training_dataset.DatasetCache(str(tmp_path_factory.mktemp("cache")))
+    vae, clip = FakeVAE(), FakeCLIP()
+
+    dataset = comfy.training_dataset.build_dataset(cache, images, captions, vae, clip, load_image, "Stretch", 16, 16, workers=2, encode_batch_size=2)
+    assert len(dataset) == 8
+    assert vae.encoded == 6 # the repeated image is encoded once
+    assert sorted(clip.encoded) == ["", "caption 0", "caption 2", "caption 4"]
+    latent, cond = dataset.load(2)
+    assert latent.shape == (3, 2, 2)
+    assert torch.allclose(latent, torch.full((3, 2, 2), 2 * 80 / 255))
+    assert cond[0][0][0, 0, 0].item() == len("caption 2")
+
+    dataset = comfy.training_dataset.build_dataset(cache, images, captions, vae, clip, load_image, "Stretch", 16, 16)
+    assert vae.encoded == 6 and len(clip.encoded) == 4
+
+    comfy.training_dataset.build_dataset(cache, images, captions, vae, clip, load_image, "Stretch", 8, 8)
+    assert vae.encoded == 12 # other size
+    comfy.training_dataset.build_dataset(cache, images, captions, FakeVAE(), clip, load_image, "Stretch", 16, 16)
+    assert len(clip.encoded) == 4 # only the latents depend on the vae
+
+
+def test_cache_prunes_other_datasets(tmp_path):
+    cache = comfy.training_dataset.DatasetCache(str(tmp_path), max_bytes=None)
+    for i, key in enumerate(["old", "used", "current"]):
+        cache.put(key, torch.zeros(256))
+        os.utime(cache.path(key), (i, i))
+    cache.get("used")
+    cache.prune(keep=["used"]) # no limit: only marks used as recently used
+    assert all(k in cache for k in ["old", "used", "current"])
+
+    cache.max_bytes = os.path.getsize(cache.path("used")) + os.path.getsize(cache.path("current"))
+    cache.prune(keep=["current"])
+    assert "old" not in cache and "used" in cache and "current" in cache
+    cache.max_bytes = 0
+    cache.prune(keep=["current"]) # the current dataset is kept even over the limit
+    assert "used" not in cache and "current" in cache
+
+
+def test_batches(folder, tmp_path_factory):
+    images, captions = comfy.training_dataset.list_image_caption_files(str(folder))
+    captions = [comfy.training_dataset.read_caption(f) for f in captions]
+    cache = comfy.training_dataset.DatasetCache(str(tmp_path_factory.mktemp("cache")))
+    dataset = comfy.training_dataset.build_dataset(cache, images, captions, FakeVAE(), FakeCLIP(), load_image, "Stretch", 16, 16)
+
+    schedule = [[0, 1], [4, 2], [3, 0]]
+    batches = list(dataset.batches(schedule))
+    assert len(batches) == 3
+    for indices, (latents, conds) in zip(schedule, batches):
+        assert torch.equal(latents, torch.stack([dataset.load(i)[0] for i in indices]))
+        assert [c[0][0, 0, 0].item() for c in conds] == [len(captions[i]) for i in indices]
+
+    dataset.prefetch = 1
+    loaded = []
+    load = dataset.load
+    dataset.load = lambda i: loaded.append(i) or load(i)
+    batches = dataset.batches([[0], [1], [2], [3], [4]])
+    next(batches)
+    threading.Event().wait(0.3)
+    assert len(loaded) <= 3 # one consumed, one queued and one waiting to be queued
+    batches.close()
+
+    dataset.load = lambda i: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        list(dataset.batches([[0]]))
@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+from spandrel import ModelLoader
+from spandrel.architectures.Compact.__arch.SRVGG import SRVGGNetCompact
+
+import comfy.upscale_tiling
+from comfy.upscale_tiling import TileMemoryModel, TileMemoryStore, plan_tiles
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def upscale_model():
+    torch.manual_seed(0)
+    return ModelLoader().load_from_state_dict(SRVGGNetCompact(num_feat=16, num_conv=4, upscale=4).state_dict()).eval()
+
+
+def test_measure_grows_with_pixels(upscale_model):
+    memory_model = comfy.upscale_tiling.measure(upscale_model, "cpu")
+    assert memory_model.method == "hooks"
+    # the biggest module call holds at least a 16 channel feature map of the tile
+    assert memory_model.per_pixel >= 16 * 4
+    assert memory_model.tile_bytes(256) > memory_model.tile_bytes(128)
+    assert memory_model.tile_bytes(128, batch=2) == pytest.approx(2 * memory_model.tile_bytes(128))
+
+
+def test_store_persists(upscale_model, tmp_path, monkeypatch):
+    path = str(tmp_path / "tile_memory.json")
+    memory_model = TileMemoryStore(path).get(upscale_model, "cpu")
+
+    def fail(*args):
+        raise AssertionError("measured twice")
+    monkeypatch.setattr(comfy.upscale_tiling, "measure", fail)
+    assert TileMemoryStore(path).get(upscale_model, "cpu") == memory_model
+
+
+def test_plan_tiles():
+    memory_model = TileMemoryModel(fixed=MB, per_pixel=1024, method="hooks")
+    # whole image fits
+    assert plan_tiles(memory_model, 300, 200, 1024 * MB) == (320, 1)
+    tile, batch = plan_tiles(memory_model, 2048, 2048, 256 * MB)
+    assert memory_model.tile_bytes(tile) <= 256 * MB < memory_model.tile_bytes(tile + comfy.upscale_tiling.TILE_MULTIPLE)
+    assert batch == 1
+    small_tile, small_batch = plan_tiles(memory_model, 2048, 2048, 256 * MB, max_tile=256)
+    assert small_tile == 256 and small_batch > 1
+    assert memory_model.tile_bytes(small_tile, small_batch) <= 256 * MB
+    # never below the minimum tile even when nothing fits
+    assert plan_tiles(memory_model, 2048, 2048, MB)[0] == comfy.upscale_tiling.MIN_TILE
@@ -0,0 +1,41 @@
+import types
+
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.sd
+
+
+class UpsampleDecoder(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(4, 3, 3, padding=1)
+
+    def decode(self, z, scale=1.0):
+        return torch.nn.functional.interpolate(self.conv(z), scale_factor=2) * scale
+
+
+def fake_vae():
+    torch.manual_seed(0)
+    return types.SimpleNamespace(
+        first_stage_model=UpsampleDecoder(),
+        process_output=lambda image: torch.clamp((image + 1.0) / 2.0, min=0.0, max=1.0),
+        device=torch.device("cpu"),
+        output_device=torch.device("cpu"),
+        vae_dtype=torch.bfloat16,
+    )
+
+
+def test_pipelined_decode_matches_sequential():
+    vae = fake_vae()
+    vae.first_stage_model.to(vae.vae_dtype)
+    samples = torch.randn(7, 4, 8, 8)
+    with torch.inference_mode():
+        expected = torch.cat([vae.process_output(vae.first_stage_model.decode(samples[x:x+3].to(vae.vae_dtype), scale=0.5).float()) for x in range(0, 7, 3)])
+        out = comfy.sd.VAE.decode_pipelined(vae, samples, 3, {"scale": 0.5})
+    assert out.dtype == torch.float32
+    assert out.shape == (7, 3, 16, 16)
+    assert torch.equal(out, expected)
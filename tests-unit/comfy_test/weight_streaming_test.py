@@ -0,0 +1,104 @@
+import json
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_patcher
+import comfy.ops
+import comfy.weight_streaming
+from comfy.ldm.flux.model import Flux
+from comfy.ldm.modules.diffusionmodules.mmdit import OpenAISignatureMMDITWrapper
+from comfy.ldm.modules.diffusionmodules.openaimodel import UNetModel
+
+ops = comfy.ops.manual_cast
+
+
+def unet():
+    model = UNetModel(image_size=32, in_channels=4, model_channels=32, out_channels=4, num_res_blocks=[1, 1], channel_mult=(1, 2), num_head_channels=16,
+                      use_spatial_transformer=True, transformer_depth=[0, 1], transformer_depth_output=[0, 0, 1, 1], transformer_depth_middle=1, context_dim=32,
+                      use_linear_in_transformer=True, dtype=torch.float32, operations=ops)
+    return initialized(model, {"context": torch.randn(1, 7, 32)})
+
+
+def mmdit():
+    model = OpenAISignatureMMDITWrapper(input_size=None, patch_size=2, in_channels=4, depth=2, adm_in_channels=32, pos_embed_max_size=16, num_patches=256,
+                                        context_embedder_config={"target": "torch.nn.Linear", "params": {"in_features": 32, "out_features": 128}}, operations=ops)
+    return initialized(model, {"context": torch.randn(1, 7, 32), "y": torch.randn(1, 32)})
+
+
+def flux():
+    model = Flux(in_channels=4, out_channels=4, vec_in_dim=32, context_in_dim=32, hidden_size=64, mlp_ratio=2.0, num_heads=4, depth=1, depth_single_blocks=2,
+                 axes_dim=[4, 6, 6], theta=10000, patch_size=2, qkv_bias=True, guidance_embed=False, operations=ops)
+    return initialized(model, {"context": torch.randn(1, 7, 32), "y": torch.randn(1, 32)})
+
+
+def initialized(model, kwargs):
+    for p in model.parameters():
+        torch.nn.init.normal_(p, std=0.05)
+    return model, kwargs
+
+
+@pytest.fixture(autouse=True)
+def prefetch(monkeypatch):
+    monkeypatch.setattr(comfy.weight_streaming, "PREFETCH_DEPTH", 2)
+
+
+def run(patcher, x, kwargs):
+    with torch.inference_mode(), comfy.weight_streaming.forward_pass(patcher, x):
+        return patcher.model(x, torch.tensor([0.5]), **kwargs)
+
+
+@pytest.mark.parametrize("make_model", [unet, mmdit, flux])
+def test_prefetch_follows_execution_order(make_model):
+    torch.manual_seed(0)
+    model, kwargs = make_model()
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    patcher.patch_model(torch.device("cpu"), lowvram_model_memory=1)
+    x = torch.randn(1, 4, 16, 16)
+
+    first = run(patcher, x, kwargs)
+    order = patcher.execution_orders[comfy.weight_streaming.shape_key(x)]
+    scheduler = model.prefetch_scheduler
+    assert scheduler.order is order
+    names = scheduler.names()
+    assert len(names) > 10
+    assert names == [n for n in order.names if n in set(names)]
+
+    scheduler.log = []
+    assert torch.equal(run(patcher, x, kwargs), first)
+    assert patcher.execution_orders[comfy.weight_streaming.shape_key(x)] is order # recorded once
+    fetched = [names[i] for kind, i in scheduler.log if kind == "fetch"]
+    prefetched = [names[i] for kind, i in scheduler.log if kind == "prefetch"]
+    assert fetched == names
+    assert prefetched == names[1:]
+    for i in range(1, len(names)):
+        assert scheduler.log.index(("prefetch", i)) < scheduler.log.index(("fetch", i))
+
+    patcher.unpatch_model(torch.device("cpu"))
+    assert getattr(model, "prefetch_scheduler", None) is None
+
+
+def test_no_recording_when_fully_loaded():
+    model, kwargs = flux()
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    patcher.patch_model(torch.device("cpu"))
+    run(patcher, torch.randn(1, 4, 16, 16), kwargs)
+    assert patcher.execution_orders == {}
+    assert getattr(model, "prefetch_scheduler", None) is None
+
+
+def test_trace_dump(tmp_path, monkeypatch):
+    monkeypatch.setattr(comfy.weight_streaming, "TRACE_DIRECTORY", str(tmp_path))
+    model, kwargs = unet()
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    run(patcher, torch.randn(1, 4, 16, 16), kwargs)
+    order = patcher.execution_orders[comfy.weight_streaming.shape_key(torch.randn(1, 4, 16, 16))]
+    with open(tmp_path / "UNetModel_1x4x16x16.json") as f:
+        trace = json.load(f)
+    assert len(trace["traceEvents"]) == len(order.calls)
+    assert trace["otherData"]["order"] == order.names
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in trace["traceEvents"])
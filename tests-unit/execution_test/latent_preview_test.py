@@ -0,0 +1,119 @@
+import time
+import types
+
+import pytest
+import torch
+
+from comfy.cli_args import args, LatentPreviewMethod
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.latent_formats
+import comfy.utils
+import latent_preview
+
+
+@pytest.fixture
+def preview_args(monkeypatch):
+    monkeypatch.setattr(args, "preview_method", LatentPreviewMethod.Latent2RGB)
+    monkeypatch.setattr(args, "preview_interval", 1)
+    monkeypatch.setattr(args, "preview_max_fps", 0)
+    monkeypatch.setattr(latent_preview, "PREVIEWERS", {})
+    monkeypatch.setattr(latent_preview, "PREVIEW_SUBSCRIBER_CHECK", None)
+
+
+@pytest.fixture
+def progress(monkeypatch):
+    events = []
+    def hook(value, total, preview, node_id=None):
+        events.append((value, total, preview))
+    monkeypatch.setattr(comfy.utils, "PROGRESS_BAR_HOOK", hook)
+    return events
+
+
+def fake_model():
+    model = types.SimpleNamespace(latent_format=comfy.latent_formats.SD15())
+    return types.SimpleNamespace(load_device=torch.device("cpu"), model=model)
+
+
+def run_sampler(callback, steps):
+    for step in range(steps):
+        callback(step, torch.randn(1, 4, 8, 8), None, steps)
+    latent_preview.PREVIEW_WORKER.wait()
+
+
+def test_previewer_is_reused(preview_args):
+    latent_format = comfy.latent_formats.SD15()
+    previewer = latent_preview.get_previewer(torch.device("cpu"), latent_format)
+    assert isinstance(previewer, latent_preview.Latent2RGBPreviewer)
+    assert latent_preview.get_previewer(torch.device("cpu"), comfy.latent_formats.SD15()) is previewer
+    assert latent_preview.get_previewer(torch.device("cpu"), comfy.latent_formats.SDXL()) is not previewer
+
+
+def test_taesd_decoder_added_later_is_used(preview_args, monkeypatch):
+    monkeypatch.setattr(args, "preview_method", LatentPreviewMethod.TAESD)
+    decoder = [None]
+    monkeypatch.setattr(latent_preview, "find_taesd_decoder", lambda latent_format: decoder[0])
+    monkeypatch.setattr(latent_preview, "TAESD", lambda encoder_path, decoder_path, latent_channels: torch.nn.Identity())
+    fallback = latent_preview.get_previewer(torch.device("cpu"), comfy.latent_formats.SD15())
+    assert isinstance(fallback, latent_preview.Latent2RGBPreviewer)
+    assert latent_preview.get_previewer(torch.device("cpu"), comfy.latent_formats.SD15()) is fallback
+
+    decoder[0] = "models/vae_approx/taesd_decoder.safetensors"
+    previewer = latent_preview.get_previewer(torch.device("cpu"), comfy.latent_formats.SD15())
+    assert isinstance(previewer, latent_preview.TAESDPreviewerImpl)
+    assert latent_preview.get_previewer(torch.device("cpu"), comfy.latent_formats.SD15()) is previewer
+
+
+def test_previews_are_sent(preview_args, progress):
+    run_sampler(latent_preview.prepare_callback(fake_model(), 5), 5)
+    previews = [e for e in progress if e[2] is not None]
+    assert 1 <= len(previews) <= 5
+    assert previews[-1][0] == 5 # the final step always has a preview
+    assert [e[0] for e in progress if e[2] is None] == [1, 2, 3, 4]
+
+
+def test_no_previews_without_subscribers(preview_args, progress):
+    latent_preview.set_preview_subscriber_check(lambda: False)
+    run_sampler(latent_preview.prepare_callback(fake_model(), 5), 5)
+    assert [e[0] for e in progress] == [1, 2, 3, 4, 5]
+    assert all(e[2] is None for e in progress)
+
+
+def test_preview_interval(preview_args, progress, monkeypatch):
+    monkeypatch.setattr(args, "preview_interval", 4)
+    decoded = []
+    previewer = latent_preview.get_previewer(torch.device("cpu"), comfy.latent_formats.SD15())
+    original = previewer.decode_latent_to_preview_image
+    monkeypatch.setattr(previewer, "decode_latent_to_preview_image", lambda f, x0: decoded.append(x0) or original(f, x0))
+    run_sampler(latent_preview.prepare_callback(fake_model(), 9), 9)
+    assert 2 <= len(decoded) <= 3 # steps 0 and 4 (unless replaced by a newer one before decoding) and the last one
+
+
+def test_pending_previews_are_dropped_when_sampling_ends(preview_args, progress, monkeypatch):
+    previewer = latent_preview.get_previewer(torch.device("cpu"), comfy.latent_formats.SD15())
+    original = previewer.decode_latent_to_preview_image
+    monkeypatch.setattr(previewer, "decode_latent_to_preview_image", lambda f, x0: time.sleep(0.05) or original(f, x0))
+    callback = latent_preview.prepare_callback(fake_model(), 10)
+    try:
+        for step in range(3):
+            callback(step, torch.randn(1, 4, 8, 8), None, 10)
+        raise latent_preview.comfy.model_management.InterruptProcessingException()
+    except latent_preview.comfy.model_management.InterruptProcessingException:
+        pass
+    finally:
+        latent_preview.finish_previews()
+    sent = len(progress)
+    time.sleep(0.2)
+    assert len(progress) == sent # nothing is sent after sampling ended
+    assert len(progress) < 6 # some of the previews were dropped
+
+
+def test_no_preview_is_sent_after_an_unpreviewed_last_step(preview_args, progress, monkeypatch):
+    monkeypatch.setattr(args, "preview_max_fps", 1e-3)
+    callback = latent_preview.prepare_callback(fake_model(), 3)
+    for step in range(3):
+        latent_preview.set_preview_subscriber_check(lambda: step < 2)
+        callback(step, torch.randn(1, 4, 8, 8), None, 3)
+    time.sleep(0.05)
+    assert progress[-1] == (3, 3, None)
@@ -0,0 +1,90 @@
+import os
+from unittest.mock import MagicMock
+
+import pytest
+import safetensors.torch
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_prefetch
+import comfy.utils
+from comfy.model_prefetch import ModelStagingStore
+from comfy_execution import prefetch
+
+
+@pytest.fixture
+def model_file(tmp_path):
+    path = os.path.join(tmp_path, "model.safetensors")
+    safetensors.torch.save_file({"a": torch.arange(16.0), "b": torch.ones(4, 4)}, path, metadata={"format": "pt"})
+    return path
+
+
+@pytest.fixture
+def staging():
+    store = comfy.model_prefetch.enable_staging(1024 * 1024)
+    yield store
+    comfy.model_prefetch.STAGING_STORE = None
+
+
+def test_staged_file_is_handed_over_once(model_file, staging, monkeypatch):
+    monkeypatch.setattr(comfy.model_prefetch, "STAGING_RAM_HEADROOM", 0)
+    assert staging.stage(model_file)
+    assert not staging.stage(model_file)
+
+    sd, metadata = comfy.utils.load_torch_file(model_file, return_metadata=True)
+    assert metadata == {"format": "pt"}
+    assert torch.equal(sd["a"], torch.arange(16.0))
+    assert staging.hits == 1
+    assert not staging.is_staged(model_file)
+
+    sd = comfy.utils.load_torch_file(model_file)
+    assert torch.equal(sd["b"], torch.ones(4, 4))
+    assert staging.hits == 1
+
+
+def test_stage_respects_budget(model_file, monkeypatch):
+    monkeypatch.setattr(comfy.model_prefetch, "STAGING_RAM_HEADROOM", 0)
+    store = ModelStagingStore(16)
+    assert not store.stage(model_file)
+    assert store.total_bytes() == 0
+
+
+def test_modified_file_is_not_used(model_file, staging, monkeypatch):
+    monkeypatch.setattr(comfy.model_prefetch, "STAGING_RAM_HEADROOM", 0)
+    assert staging.stage(model_file)
+    safetensors.torch.save_file({"a": torch.zeros(32)}, model_file)
+    sd = comfy.utils.load_torch_file(model_file)
+    assert list(sd.keys()) == ["a"]
+    assert torch.equal(sd["a"], torch.zeros(32))
+
+
+def test_retain_drops_unwanted(model_file, staging, monkeypatch):
+    monkeypatch.setattr(comfy.model_prefetch, "STAGING_RAM_HEADROOM", 0)
+    staging.stage(model_file)
+    staging.retain([model_file])
+    assert staging.is_staged(model_file)
+    staging.retain([])
+    assert not staging.is_staged(model_file)
+
+
+def test_plan_skips_files_of_running_prompt(monkeypatch):
+    monkeypatch.setattr(prefetch.folder_paths, "get_full_path", lambda folder, name: "/{}/{}".format(folder, name))
+    running_prompt = {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "base.safetensors"}},
+    }
+    queued_prompt = {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "base.safetensors"}},
+        "2": {"class_type": "LoraLoader", "inputs": {"lora_name": "style.safetensors", "model": ["1", 0]}},
+        "3": {"class_type": "VAELoader", "inputs": {"vae_name": ["4", 0]}},
+        "5": {"class_type": "KSampler", "inputs": {"seed": 0}},
+    }
+    queue = MagicMock()
+    queue.get_current_queue_volatile.return_value = ([(0, "a", running_prompt, {}, [])], [(1, "b", queued_prompt, {}, [])])
+    prefetcher = prefetch.ModelPrefetcher(queue, 1024)
+    in_use, wanted = prefetcher.plan()
+    assert in_use == ["/checkpoints/base.safetensors"]
+    assert wanted == ["/loras/style.safetensors"]
+    comfy.model_prefetch.STAGING_STORE = None